@@ -1,20 +1,17 @@
-from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from bson import ObjectId, json_util
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+import atexit
 import datetime
-from .models import ChatSession
-
-# Initialize MongoDB client and collection with environment variables
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-MONGO_URI = os.getenv('MONGO_URI')
-MONGO_DB = os.getenv('MONGO_DB', 'default_db')
-MONGO_COLLECTION = os.getenv('MONGO_COLLECTION', 'default_collection')
-
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DB]
-collection = db[MONGO_COLLECTION]
+import queue
+import random
+import threading
+import time
+from .models import ChatSession, ChatTurn
+from .mongo import get_collection
 
 def get_selected_category(state):
     category_mapping = {
@@ -26,41 +23,286 @@ def get_selected_category(state):
     }
     return category_mapping.get(state, "Unknown")
 
+def archive_id(chat_session):
+    """Deterministic _id of a session's archive, so archiving a session twice stores it once"""
+    return f"{chat_session.pk}:{chat_session.created_at.isoformat()}"
+
+def only_duplicates(error):
+    """True when a BulkWriteError only reports documents Mongo already holds"""
+    return (not error.details.get("writeConcernErrors")
+            and all(write_error.get("code") == 11000 for write_error in error.details.get("writeErrors", [])))
+
+def build_archive(chat_session, turns, session_end):
+    """The Mongo document archived for a finished session"""
+    chat_messages = []
+    for msg in turns:
+        entry = {
+            "timestamp": msg["timestamp"],
+            "user_message": msg.get("user", ""),
+            "bot_response": msg.get("bot", ""),
+            "node_id": msg.get("node_id"),
+            "message_type": "text"
+        }
+        if entry["user_message"] or entry["bot_response"]:
+            chat_messages.append(entry)
+
+    return {
+        "_id": archive_id(chat_session),
+        "session_id": chat_session.session_id,
+        "timestamp": datetime.datetime.now(),
+        "selected_language": chat_session.selected_language,  # Save selected language
+        "selected_category": get_selected_category(chat_session.state),  # Ensure selected category is saved
+        "chat_messages": chat_messages,
+        "session_start": chat_session.created_at,
+        "session_end": session_end,
+        "final_state": chat_session.state
+    }
+
 def save_chat_history(session_id, chat_session, user_message):
     try:
-        chat_messages = []
-        for msg in chat_session.chat_history:
-            entry = {
-                "timestamp": datetime.datetime.now().isoformat(),
-                "user_message": msg.get("user", ""),
-                "bot_response": msg.get("bot", ""),
-                "message_type": "text"
-            }
-            if entry["user_message"] or entry["bot_response"]:
-                chat_messages.append(entry)
-        
-        chat_data = {
-            "session_id": session_id,
-            "timestamp": datetime.datetime.now(),
-            "selected_language": chat_session.selected_language,  # Save selected language
-            "selected_category": get_selected_category(chat_session.state),  # Ensure selected category is saved
-            "chat_messages": chat_messages,
-            "session_start": chat_session.created_at,
-            "session_end": datetime.datetime.now(),
-            "final_state": chat_session.state
-        }
-        
-        result = collection.insert_one(chat_data)
-        print(f"Chat history saved with ID: {result.inserted_id}")
+        chat_data = build_archive(chat_session, chat_session.iter_turns(), datetime.datetime.now())
+        archive_queue.enqueue(chat_data)
+        print(f"Chat history queued with ID: {chat_data['_id']}")
         return True
         
     except Exception as e:
         print(f"Error saving chat history: {e}")
         return False
 
+def archive_sessions(sessions):
+    """Archive many sessions with one turn query and one insert_many"""
+    turns = {chat_session.pk: [] for chat_session in sessions}
+    for turn in ChatTurn.objects.filter(session__in=list(turns)).order_by("session", "sequence").iterator():
+        turns[turn.session_id].append(turn.as_message())
+    documents = [
+        build_archive(chat_session, turns[chat_session.pk], chat_session.updated_at)
+        for chat_session in sessions
+    ]
+    if documents:
+        try:
+            get_collection().insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Another sweep archived some of these first; the rest went in
+            if not only_duplicates(e):
+                raise
+
+def start_background_workers():
+    """Start the expiry sweeper and the archive writer of this process if not running yet"""
+    sweeper.ensure_started()
+    archive_queue.ensure_started()
+
 def check_session_timeout(chat_session):
+    """Cheap expiry check for the request path; the sweeper archives and deletes the session"""
     if chat_session.is_session_expired():
-        save_chat_history(chat_session.session_id, chat_session, "Session timeout")
-        chat_session.delete()
+        sweeper.wake()
         return True
     return False
+
+
+class ExpirySweeper:
+    """Archives and deletes expired sessions in the background.
+
+    Every ``interval`` seconds, or sooner when a request runs into an
+    expired session, expired rows are selected through the updated_at index
+    in batches of ``batch_size``, archived to Mongo with one insert_many per
+    batch and deleted in bulk. A batch that fails to archive is left in place
+    and retried on the next sweep. Sweeps within a process never overlap.
+    Sweeps of several worker processes (or the sweep_sessions command) may
+    pick the same sessions: archives have a deterministic _id, so a session
+    archived twice is stored once.
+    """
+
+    def __init__(self, interval=60, batch_size=500):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._sweeping = threading.Lock()
+        self._pid = None
+
+    def sweep(self):
+        """Archive and delete every session expired right now; returns how many"""
+        with self._sweeping:
+            return self._sweep(timezone.now())
+
+    def _sweep(self, cutoff):
+        swept = 0
+        last_pk = 0
+        while True:
+            sessions = list(
+                ChatSession.expired(cutoff)
+                .filter(pk__gt=last_pk)
+                .order_by("pk")[:self.batch_size]
+            )
+            if not sessions:
+                return swept
+            last_pk = sessions[-1].pk
+            try:
+                archive_sessions(sessions)
+            except Exception as e:
+                print(f"[ERROR] Archiving {len(sessions)} expired sessions failed: {e}")
+                continue
+            # Sessions touched since they were read are live again; keep them
+            ChatSession.expired(cutoff).filter(pk__in=[chat_session.pk for chat_session in sessions]).delete()
+            swept += len(sessions)
+
+    def wake(self):
+        """Sweep now instead of waiting for the next interval"""
+        self._wakeup.set()
+
+    def ensure_started(self):
+        """Start the sweeper thread once per process (threads do not survive a fork)"""
+        pid = os.getpid()
+        if self.interval <= 0 or self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            threading.Thread(target=self._run, name="session-expiry-sweeper", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                swept = self.sweep()
+                if swept:
+                    print(f"[INFO] Archived {swept} expired sessions")
+            except Exception as e:
+                print(f"[ERROR] Session sweep failed: {e}")
+            finally:
+                close_old_connections()
+
+
+sweeper = ExpirySweeper(
+    interval=getattr(settings, "CHAT_SESSION_SWEEP_INTERVAL", 60),
+    batch_size=getattr(settings, "CHAT_SESSION_SWEEP_BATCH_SIZE", 500),
+)
+
+
+class ArchiveQueue:
+    """Write-behind buffer between finished conversations and Mongo.
+
+    save_chat_history() only enqueues the transcript. A background worker
+    drains the bounded queue into insert_many batches and retries failures
+    with exponential backoff. A batch that still fails, or a transcript that
+    finds the queue full, is appended to an on-disk journal, which is
+    replayed when the worker starts and whenever Mongo accepts a batch
+    again. Every document gets its _id up front so a retried batch is not
+    stored twice.
+    """
+
+    def __init__(self, journal, max_size=1000, batch_size=100, retries=5, backoff=0.5, max_backoff=8.0):
+        self.journal = str(journal)
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._queue = queue.Queue(maxsize=max_size)
+        self._journal_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._pid = None
+        atexit.register(self.close)
+
+    def enqueue(self, document):
+        """Hand a transcript to the worker without waiting for Mongo"""
+        document.setdefault("_id", ObjectId())
+        self.ensure_started()
+        try:
+            self._queue.put_nowait(document)
+        except queue.Full:
+            self.spill([document])
+
+    def ensure_started(self):
+        """Start the worker once per process (threads do not survive a fork)"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            threading.Thread(target=self._run, name="chat-archive-writer", daemon=True).start()
+
+    def _run(self):
+        self.replay()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=0.05))
+                except queue.Empty:
+                    break
+            if self._insert(batch):
+                self.replay()
+            else:
+                self.spill(batch)
+
+    def _insert(self, documents):
+        """insert_many with retries; True once Mongo holds every document"""
+        delay = self.backoff
+        for attempt in range(1, self.retries + 1):
+            try:
+                get_collection().insert_many(documents, ordered=False)
+                return True
+            except BulkWriteError as e:
+                # Duplicate _ids were stored by an earlier attempt
+                if only_duplicates(e):
+                    return True
+                error = e
+            except Exception as e:
+                error = e
+            print(f"[WARN] Archiving {len(documents)} transcripts failed "
+                  f"(attempt {attempt}/{self.retries}): {error}")
+            if attempt < self.retries:
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, self.max_backoff)
+        return False
+
+    def spill(self, documents):
+        """Append transcripts to the journal for a later replay"""
+        with self._journal_lock:
+            with open(self.journal, "a", encoding="utf-8") as f:
+                for document in documents:
+                    f.write(json_util.dumps(document) + "\n")
+        print(f"[WARN] {len(documents)} transcripts written to {self.journal}")
+
+    def replay(self):
+        """Send the journaled transcripts to Mongo; returns how many were stored"""
+        with self._journal_lock:
+            if not os.path.exists(self.journal) or os.path.getsize(self.journal) == 0:
+                return 0
+            replaying = f"{self.journal}.{os.getpid()}.replay"
+            os.replace(self.journal, replaying)
+        with open(replaying, encoding="utf-8") as f:
+            documents = [json_util.loads(line) for line in f if line.strip()]
+        replayed = 0
+        for start in range(0, len(documents), self.batch_size):
+            batch = documents[start:start + self.batch_size]
+            if not self._insert(batch):
+                self.spill(documents[start:])
+                break
+            replayed += len(batch)
+        os.remove(replaying)
+        if replayed:
+            print(f"[INFO] Replayed {replayed} journaled transcripts")
+        return replayed
+
+    def close(self):
+        """Journal whatever is still queued so it survives the process"""
+        pending = []
+        while True:
+            try:
+                pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if pending:
+            self.spill(pending)
+
+
+archive_queue = ArchiveQueue(
+    journal=getattr(settings, "CHAT_ARCHIVE_JOURNAL", "logs/archive_journal.jsonl"),
+    max_size=getattr(settings, "CHAT_ARCHIVE_QUEUE_SIZE", 1000),
+    batch_size=getattr(settings, "CHAT_ARCHIVE_BATCH_SIZE", 100),
+)
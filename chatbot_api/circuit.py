@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+from django.conf import settings
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+    def __init__(self, upstream, retry_in):
+        super().__init__(f"Circuit for {upstream} is open, retry in {retry_in:.1f}s")
+        self.upstream = upstream
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over the recent calls to one upstream.
+
+    Calls are counted in one-second buckets over the last ``window`` seconds.
+    Once at least ``min_calls`` were made, the circuit opens when the share of
+    failed calls (errors and 5xx replies) reaches ``failure_rate``, or the share
+    of calls slower than ``slow_call_seconds`` reaches ``slow_call_rate``.
+    While open, calls fail at once with CircuitOpenError. After
+    ``open_seconds`` a single probe call is let through (half-open): the
+    circuit closes if it succeeds in time and opens again otherwise.
+    ``clock`` returns the current time in seconds (time.monotonic by default).
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, window=30, min_calls=10, failure_rate=0.5,
+                 slow_call_seconds=5.0, slow_call_rate=0.8, open_seconds=15, clock=time.monotonic):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.times_opened = 0
+        self.rejected = 0
+        self.last_failure = None
+        self._probing = False
+        self._buckets = deque()  # [second, calls, failures, slow, total_seconds, max_seconds]
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Let a call through, or raise CircuitOpenError; returns True for a half-open probe"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            retry_in = self.opened_at + self.open_seconds - self.clock()
+            if self.state == self.OPEN and retry_in <= 0:
+                self.state = self.HALF_OPEN
+                print(f"[INFO] Circuit for {self.name} half-open, probing")
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            raise CircuitOpenError(self.name, max(retry_in, 0.0))
+
+    def record(self, seconds, failed, probe=False, error=None):
+        """Count a finished call and open or close the circuit accordingly"""
+        slow = seconds >= self.slow_call_seconds
+        now = self.clock()
+        with self._lock:
+            self._count(int(now), seconds, failed, slow)
+            if failed:
+                self.last_failure = error
+            if probe:
+                self._probing = False
+                if failed or slow:
+                    self._open(now, "probe failed")
+                else:
+                    self.state = self.CLOSED
+                    self._buckets.clear()
+                    print(f"[INFO] Circuit for {self.name} closed")
+                return
+            if self.state != self.CLOSED:
+                return
+            calls, failures, slow_calls = self._totals(now)
+            if calls < self.min_calls:
+                return
+            if failures / calls >= self.failure_rate:
+                self._open(now, f"{failures}/{calls} calls failed")
+            elif slow_calls / calls >= self.slow_call_rate:
+                self._open(now, f"{slow_calls}/{calls} calls slower than {self.slow_call_seconds}s")
+
+    def _count(self, second, seconds, failed, slow):
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append([second, 0, 0, 0, 0.0, 0.0])
+        bucket = self._buckets[-1]
+        bucket[1] += 1
+        bucket[2] += failed
+        bucket[3] += slow
+        bucket[4] += seconds
+        bucket[5] = max(bucket[5], seconds)
+
+    def _totals(self, now):
+        """Calls, failures and slow calls in the window; drops older buckets (caller holds the lock)"""
+        oldest = int(now) - self.window
+        while self._buckets and self._buckets[0][0] <= oldest:
+            self._buckets.popleft()
+        return tuple(sum(bucket[i] for bucket in self._buckets) for i in (1, 2, 3))
+
+    def _open(self, now, reason):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.times_opened += 1
+        print(f"[WARN] Circuit for {self.name} opened for {self.open_seconds}s: {reason}")
+
+    def stats(self):
+        with self._lock:
+            calls, failures, slow_calls = self._totals(self.clock())
+            total_seconds = sum(bucket[4] for bucket in self._buckets)
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = round(max(self.opened_at + self.open_seconds - self.clock(), 0.0), 1)
+            return {
+                "state": self.state,
+                "retry_in_seconds": retry_in,
+                "window_seconds": self.window,
+                "calls": calls,
+                "failure_rate": round(failures / calls, 4) if calls else 0.0,
+                "slow_call_rate": round(slow_calls / calls, 4) if calls else 0.0,
+                "mean_latency_ms": round(total_seconds / calls * 1000, 2) if calls else 0.0,
+                "max_latency_ms": round(max((bucket[5] for bucket in self._buckets), default=0.0) * 1000, 2),
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+                "last_failure": self.last_failure,
+            }
+
+
+# One breaker per upstream host, shared by the sync session and the async clients
+circuit_breakers = {}
+_lock = threading.Lock()
+
+
+def circuit_for(url):
+    """The breaker of the host a URL points at"""
+    name = urlsplit(str(url)).netloc
+    breaker = circuit_breakers.get(name)
+    if breaker is None:
+        with _lock:
+            breaker = circuit_breakers.get(name)
+            if breaker is None:
+                breaker = circuit_breakers[name] = CircuitBreaker(
+                    name,
+                    window=settings.CIRCUIT_WINDOW_SECONDS,
+                    min_calls=settings.CIRCUIT_MIN_CALLS,
+                    failure_rate=settings.CIRCUIT_FAILURE_RATE,
+                    slow_call_seconds=settings.CIRCUIT_SLOW_CALL_SECONDS,
+                    slow_call_rate=settings.CIRCUIT_SLOW_CALL_RATE,
+                    open_seconds=settings.CIRCUIT_OPEN_SECONDS,
+                )
+    return breaker
+
+
+def circuit_stats():
+    return {name: breaker.stats() for name, breaker in list(circuit_breakers.items())}
@@ -0,0 +1,658 @@
+import datetime
+import joblib
+import json
+import os
+import queue
+import threading
+import time
+from django.conf import settings
+from .features import CompactVectorizer
+from .forest import CompiledForest, verification_corpus
+from .intent_cache import PredictionCache
+from .keywords import KeywordMatcher
+from .shadow import ShadowEvaluator
+
+MODEL_PATH = os.path.join("models", "best_rf_classifier_model_V_5.joblib")
+VECTORIZER_PATH = os.path.join("models", "tfidf_vectorizer_V_5.joblib")
+
+# Output columns of the multi-label intent model, in order
+INTENT_LABELS = (
+    'greetings',
+    'Fault Reporting',
+    'Bill Inquiries',
+    'New Connection Requests',
+    'Incident Reports',
+    'Solar Services'
+)
+
+def compiled_model_dir(model_path):
+    """Where the compiled forest arrays of a model are kept, memory-mapped by every worker"""
+    return os.path.splitext(model_path)[0] + ".compiled"
+
+def load_intent_model(model_path=MODEL_PATH):
+    return joblib.load(model_path)
+
+def load_vectorizer(vectorizer_path=VECTORIZER_PATH):
+    # Arrays stored uncompressed in the pickle are memory-mapped, not copied
+    return joblib.load(vectorizer_path, mmap_mode="r")
+
+def compact_vectorizer_dir(vectorizer_path):
+    """Where the compact form of a vectorizer is kept, memory-mapped by every worker"""
+    return os.path.splitext(vectorizer_path)[0] + ".compact"
+
+def compact_vectorizer(vectorizer):
+    """Reduce the vectorizer to arrays, or None if it cannot be or its output differs"""
+    try:
+        compact = CompactVectorizer.from_tfidf(vectorizer)
+    except (AttributeError, ValueError) as e:
+        print(f"[WARN] Cannot compact the intent vectorizer ({e}); using sklearn")
+        return None
+    corpus = verification_corpus(vectorizer)
+    if (vectorizer.transform(corpus) != compact.transform(corpus)).nnz:
+        print("[WARN] Compact intent vectorizer output differs from sklearn; using sklearn")
+        return None
+    return compact
+
+def load_featurizer(vectorizer_path=VECTORIZER_PATH):
+    """Open the compact vectorizer memory-mapped, building it first if missing or stale.
+
+    The sklearn vectorizer is only unpickled to (re)build it, or when the
+    compact form is disabled or cannot reproduce its output.
+    """
+    if not getattr(settings, "INTENT_VECTORIZER_COMPACT", True):
+        return load_vectorizer(vectorizer_path)
+    source = model_version(vectorizer_path)
+    compact_dir = compact_vectorizer_dir(vectorizer_path)
+    compact = CompactVectorizer.load(compact_dir, source=source)
+    if compact is None:
+        vectorizer = load_vectorizer(vectorizer_path)
+        compact = compact_vectorizer(vectorizer)
+        if compact is None:
+            return vectorizer
+        compact.save(compact_dir, source=source)
+        compact = CompactVectorizer.load(compact_dir, source=source) or compact
+    print(f"[INFO] Intent vectorizer: {compact.n_features} features, "
+          f"{compact.nbytes // 1024} KiB mapped from {compact_dir}")
+    return compact
+
+def model_version(path):
+    """Identify a model file by name and modification time"""
+    return f"{os.path.basename(path)}@{os.stat(path).st_mtime_ns}"
+
+def compile_intent_model(forest, vectorizer):
+    """Flatten the forest into arrays, or None if they disagree with sklearn on a check corpus"""
+    compiled = CompiledForest.from_sklearn(forest)
+    check = vectorizer.transform(verification_corpus(vectorizer))
+    mismatched = compiled.mismatches(forest, check)
+    if mismatched:
+        print(f"[WARN] Compiled intent model disagrees with sklearn on {mismatched} "
+              f"of {check.shape[0]} messages; using sklearn")
+        return None
+    return compiled
+
+def load_model(model_path, vectorizer_path, version):
+    """Open the compiled intent model memory-mapped, compiling it first if missing or stale.
+
+    The sklearn forest is only unpickled to (re)compile, or when compilation
+    is disabled or fails verification.
+    """
+    if not getattr(settings, "INTENT_MODEL_COMPILED", True):
+        return load_intent_model(model_path)
+    compiled_dir = compiled_model_dir(model_path)
+    compiled = CompiledForest.load(compiled_dir, source=version)
+    if compiled is None:
+        forest = load_intent_model(model_path)
+        compiled = compile_intent_model(forest, load_vectorizer(vectorizer_path))
+        if compiled is None:
+            return forest
+        compiled.save(compiled_dir, source=version)
+        compiled = CompiledForest.load(compiled_dir, source=version) or compiled
+    print(f"[INFO] Intent model: {len(compiled.roots)} compiled trees, {len(compiled.feature)} nodes, "
+          f"{compiled.nbytes // 1024} KiB mapped from {compiled_dir}")
+    return compiled
+
+
+class _PendingPrediction:
+    __slots__ = ("text", "done", "result", "error")
+
+    def __init__(self, text):
+        self.text = text
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class InferenceBatcher:
+    """Runs ``predict_rows`` on micro-batches of messages from all request threads.
+
+    sklearn's transform/predict cost mostly the same for one row as for
+    dozens, so a worker thread collects the messages submitted within
+    ``window`` seconds (or until ``max_batch`` are waiting), classifies them
+    with one transform and one predict, and wakes each caller with its row.
+    A caller waits at most ``window`` longer than a direct predict would take.
+    """
+
+    def __init__(self, predict_rows, window=0.002, max_batch=32, timeout=10.0):
+        self.predict_rows = predict_rows
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.batches = 0
+        self.messages = 0
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def predict(self, text):
+        """Return the label indicator row for one message"""
+        pending = _PendingPrediction(text)
+        with self._lock:
+            # Queued under the lock, so nothing lands behind close()'s sentinel
+            self._ensure_started().put(pending)
+        if not pending.done.wait(self.timeout):
+            raise TimeoutError("Intent classification timed out")
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _ensure_started(self):
+        """Start the worker once per process (threads do not survive a fork); needs the lock"""
+        pid = os.getpid()
+        if self._pid != pid:
+            self._queue = queue.Queue()
+            self._pid = pid
+            threading.Thread(target=self._run, args=(self._queue,),
+                             name="intent-batcher", daemon=True).start()
+        return self._queue
+
+    def close(self):
+        """Stop the worker; messages it has not picked up yet fail instead of waiting out the timeout"""
+        with self._lock:
+            if self._pid == os.getpid():
+                error = RuntimeError("Intent batcher closed")
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        item.error = error
+                        item.done.set()
+                self._queue.put(None)
+            self._pid = None
+            self._queue = None
+
+    def _run(self, pending_queue):
+        while True:
+            first = pending_queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    item = (pending_queue.get(timeout=remaining) if remaining > 0
+                            else pending_queue.get_nowait())
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._classify(batch)
+                    return
+                batch.append(item)
+            self._classify(batch)
+
+    def _classify(self, batch):
+        try:
+            for item, row in zip(batch, self.predict_rows([item.text for item in batch])):
+                item.result = row
+        except Exception as e:
+            for item in batch:
+                item.error = e
+        finally:
+            self.batches += 1
+            self.messages += len(batch)
+            for item in batch:
+                item.done.set()
+
+    def stats(self):
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "messages": self.messages,
+            "mean_batch_size": round(self.messages / self.batches, 2) if self.batches else 0.0,
+        }
+
+
+class IntentClassifier:
+    """The one way to classify a message: vectorizer, model, labels and version together.
+
+    classify() tries the keyword fast path, then the prediction cache, then
+    the micro-batched model, and returns the predicted labels (possibly
+    none) without raising for ordinary text. classify_many() does the same
+    for a list, running the model once over all cache misses.
+    """
+
+    WARMUP_MESSAGES = ("hello", "my bill", "power cut", "solar panel", "new connection")
+
+    def __init__(self, vectorizer, model, labels=INTENT_LABELS, version="", keywords=None,
+                 cache_size=4096, batch_window=0.002, batch_size=32):
+        self.vectorizer = vectorizer
+        self.model = model
+        self.labels = tuple(labels)
+        self.version = version
+        self.keywords = keywords
+        self.cache = PredictionCache(max_size=cache_size)
+        self.batcher = InferenceBatcher(self.predict_rows, window=batch_window, max_batch=batch_size)
+
+    @classmethod
+    def load(cls, model_path=MODEL_PATH, vectorizer_path=VECTORIZER_PATH, labels=INTENT_LABELS,
+             version=None, **options):
+        """Load a model and its vectorizer from disk, named ``version`` or after the model file"""
+        source = model_version(model_path)
+        vectorizer = load_featurizer(vectorizer_path)
+        model = load_model(model_path, vectorizer_path, source)
+        return cls(vectorizer, model, labels=labels, version=version or source, **options)
+
+    def predict_rows(self, texts):
+        """Label indicator rows for a list of messages, straight from the model"""
+        rows = self.model.predict(self.vectorizer.transform(list(texts)))
+        return [tuple(int(value) for value in row) for row in rows]
+
+    def labels_for(self, row):
+        return [label for label, value in zip(self.labels, row) if value == 1]
+
+    def _fast_path(self, text):
+        """Labels from a keyword match or the cache, or None if the model has to run"""
+        if self.keywords is not None:
+            category = self.keywords.classify(text)
+            if category in self.labels:
+                return [category]
+        cached = self.cache.get(text, self.version)
+        return list(cached) if cached is not None else None
+
+    def classify(self, text):
+        """Predicted labels of one message, in label order"""
+        labels = self._fast_path(text)
+        if labels is None:
+            labels = self.labels_for(self.batcher.predict(text))
+            self.cache.put(text, self.version, tuple(labels))
+        return labels
+
+    def classify_many(self, texts):
+        """Predicted labels of each message, with one model pass over the cache misses"""
+        results = [self._fast_path(text) for text in texts]
+        misses = [i for i, labels in enumerate(results) if labels is None]
+        if misses:
+            for i, row in zip(misses, self.predict_rows([texts[i] for i in misses])):
+                results[i] = self.labels_for(row)
+                self.cache.put(texts[i], self.version, tuple(results[i]))
+        return results
+
+    def warmup(self):
+        """Run a few predictions so first requests do not pay for lazy initialization"""
+        self.predict_rows(self.WARMUP_MESSAGES)
+
+    def smoke_test(self, examples):
+        """Share of (text, label) examples the model gets right; raises if its output is malformed"""
+        if not examples:
+            return 1.0
+        rows = self.predict_rows([text for text, _ in examples])
+        correct = 0
+        for row, (_, label) in zip(rows, examples):
+            if len(row) != len(self.labels):
+                raise ValueError(f"Model predicts {len(row)} labels, expected {len(self.labels)}")
+            correct += label in self.labels_for(row)
+        return correct / len(examples)
+
+    def close(self):
+        self.batcher.close()
+
+    def stats(self):
+        return {
+            "intent_model": {
+                "version": self.version,
+                "labels": list(self.labels),
+                "compiled": isinstance(self.model, CompiledForest),
+            },
+            "keyword_fast_path": self.keywords.stats() if self.keywords is not None else None,
+            "intent_cache": self.cache.stats(),
+            "intent_batching": self.batcher.stats(),
+        }
+
+
+def load_smoke_set(path):
+    """(text, label) examples a model must mostly get right before it serves requests"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [(example["text"], example["label"]) for example in json.load(f)]
+    except FileNotFoundError:
+        print(f"[WARN] No intent smoke set at {path}; models are only checked for well-formed output")
+        return []
+
+
+class ModelRegistry:
+    """Versioned intent models in a directory, and the classifier serving requests.
+
+    The registry directory holds one folder per version and a manifest::
+
+        {"active": "v6", "previous": "v5",
+         "versions": {"v6": {"model": "v6/model.joblib",
+                             "vectorizer": "v6/vectorizer.joblib",
+                             "labels": [...]}, ...}}
+
+    ``active`` is the live IntentClassifier; requests read it once per
+    classification, so swapping it is a single assignment and never blocks
+    them. A new version is loaded and smoke tested off the request path and
+    only then swapped in; the outgoing classifier is kept as ``previous`` so
+    rollback() is instant; one dropped from ``previous`` is only closed on
+    the swap after that, when requests that read it are done. activate()
+    and rollback() rewrite the manifest, and a watcher thread in every
+    worker process follows manifest changes.
+    Without a manifest the model at MODEL_PATH is served as before.
+
+    A version named by the manifest's "shadow" key runs as a candidate next
+    to the live model on the messages classify() sees (see ShadowEvaluator);
+    activating it promotes the already loaded candidate.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path, smoke_set=(), min_accuracy=0.8, poll_interval=5.0, shadow=None, **options):
+        self.path = path
+        self.smoke_set = list(smoke_set)
+        self.min_accuracy = min_accuracy
+        self.poll_interval = poll_interval
+        self.options = options
+        self.active = None
+        self.previous = None
+        self.shadow = shadow or ShadowEvaluator()
+        self._retired = []  # dropped classifiers, closed on the next swap
+        self.swaps = 0
+        self.rejected = 0
+        self.last_error = None
+        self._manifest_mtime = None
+        self._lock = threading.Lock()  # one load or swap at a time
+        self._pid = None
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, self.MANIFEST)
+
+    def read_manifest(self):
+        """The manifest, or None when the registry has none"""
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write_manifest(self, manifest):
+        staging = f"{self.manifest_path}.tmp-{os.getpid()}"
+        with open(staging, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(staging, self.manifest_path)
+        self._manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+
+    def publish(self, version, vectorizer, model, labels=INTENT_LABELS, metrics=None, activate=False):
+        """Add a trained vectorizer and model to the registry as a new version.
+
+        With ``activate`` it also becomes the manifest's active version,
+        which the watcher of every worker then loads, checks and swaps in.
+        """
+        version_dir = os.path.join(self.path, version)
+        if os.path.exists(version_dir):
+            raise ValueError(f"Model version {version} already exists")
+        os.makedirs(version_dir)
+        # Uncompressed, so the arrays in them can be memory-mapped
+        joblib.dump(model, os.path.join(version_dir, "model.joblib"))
+        joblib.dump(vectorizer, os.path.join(version_dir, "vectorizer.joblib"))
+        if metrics is not None:
+            with open(os.path.join(version_dir, "metrics.json"), "w", encoding="utf-8") as f:
+                json.dump(metrics, f, indent=2)
+        with self._lock:
+            manifest = self.read_manifest() or {"active": None, "previous": None, "versions": {}}
+            manifest["versions"][version] = {
+                "model": f"{version}/model.joblib",
+                "vectorizer": f"{version}/vectorizer.joblib",
+                "labels": list(labels),
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            }
+            if activate:
+                manifest["previous"], manifest["active"] = manifest.get("active"), version
+            self.write_manifest(manifest)
+        return version_dir
+
+    def load_version(self, version, manifest):
+        """Load and smoke test one version of the manifest; raises ValueError if it fails"""
+        entry = manifest.get("versions", {}).get(version)
+        if entry is None:
+            raise ValueError(f"Unknown model version: {version}")
+        classifier = IntentClassifier.load(
+            os.path.join(self.path, entry["model"]),
+            os.path.join(self.path, entry["vectorizer"]),
+            labels=entry.get("labels", INTENT_LABELS),
+            version=version,
+            **self.options,
+        )
+        accuracy = classifier.smoke_test(self.smoke_set)
+        if accuracy < self.min_accuracy:
+            classifier.close()
+            raise ValueError(f"Model {version} scored {accuracy:.2f} on the smoke set, "
+                             f"below {self.min_accuracy:.2f}")
+        classifier.warmup()
+        print(f"[INFO] Intent model {version} loaded (smoke accuracy {accuracy:.2f})")
+        return classifier
+
+    def load(self):
+        """Serve the manifest's active version, else its previous one, else MODEL_PATH"""
+        manifest = None
+        try:
+            manifest = self.read_manifest()
+        except (OSError, ValueError) as e:
+            print(f"[ERROR] Unreadable model manifest {self.manifest_path}: {e}")
+        if manifest is not None:
+            self._manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+            for version in (manifest.get("active"), manifest.get("previous")):
+                if not version:
+                    continue
+                try:
+                    self.active = self.load_version(version, manifest)
+                    break
+                except Exception as e:
+                    self.last_error = str(e)
+                    print(f"[ERROR] Could not serve intent model {version}: {e}")
+        if self.active is None:
+            self.active = IntentClassifier.load(**self.options)
+            self.active.warmup()
+        if manifest is not None:
+            try:
+                self._follow_shadow(manifest)
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"[ERROR] Could not shadow intent model {manifest.get('shadow')}: {e}")
+        return self.active
+
+    def classify(self, text):
+        """Labels of a message from the live model, shadowed by the candidate if there is one"""
+        classifier = self.active
+        labels = classifier.classify(text)
+        self.shadow.submit(text, classifier)
+        return labels
+
+    def _retire(self, classifier):
+        """Close a classifier the registry dropped, once requests that read it are done.
+
+        A request reads ``active`` once and may still be classifying with it
+        after later swaps, so it is closed on the next swap instead of now.
+        """
+        if classifier is not None and classifier not in (self.active, self.previous, self.shadow.candidate):
+            self._retired.append(classifier)
+
+    def _swap(self, classifier):
+        """Make ``classifier`` live and keep the outgoing one for rollback"""
+        retired, self._retired = self._retired, []
+        for old in retired:
+            if old is not classifier and old is not self.active:
+                old.close()
+        dropped = self.previous if self.previous is not classifier else None
+        self.previous, self.active = self.active, classifier
+        self._retire(dropped)
+        self.swaps += 1
+        print(f"[INFO] Intent model {classifier.version} is live"
+              + (f" (previous {self.previous.version})" if self.previous else ""))
+
+    def _switch(self, version, manifest):
+        if version == self.active.version:
+            return
+        if self.previous is not None and version == self.previous.version:
+            self._swap(self.previous)
+        elif self.shadow.candidate is not None and version == self.shadow.candidate.version:
+            self._swap(self.shadow.stop())
+        else:
+            self._swap(self.load_version(version, manifest))
+
+    def _follow_shadow(self, manifest):
+        """Shadow the manifest's "shadow" version, or stop shadowing if it names none"""
+        version = manifest.get("shadow")
+        current = self.shadow.candidate
+        if version == (current.version if current is not None else None):
+            return
+        if current is not None and current is not self.active:
+            self._retire(self.shadow.stop())
+        if version and version != self.active.version:
+            self.shadow.start(self.load_version(version, manifest))
+            print(f"[INFO] Shadowing intent model {version} against {self.active.version}")
+
+    def activate(self, version):
+        """Load, check and swap in a version, and make it the manifest's active one"""
+        with self._lock:
+            manifest = self.read_manifest()
+            if manifest is None:
+                raise ValueError(f"No model manifest in {self.path}")
+            outgoing = self.active.version
+            self._switch(version, manifest)
+            if manifest.get("active") != version:
+                manifest["previous"], manifest["active"] = outgoing, version
+            if manifest.get("shadow") == version:
+                manifest["shadow"] = None
+            self.write_manifest(manifest)
+
+    def start_shadow(self, version):
+        """Run a version as the shadow candidate and record it in the manifest"""
+        with self._lock:
+            manifest = self.read_manifest()
+            if manifest is None:
+                raise ValueError(f"No model manifest in {self.path}")
+            if version == self.active.version:
+                raise ValueError(f"Model {version} is already live")
+            manifest["shadow"] = version
+            self._follow_shadow(manifest)
+            self.write_manifest(manifest)
+
+    def stop_shadow(self):
+        with self._lock:
+            manifest = self.read_manifest() or {}
+            manifest["shadow"] = None
+            self._follow_shadow(manifest)
+            if os.path.exists(self.manifest_path):
+                self.write_manifest(manifest)
+
+    def rollback(self):
+        """Swap the previous version back in"""
+        with self._lock:
+            if self.previous is None:
+                raise ValueError("No previous model to roll back to")
+            self._swap(self.previous)
+            manifest = self.read_manifest()
+            if manifest is not None:
+                manifest["active"], manifest["previous"] = self.active.version, self.previous.version
+                self.write_manifest(manifest)
+
+    def refresh(self):
+        """Follow the manifest if another process changed it; the watcher calls this"""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._manifest_mtime:
+            return
+        with self._lock:
+            manifest = self.read_manifest()
+            self._manifest_mtime = mtime
+            if manifest is None:
+                return
+            version = manifest.get("active")
+            try:
+                if version:
+                    self._switch(version, manifest)
+            except Exception as e:
+                self.rejected += 1
+                self.last_error = str(e)
+                print(f"[ERROR] Kept intent model {self.active.version}; {version} failed to load: {e}")
+            try:
+                self._follow_shadow(manifest)
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"[ERROR] Could not shadow intent model {manifest.get('shadow')}: {e}")
+
+    def ensure_started(self):
+        """Start the manifest watcher once per process (threads do not survive a fork)"""
+        pid = os.getpid()
+        if self.poll_interval <= 0 or self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            threading.Thread(target=self._watch, name="intent-model-watcher", daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"[ERROR] Model registry watcher failed: {e}")
+
+    def stats(self):
+        manifest = None
+        try:
+            manifest = self.read_manifest()
+        except (OSError, ValueError):
+            pass
+        return {
+            **self.active.stats(),
+            "model_registry": {
+                "path": self.path,
+                "active": self.active.version,
+                "previous": self.previous.version if self.previous else None,
+                "available": sorted(manifest.get("versions", {})) if manifest else [],
+                "swaps": self.swaps,
+                "rejected": self.rejected,
+                "last_error": self.last_error,
+            },
+            "intent_shadow": self.shadow.dump(),
+        }
+
+
+model_registry = ModelRegistry(
+    getattr(settings, "INTENT_MODEL_REGISTRY", os.path.join("models", "registry")),
+    smoke_set=load_smoke_set(
+        getattr(settings, "INTENT_SMOKE_SET_FILE", os.path.join("node_data", "intent_smoke.json"))
+    ),
+    min_accuracy=getattr(settings, "INTENT_SMOKE_MIN_ACCURACY", 0.8),
+    poll_interval=getattr(settings, "INTENT_MODEL_POLL_INTERVAL", 5.0),
+    shadow=ShadowEvaluator(
+        max_queue=getattr(settings, "INTENT_SHADOW_QUEUE_SIZE", 256),
+        sample_rate=getattr(settings, "INTENT_SHADOW_SAMPLE_RATE", 1.0),
+    ),
+    keywords=KeywordMatcher.from_file(
+        getattr(settings, "INTENT_KEYWORDS_FILE", os.path.join("node_data", "intent_keywords.json"))
+    ),
+    cache_size=getattr(settings, "INTENT_CACHE_SIZE", 4096),
+    batch_window=getattr(settings, "INTENT_BATCH_WINDOW_MS", 2) / 1000,
+    batch_size=getattr(settings, "INTENT_BATCH_MAX_SIZE", 32),
+)
+model_registry.load()
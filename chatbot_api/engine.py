@@ -0,0 +1,206 @@
+from rest_framework.response import Response
+from rest_framework import status
+from .session_store import session_store, SessionConflict
+from .classifier import model_registry
+from .utils import handle_english_message
+from .chat_history import save_chat_history, check_session_timeout, start_background_workers
+from .tree import conversation_graph
+import datetime
+from node_data.handlers.bill_inquiries import BillInquiriesHandler
+from node_data.handlers.solar_service import SolarServiceHandler
+from node_data.handlers.fault_reporting import FaultReportingHandler
+
+# Root nodes of the compiled conversation graph
+tree_structure = conversation_graph.root
+
+SESSION_EXPIRED = {
+    "message": "Session has expired due to inactivity. Please start a new session.",
+    "type": "timeout"
+}
+
+SESSION_CONFLICT = {
+    "message": "This conversation is being updated by another request. Please send your message again.",
+    "type": "conflict"
+}
+
+# State -> owning handler, resolved once so each turn routes with a single lookup
+STATE_HANDLERS = conversation_graph.dispatch_table({
+    "bill_inquiries": BillInquiriesHandler().handle_bill_inquiry,
+    "solar_service": SolarServiceHandler().handle_solar_service,
+    "fault_reporting": FaultReportingHandler().handle_fault_report,
+})
+
+# State -> owning handler's async prefetch of the upstream calls a turn needs
+STATE_PREFETCHERS = conversation_graph.dispatch_table({
+    "bill_inquiries": BillInquiriesHandler().aprefetch,
+    "solar_service": SolarServiceHandler().aprefetch,
+})
+
+
+def start_workers():
+    """Start the background threads of this process if not running yet"""
+    start_background_workers()
+    model_registry.ensure_started()
+
+
+def run_turn(session_id, user_message):
+    """Check the session out of the session store, run one turn and check it back in.
+
+    The store decides when the change reaches the database.
+    """
+    start_workers()
+    try:
+        with session_store.session(session_id) as (chat_session, created):
+            # Handle session timeout
+            if not created and check_session_timeout(chat_session):
+                return Response(SESSION_EXPIRED, status=status.HTTP_408_REQUEST_TIMEOUT)
+            return advance(chat_session, user_message, created)
+    except SessionConflict:
+        return Response(SESSION_CONFLICT, status=status.HTTP_409_CONFLICT)
+
+
+def advance(chat_session, user_message, created=False):
+    """Advance the conversation of a loaded session by one user message.
+
+    Handlers only change the session in memory; the caller checks it back
+    in to the session store. The turns recorded are tagged with the node
+    the message led to.
+    """
+    response = route(chat_session, user_message, created)
+    chat_session.stamp_turns()
+    return response
+
+
+def route(chat_session, user_message, created):
+    """Run the node or handler owning the session's state"""
+    # Handle new session
+    if created:
+        chat_session.state = "start"
+        return conversation_graph.response(tree_structure["start"])
+
+    # Handler-owned states (bill, solar, fault flows) route with one lookup
+    handler = STATE_HANDLERS.get(chat_session.state)
+    if handler:
+        current_node = conversation_graph.node(chat_session.state, chat_session.selected_language)
+        return handler(chat_session, user_message, current_node)
+
+    current_node = tree_structure.get(chat_session.state)
+    if not current_node:
+        chat_session.state = "start"
+        return conversation_graph.response(tree_structure["start"])
+
+    # Preserve language selection through the entire session
+    if chat_session.state == "start" and user_message in current_node["options"]:
+        next_node_key = current_node["next"][user_message]
+        next_node = tree_structure[next_node_key]
+        chat_session.selected_language = user_message
+        chat_session.state = next_node_key
+        chat_session.add_turn(user_message, next_node["message"])
+        return conversation_graph.response(next_node)
+
+    if current_node["type"] == "menu":
+        if user_message in current_node["options"]:
+            next_node_key = current_node["next"][user_message]
+            next_node = conversation_graph.node(next_node_key, chat_session.selected_language)
+            if not next_node:
+                return Response({
+                    "message": "Please select a valid option",
+                    "type": "menu",
+                    "options": current_node["options"]
+                })
+            chat_session.state = next_node_key
+            chat_session.add_turn(user_message, next_node["message"])
+            return conversation_graph.response(next_node)
+        return Response({
+            "message": "Please select a valid option",
+            "type": "menu",
+            "options": current_node["options"]
+        })
+
+    if current_node["type"] == "message" or current_node["type"] == "classification":
+        chat_session.add_turn(user_message, None)
+        if chat_session.state == "english_start":
+            return handle_english_message(chat_session, user_message, tree_structure)
+        try:
+            labels = model_registry.classify(user_message)
+            intent = labels[0] if labels else "unknown"
+            response_message = f"Identified intent: {intent}"
+            next_node_key = current_node.get("next", {}).get(intent)
+            if next_node_key:
+                chat_session.state = next_node_key
+                next_node_data = conversation_graph.node(next_node_key, chat_session.selected_language)
+                chat_session.set_reply(response_message)
+                return Response({
+                    "message": response_message,
+                    "type": "menu",
+                    "options": next_node_data.get("options", [])
+                })
+        except Exception:
+            return Response({
+                "message": "I couldn't understand. Would you like to:",
+                "type": "menu",
+                "options": ["Try Again", "Main Menu", "Exit"]
+            })
+
+    if current_node["type"] == "end":
+        if save_chat_history(chat_session.session_id, chat_session, user_message):
+            chat_session.delete()
+            return Response({
+                "message": current_node["message"],
+                "type": "end"
+            })
+        else:
+            return Response({
+                "message": "Error saving chat history. Please try again.",
+                "type": "error"
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if chat_session.state == "english_menu" and current_node["type"] == "message":
+        return handle_english_message(chat_session, user_message, tree_structure)
+
+    return Response({"message": "Something went wrong"}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def run_batch(turns):
+    """Run many (session_id, message) turns with one session checkout and one check-in.
+
+    Turns of the same session are applied in the order given. Returns the
+    responses in input order.
+    """
+    start_workers()
+    session_ids = list(dict.fromkeys(session_id for session_id, _ in turns))
+    try:
+        sessions, created = session_store.checkout_many(session_ids)
+    except SessionConflict:
+        return [Response(SESSION_CONFLICT, status=status.HTTP_409_CONFLICT) for _ in turns]
+    try:
+        expired = set()
+        for session_id, chat_session in sessions.items():
+            if session_id not in created and check_session_timeout(chat_session):
+                expired.add(session_id)
+
+        responses = []
+        for session_id, user_message in turns:
+            if session_id in expired:
+                responses.append(Response(SESSION_EXPIRED, status=status.HTTP_408_REQUEST_TIMEOUT))
+                continue
+            chat_session = sessions[session_id]
+            if chat_session.pk is None:
+                # Archived by an exit turn; like the single-turn endpoint,
+                # the next message starts a new session
+                chat_session = sessions[session_id] = session_store.restart(chat_session)
+                created.add(session_id)
+            is_new = session_id in created
+            created.discard(session_id)
+            responses.append(advance(chat_session, user_message, is_new))
+    except BaseException:
+        session_store.checkin_many(sessions.values(), commit=False)
+        raise
+    try:
+        session_store.checkin_many(sessions.values())
+    except SessionConflict as e:
+        # The other sessions were stored; only the turns of these were dropped
+        conflicts = set(e.session_ids)
+        responses = [Response(SESSION_CONFLICT, status=status.HTTP_409_CONFLICT) if session_id in conflicts
+                     else response for (session_id, _), response in zip(turns, responses)]
+    return responses
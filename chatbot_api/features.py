@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import numpy as np
+from scipy import sparse
+
+
+def term_hash(term):
+    """Stable 64-bit hash of a term, the same in every process"""
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class CompactVectorizer:
+    """A fitted sklearn TfidfVectorizer reduced to three NumPy arrays.
+
+    The vocabulary is frozen into ``keys``, the sorted 64-bit hashes of its
+    terms (checked to be collision-free when built), with ``columns``
+    giving each key's feature column and ``idf`` the stored IDF weights.
+    transform() hashes each token and finds it with one searchsorted over
+    all tokens of all messages, so no vocabulary dict or per-term Python
+    object is kept; the arrays can be memory-mapped and shared by workers.
+
+    It produces the same matrix as the source vectorizer, so models trained
+    on that vectorizer need no retraining. Only word analyzers with the
+    built-in preprocessing (optionally with n-grams and stop words) can be
+    reduced; from_tfidf() raises ValueError for anything else.
+    """
+
+    ARRAYS = ("keys", "columns", "idf")
+
+    def __init__(self, keys, columns, idf, token_pattern=r"(?u)\b\w\w+\b", lowercase=True,
+                 ngram_range=(1, 1), stop_words=(), norm="l2", sublinear_tf=False):
+        self.keys = keys
+        self.columns = columns
+        self.idf = idf
+        self.token_pattern = token_pattern
+        self.lowercase = lowercase
+        self.ngram_range = tuple(ngram_range)
+        self.stop_words = frozenset(stop_words)
+        self.norm = norm
+        self.sublinear_tf = sublinear_tf
+        self._token_re = re.compile(token_pattern)
+
+    @classmethod
+    def from_tfidf(cls, vectorizer):
+        """Reduce a fitted TfidfVectorizer"""
+        if (vectorizer.analyzer != "word" or vectorizer.tokenizer is not None
+                or vectorizer.preprocessor is not None or vectorizer.strip_accents is not None
+                or vectorizer.binary or not vectorizer.use_idf or vectorizer.norm not in ("l1", "l2", None)):
+            raise ValueError("Only word-level TF-IDF with the built-in preprocessing can be compacted")
+        stop_words = vectorizer.get_stop_words() or ()
+        terms = list(vectorizer.vocabulary_)
+        hashes = np.array([term_hash(term) for term in terms], dtype=np.uint64)
+        if len(np.unique(hashes)) != len(hashes):
+            raise ValueError("Vocabulary terms collide under the 64-bit term hash")
+        order = np.argsort(hashes)
+        return cls(
+            keys=hashes[order],
+            columns=np.array([vectorizer.vocabulary_[term] for term in terms], dtype=np.int32)[order],
+            idf=np.asarray(vectorizer.idf_, dtype=np.float64),
+            token_pattern=vectorizer.token_pattern,
+            lowercase=vectorizer.lowercase,
+            ngram_range=vectorizer.ngram_range,
+            stop_words=stop_words,
+            norm=vectorizer.norm,
+            sublinear_tf=vectorizer.sublinear_tf,
+        )
+
+    @property
+    def n_features(self):
+        return len(self.idf)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def terms(self, text):
+        """The terms of one message, tokenized and n-grammed the way sklearn does"""
+        if self.lowercase:
+            text = text.lower()
+        tokens = [token for token in self._token_re.findall(text) if token not in self.stop_words]
+        low, high = self.ngram_range
+        if (low, high) == (1, 1):
+            return tokens
+        terms = tokens[:] if low == 1 else []
+        for n in range(max(low, 2), high + 1):
+            terms.extend(" ".join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+        return terms
+
+    def transform(self, texts):
+        """TF-IDF rows of the messages as a CSR matrix, equal to the source vectorizer's"""
+        texts = list(texts)
+        rows, hashes = [], []
+        for row, text in enumerate(texts):
+            terms = self.terms(text)
+            rows.extend([row] * len(terms))
+            hashes.extend(term_hash(term) for term in terms)
+        rows = np.array(rows, dtype=np.int64)
+        hashes = np.array(hashes, dtype=np.uint64)
+
+        # Known terms only, counted per (row, column) in sklearn's sorted order
+        position = np.minimum(np.searchsorted(self.keys, hashes), len(self.keys) - 1)
+        known = self.keys[position] == hashes
+        cells, counts = np.unique(rows[known] * self.n_features + self.columns[position[known]],
+                                  return_counts=True)
+        cell_rows, cell_columns = np.divmod(cells, self.n_features)
+
+        values = counts.astype(np.float64)
+        if self.sublinear_tf:
+            values = np.log(values) + 1
+        values *= self.idf[cell_columns]
+        if self.norm is not None:
+            weights = values * values if self.norm == "l2" else np.abs(values)
+            norms = np.bincount(cell_rows, weights=weights, minlength=len(texts))
+            if self.norm == "l2":
+                norms = np.sqrt(norms)
+            norms[norms == 0.0] = 1.0
+            values /= norms[cell_rows]
+        indptr = np.searchsorted(cell_rows, np.arange(len(texts) + 1))
+        return sparse.csr_matrix((values, cell_columns.astype(np.int32), indptr),
+                                 shape=(len(texts), self.n_features))
+
+    def config(self):
+        return {
+            "token_pattern": self.token_pattern,
+            "lowercase": self.lowercase,
+            "ngram_range": list(self.ngram_range),
+            "stop_words": sorted(self.stop_words),
+            "norm": self.norm,
+            "sublinear_tf": self.sublinear_tf,
+        }
+
+    def save(self, path, source=""):
+        """Write the arrays and settings to a directory, replacing it atomically"""
+        staging = f"{path}.tmp-{os.getpid()}"
+        os.makedirs(staging, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(staging, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(staging, "config.json"), "w", encoding="utf-8") as f:
+            json.dump(self.config(), f)
+        with open(os.path.join(staging, "SOURCE"), "w", encoding="utf-8") as f:
+            f.write(source)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(staging, path)
+        except OSError:
+            # Another process published the same arrays first
+            shutil.rmtree(staging, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, source=None, mmap_mode="r"):
+        """Open a saved vectorizer, or None if missing or reduced from a vectorizer other than ``source``"""
+        try:
+            with open(os.path.join(path, "SOURCE"), encoding="utf-8") as f:
+                if source is not None and f.read() != source:
+                    return None
+            with open(os.path.join(path, "config.json"), encoding="utf-8") as f:
+                config = json.load(f)
+            arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                      for name in cls.ARRAYS}
+            return cls(**arrays, **config)
+        except (OSError, ValueError):
+            return None
+
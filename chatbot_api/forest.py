@@ -0,0 +1,189 @@
+import os
+import shutil
+import numpy as np
+from scipy import sparse
+
+LEAF = -1
+
+
+class CompiledForest:
+    """A fitted sklearn RandomForestClassifier flattened into NumPy arrays.
+
+    All trees share one node table: ``feature``, ``threshold`` and the
+    ``left``/``right`` child indices (LEAF for leaves), plus ``leaf_slot``
+    pointing leaves into ``leaf_values`` (n_leaves, n_outputs, n_classes),
+    which holds each leaf's class probabilities normalized the way sklearn's
+    predict_proba normalizes them. Nothing else of the estimators is kept.
+
+    predict() walks every tree for every row at once, one depth level per
+    step, reading feature values straight from the sparse rows, and returns
+    what the forest's own predict() would: one column per output for
+    multi-output forests such as the intent model.
+    """
+
+    ARRAYS = ("feature", "threshold", "left", "right", "leaf_slot", "leaf_values", "roots", "classes")
+
+    def __init__(self, feature, threshold, left, right, leaf_slot, leaf_values, roots, classes):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.leaf_slot = leaf_slot
+        self.leaf_values = leaf_values
+        self.roots = roots
+        self.classes = classes
+        self.n_outputs = leaf_values.shape[1]
+
+    @classmethod
+    def from_sklearn(cls, forest):
+        """Compile a fitted RandomForestClassifier (single- or multi-output)"""
+        n_outputs = forest.n_outputs_
+        if n_outputs == 1:
+            class_lists = [np.asarray(forest.classes_)]
+            n_classes = [int(forest.n_classes_)]
+        else:
+            class_lists = [np.asarray(c) for c in forest.classes_]
+            n_classes = [int(n) for n in forest.n_classes_]
+        max_classes = max(n_classes)
+
+        features, thresholds, lefts, rights, slots, values, roots = [], [], [], [], [], [], []
+        offset = 0
+        leaves = 0
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            is_leaf = tree.children_left == -1
+            roots.append(offset)
+            features.append(np.where(is_leaf, 0, tree.feature))
+            thresholds.append(tree.threshold)
+            lefts.append(np.where(is_leaf, LEAF, tree.children_left + offset))
+            rights.append(np.where(is_leaf, LEAF, tree.children_right + offset))
+            slot = np.full(tree.node_count, LEAF)
+            slot[is_leaf] = np.arange(leaves, leaves + int(is_leaf.sum()))
+            slots.append(slot)
+
+            value = np.zeros((int(is_leaf.sum()), n_outputs, max_classes))
+            for k, n in enumerate(n_classes):
+                proba = tree.value[is_leaf, k, :n]
+                normalizer = proba.sum(axis=1, keepdims=True)
+                normalizer[normalizer == 0.0] = 1.0
+                value[:, k, :n] = proba / normalizer
+            values.append(value)
+            offset += tree.node_count
+            leaves += value.shape[0]
+
+        classes = np.zeros((n_outputs, max_classes), dtype=class_lists[0].dtype)
+        for k, class_list in enumerate(class_lists):
+            classes[k, :len(class_list)] = class_list
+        return cls(
+            feature=np.concatenate(features).astype(np.int32),
+            threshold=np.concatenate(thresholds).astype(np.float64),
+            left=np.concatenate(lefts).astype(np.int32),
+            right=np.concatenate(rights).astype(np.int32),
+            leaf_slot=np.concatenate(slots).astype(np.int32),
+            leaf_values=np.concatenate(values),
+            roots=np.asarray(roots, dtype=np.int32),
+            classes=classes,
+        )
+
+    def apply(self, X):
+        """Leaf reached in every tree by every row of X: (n_rows, n_trees) node indices"""
+        X = sparse.csr_matrix(X)
+        X.sort_indices()
+        n_rows, n_features = X.shape
+        # Row-major keys of the stored entries; sorted because CSR rows and indices are
+        keys = np.repeat(np.arange(n_rows, dtype=np.int64), np.diff(X.indptr)) * n_features + X.indices
+        data = X.data
+
+        rows = np.repeat(np.arange(n_rows, dtype=np.int64), len(self.roots))
+        nodes = np.tile(self.roots, n_rows)
+        active = np.flatnonzero(self.left[nodes] != LEAF)
+        while len(active):
+            current = nodes[active]
+            wanted = rows[active] * n_features + self.feature[current]
+            # Sparse lookup of each split feature in its row, 0.0 when absent
+            value = np.zeros(len(active))
+            if len(keys):
+                position = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+                found = keys[position] == wanted
+                value[found] = data[position[found]]
+            # sklearn compares float32 feature values against float64 thresholds
+            go_left = value.astype(np.float32) <= self.threshold[current]
+            nodes[active] = np.where(go_left, self.left[current], self.right[current])
+            active = active[self.left[nodes[active]] != LEAF]
+        return nodes.reshape(n_rows, len(self.roots))
+
+    def predict_proba_sum(self, X):
+        """Per-row class probabilities summed over trees: (n_rows, n_outputs, n_classes)"""
+        return self.leaf_values[self.leaf_slot[self.apply(X)]].sum(axis=1)
+
+    def predict_proba(self, X):
+        """Class probabilities averaged over trees, as the source forest's predict_proba().
+
+        Multi-output forests give (n_rows, n_outputs, n_classes), with zeros
+        past the classes of outputs that have fewer.
+        """
+        proba = self.predict_proba_sum(X) / len(self.roots)
+        return proba[:, 0] if self.n_outputs == 1 else proba
+
+    def predict(self, X):
+        """Same labels as the source forest's predict()"""
+        votes = self.predict_proba_sum(X)
+        best = votes.argmax(axis=2)
+        labels = np.take_along_axis(self.classes[np.newaxis, :, :], best[:, :, np.newaxis], axis=2)[:, :, 0]
+        return labels[:, 0] if self.n_outputs == 1 else labels
+
+    def mismatches(self, forest, X):
+        """Number of rows of X on which this and the sklearn forest disagree"""
+        expected = np.asarray(forest.predict(X)).reshape(X.shape[0], -1)
+        actual = self.predict(X).reshape(X.shape[0], -1)
+        return int((expected != actual).any(axis=1).sum())
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def save(self, path, source=""):
+        """Write the arrays as .npy files in a directory, replacing it atomically.
+
+        ``source`` identifies the model the arrays were compiled from.
+        """
+        staging = f"{path}.tmp-{os.getpid()}"
+        os.makedirs(staging, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(staging, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(staging, "SOURCE"), "w", encoding="utf-8") as f:
+            f.write(source)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(staging, path)
+        except OSError:
+            # Another process published the same arrays first
+            shutil.rmtree(staging, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, source=None, mmap_mode="r"):
+        """Open saved arrays, memory-mapped by default so processes share their pages.
+
+        Returns None when nothing is saved at ``path`` or it was compiled
+        from a model other than ``source``.
+        """
+        try:
+            with open(os.path.join(path, "SOURCE"), encoding="utf-8") as f:
+                saved_source = f.read()
+            if source is not None and saved_source != source:
+                return None
+            return cls(**{
+                name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                for name in cls.ARRAYS
+            })
+        except (OSError, ValueError):
+            return None
+
+
+def verification_corpus(vectorizer, size=500, seed=0):
+    """Messages made of random vocabulary terms, to check a compiled forest against sklearn"""
+    rng = np.random.default_rng(seed)
+    terms = np.array(sorted(vectorizer.vocabulary_))
+    lengths = rng.integers(1, 9, size=size)
+    return [" ".join(rng.choice(terms, size=n)) for n in lengths]
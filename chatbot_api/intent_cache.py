@@ -0,0 +1,76 @@
+import re
+import threading
+from collections import OrderedDict
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_DIGITS = re.compile(r"\d+")
+
+
+def normalize_text(text):
+    """Cache key for a message: lower case, punctuation dropped, digit runs masked, single spaces.
+
+    The TF-IDF vectorizer lower-cases, splits on non-word characters and has
+    no numeric tokens, so messages that normalize alike get the same features.
+    """
+    text = _PUNCTUATION.sub(" ", str(text).lower())
+    text = _DIGITS.sub("0", text)
+    return " ".join(text.split())
+
+
+class PredictionCache:
+    """Bounded LRU of intent predictions keyed on normalized message text.
+
+    Entries belong to one model version; a lookup or store with another
+    version empties the cache first, so a new model never serves old answers.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+
+    def get(self, text, version):
+        """Return the cached prediction for a message, or None"""
+        key = normalize_text(text)
+        with self._lock:
+            self._check_version(version)
+            prediction = self._entries.get(key)
+            if prediction is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return prediction
+
+    def put(self, text, version, prediction):
+        key = normalize_text(text)
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = prediction
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "version": self.version,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,102 @@
+import json
+import threading
+from collections import deque
+from .intent_cache import normalize_text
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over per-category keyword lists.
+
+    Keywords and messages are normalized like the prediction cache keys and
+    only whole words match ("hi" does not match "this"). classify() returns
+    a category when the keywords found all belong to that one category, and
+    None when none or several categories match, leaving those messages to
+    the model.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = keywords
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for category, phrases in keywords.items():
+            for phrase in phrases:
+                self._add(normalize_text(phrase), category)
+        self._link()
+        self.hits = 0
+        self.ambiguous = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def _add(self, phrase, category):
+        if not phrase:
+            return
+        node = 0
+        for char in phrase:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            node = next_node
+        self._output[node] += ((len(phrase), category),)
+
+    def _link(self):
+        """Breadth-first failure links; each state also reports its suffixes' keywords"""
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self._goto[node].items():
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._output[child] += self._output[self._fail[child]]
+                pending.append(child)
+
+    def matches(self, text):
+        """Categories of the whole-word keywords found in a message"""
+        text = normalize_text(text)
+        found = set()
+        node = 0
+        for end, char in enumerate(text, start=1):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length, category in self._output[node]:
+                start = end - length
+                if (start == 0 or text[start - 1] == " ") and (end == len(text) or text[end] == " "):
+                    found.add(category)
+        return found
+
+    def classify(self, text):
+        """The single category a message's keywords point to, or None"""
+        found = self.matches(text)
+        with self._lock:
+            if len(found) == 1:
+                self.hits += 1
+                return found.pop()
+            if found:
+                self.ambiguous += 1
+            else:
+                self.misses += 1
+            return None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.ambiguous + self.misses
+            return {
+                "categories": len(self.keywords),
+                "keywords": sum(len(phrases) for phrases in self.keywords.values()),
+                "hits": self.hits,
+                "ambiguous": self.ambiguous,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,237 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+
+class _Flight:
+    """An upstream lookup in progress that other callers of the same key wait for"""
+
+    __slots__ = ("done", "value", "error", "stale")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+
+class _AsyncFlight:
+    """An awaited upstream lookup in progress that other tasks of the same event loop wait for"""
+
+    __slots__ = ("future", "stale")
+
+    def __init__(self, future):
+        self.future = future
+        self.stale = False
+
+
+class LookupCache:
+    """Bounded TTL cache of upstream lookups with negative caching and single-flight.
+
+    get_or_load() serves a fresh entry, or runs ``load`` once per key however
+    many threads ask at the same time; the others wait for that one result.
+    aget_or_load() does the same for coroutines, coalescing the tasks of one
+    event loop. Results ``negative`` calls true (say, "no such account") are
+    kept for ``negative_ttl`` instead of ``ttl``. Results carrying an
+    "error" key (the upstream failed) are never cached, so a retry asks again.
+
+    invalidate() and invalidate_matching() drop entries known to be out of
+    date. Otherwise a served value may be up to ``ttl`` seconds old
+    (``negative_ttl`` for negative results), plus the time its lookup took.
+    Each process has its own copy, and invalidation reaches only the calling
+    process.
+    """
+
+    def __init__(self, ttl=60, negative_ttl=15, max_size=10000, wait_timeout=30.0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.uncached = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._flights = {}
+        self._async_flights = {}  # (event loop, key) -> _AsyncFlight
+        self._lock = threading.Lock()
+
+    def _fresh(self, key, now):
+        """The live entry of a key, or None (expired entries are dropped); caller holds the lock"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None, negative=None):
+        """The cached value of a key, or ``default``; counts as a hit or miss"""
+        with self._lock:
+            entry = self._fresh(key, time.monotonic())
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            if negative is not None and negative(entry[1]):
+                self.negative_hits += 1
+            return entry[1]
+
+    def put(self, key, value, negative=False):
+        """Cache a value unless it reports an upstream error"""
+        if isinstance(value, dict) and value.get("error"):
+            with self._lock:
+                self.uncached += 1
+            return
+        ttl = self.negative_ttl if negative else self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, load, negative=None):
+        """Return the cached value of a key, calling ``load()`` once if there is none"""
+        with self._lock:
+            entry = self._fresh(key, time.monotonic())
+            if entry is not None:
+                self.hits += 1
+                if negative is not None and negative(entry[1]):
+                    self.negative_hits += 1
+                return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if flight.done.wait(self.wait_timeout):
+                if flight.error is not None:
+                    raise flight.error
+                return flight.value
+            return load()
+
+        try:
+            flight.value = load()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+        if not flight.stale:
+            self.put(key, flight.value, negative is not None and negative(flight.value))
+        return flight.value
+
+    async def aget_or_load(self, key, aload, negative=None):
+        """Return the cached value of a key, awaiting ``aload()`` once if there is none"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entry = self._fresh(key, time.monotonic())
+            if entry is not None:
+                self.hits += 1
+                if negative is not None and negative(entry[1]):
+                    self.negative_hits += 1
+                return entry[1]
+            flight = self._async_flights.get((loop, key))
+            leader = flight is None
+            if leader:
+                flight = self._async_flights[(loop, key)] = _AsyncFlight(loop.create_future())
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            try:
+                # Shielded: a waiter giving up must not cancel the leader's lookup
+                return await asyncio.wait_for(asyncio.shield(flight.future), self.wait_timeout)
+            except asyncio.TimeoutError:
+                return await aload()
+            except asyncio.CancelledError:
+                if flight.future.cancelled():
+                    # The leader was cancelled; look the key up ourselves
+                    return await aload()
+                raise
+
+        try:
+            value = await aload()
+        except asyncio.CancelledError:
+            flight.future.cancel()
+            raise
+        except BaseException as e:
+            flight.future.set_exception(e)
+            # Retrieved here so an unawaited error is not logged by asyncio
+            flight.future.exception()
+            raise
+        else:
+            flight.future.set_result(value)
+        finally:
+            with self._lock:
+                self._async_flights.pop((loop, key), None)
+        if not flight.stale:
+            self.put(key, value, negative is not None and negative(value))
+        return value
+
+    def invalidate(self, key):
+        """Forget a key, including the result of a lookup of it still in progress; True if it was cached"""
+        with self._lock:
+            cached = self._entries.pop(key, None) is not None
+            self.invalidations += cached
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.stale = True
+            for (_, flight_key), async_flight in self._async_flights.items():
+                if flight_key == key:
+                    async_flight.stale = True
+            return cached
+
+    def invalidate_matching(self, predicate):
+        """Forget every entry for which ``predicate(key, value)`` is true; returns how many"""
+        with self._lock:
+            keys = [key for key, (_, value) in self._entries.items() if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "negative_ttl": self.negative_ttl,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "uncached_errors": self.uncached,
+                "invalidations": self.invalidations,
+                "in_flight": len(self._flights) + len(self._async_flights),
+                "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Account balance and contact lookups of the billing API
+billing_cache = LookupCache(
+    ttl=getattr(settings, "BILLING_CACHE_TTL", 60),
+    negative_ttl=getattr(settings, "BILLING_CACHE_NEGATIVE_TTL", 15),
+    max_size=getattr(settings, "BILLING_CACHE_SIZE", 10000),
+)
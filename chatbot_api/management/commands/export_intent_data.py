@@ -0,0 +1,24 @@
+import json
+from collections import Counter
+from django.core.management.base import BaseCommand
+from chatbot_api.training import labelled_turns, read_transcripts
+
+
+class Command(BaseCommand):
+    help = "Export labelled intent examples from a dump of archived chat transcripts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("dump", help="Transcripts as a JSON array or JSON lines (e.g. mongoexport output)")
+        parser.add_argument("-o", "--output", default="intent_data.jsonl",
+                            help="JSON lines file of {\"text\", \"label\"} examples to write")
+
+    def handle(self, *args, **options):
+        documents = read_transcripts(options["dump"])
+        examples = labelled_turns(documents)
+        with open(options["output"], "w", encoding="utf-8") as f:
+            for text, label in examples:
+                f.write(json.dumps({"text": text, "label": label}, ensure_ascii=False) + "\n")
+        self.stdout.write(f"Exported {len(examples)} examples from {len(documents)} transcripts "
+                          f"to {options['output']}")
+        for label, count in sorted(Counter(label for _, label in examples).items()):
+            self.stdout.write(f"  {label}: {count}")
@@ -0,0 +1,63 @@
+import threading
+from django.core.management.base import BaseCommand, CommandError
+from chatbot_api.stub_upstream import ENDPOINTS, FIXTURE_FILE, Behaviour, StubUpstreams, make_server
+
+
+class Command(BaseCommand):
+    help = ("Serve a local stand-in for the billing API and the solar chat service, "
+            "answering from a fixture dataset with injected latency, errors and timeouts")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8080)
+        parser.add_argument("--chat-port", type=int,
+                            help="Also listen here, so the chat service is a separate upstream host")
+        parser.add_argument("--fixture", default=str(FIXTURE_FILE))
+        parser.add_argument("--generate", type=int, default=0,
+                            help="Add this many synthetic accounts with contact numbers")
+        parser.add_argument("--seed", type=int)
+        parser.add_argument("--endpoint", choices=ENDPOINTS,
+                            help="Apply the options below to this endpoint only (default: all)")
+        parser.add_argument("--latency-ms", type=float)
+        parser.add_argument("--distribution", choices=Behaviour.DISTRIBUTIONS)
+        parser.add_argument("--spread", type=float,
+                            help="Relative half-width (uniform) or sigma (lognormal) of the latency")
+        parser.add_argument("--error-rate", type=float, help="Share of requests answered with --error-status")
+        parser.add_argument("--error-status", type=int)
+        parser.add_argument("--timeout-rate", type=float,
+                            help="Share of requests never answered (held for --hang-seconds)")
+        parser.add_argument("--hang-seconds", type=float)
+
+    def handle(self, *args, **options):
+        behaviour = {key: options[key] for key in (
+            "endpoint", "latency_ms", "distribution", "spread", "error_rate",
+            "error_status", "timeout_rate", "hang_seconds",
+        )}
+        try:
+            stubs = StubUpstreams.from_file(options["fixture"], behaviour=behaviour,
+                                            generate=options["generate"], seed=options["seed"])
+            servers = [make_server(stubs, options["host"], port)
+                       for port in (options["port"], options["chat_port"]) if port]
+        except (OSError, ValueError, TypeError) as e:
+            raise CommandError(str(e))
+
+        host, billing_port = servers[0].server_address[:2]
+        chat_port = servers[-1].server_address[1]
+        self.stdout.write(f"Serving {len(stubs.accounts)} accounts and {len(stubs.contacts)} contacts")
+        for endpoint, config in stubs.stats()["behaviour"].items():
+            self.stdout.write(f"  {endpoint}: {config}")
+        self.stdout.write("Point the chatbot at it with:")
+        self.stdout.write(f"  BILLING_API_BASE_URL=http://{host}:{billing_port}/CCLECO/Main")
+        self.stdout.write(f"  SOLAR_CHAT_URL=http://{host}:{chat_port}/chat/")
+        self.stdout.write(f"Stats at GET http://{host}:{billing_port}/_stub/, "
+                          f"change behaviour with POST {{\"endpoint\", \"error_rate\", ...}} there")
+
+        for server in servers[1:]:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            servers[0].serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for server in servers:
+                server.server_close()
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from chatbot_api.chat_history import sweeper
+
+
+class Command(BaseCommand):
+    help = "Archive expired chat sessions to MongoDB and delete them"
+
+    def handle(self, *args, **options):
+        swept = sweeper.sweep()
+        self.stdout.write(f"Archived {swept} expired sessions")
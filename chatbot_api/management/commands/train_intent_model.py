@@ -0,0 +1,92 @@
+import datetime
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chatbot_api.classifier import INTENT_LABELS, ModelRegistry
+from chatbot_api.training import benchmark, evaluate, select, serving_classifier, split_examples, train
+
+
+def parse_list(value, convert=int):
+    """Comma-separated values; "none" stands for None"""
+    return [None if item.strip().lower() == "none" else convert(item) for item in value.split(",")]
+
+
+class Command(BaseCommand):
+    help = ("Train intent model candidates, compare accuracy and inference latency, "
+            "and publish the best one to the model registry")
+
+    def add_arguments(self, parser):
+        parser.add_argument("data", help="JSON lines of {\"text\", \"label\"} (see export_intent_data)")
+        parser.add_argument("--name", dest="model_version", help="Registry version name (default: a timestamp)")
+        parser.add_argument("--registry", default=getattr(settings, "INTENT_MODEL_REGISTRY", "models/registry"))
+        parser.add_argument("--estimators", default="50,100", help="Forest sizes to try, e.g. 50,100,200")
+        parser.add_argument("--max-depth", default="none", help="Tree depths to try, e.g. none,20")
+        parser.add_argument("--test-size", type=float, default=0.2)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=getattr(settings, "INTENT_BATCH_MAX_SIZE", 32))
+        parser.add_argument("--latency-budget-ms", type=float,
+                            help="Only pick candidates whose single-message p95 latency is within this")
+        parser.add_argument("--dry-run", action="store_true", help="Report without publishing")
+        parser.add_argument("--activate", action="store_true",
+                            help="Make the published version active (workers swap it in)")
+
+    def handle(self, *args, **options):
+        with open(options["data"], encoding="utf-8") as f:
+            examples = [(row["text"], row["label"]) for row in map(json.loads, f) if row.get("label") in INTENT_LABELS]
+        if not examples:
+            raise CommandError(f"No examples with a known label in {options['data']}")
+        train_set, test_set = split_examples(examples, options["test_size"], options["seed"])
+        self.stdout.write(f"{len(train_set)} training and {len(test_set)} test examples")
+
+        candidates = []
+        for n_estimators in parse_list(options["estimators"]):
+            for max_depth in parse_list(options["max_depth"]):
+                vectorizer, model = train(train_set, n_estimators=n_estimators, max_depth=max_depth,
+                                          seed=options["seed"])
+                classifier = serving_classifier(vectorizer, model)
+                candidate = {
+                    "params": {"n_estimators": n_estimators, "max_depth": max_depth},
+                    "evaluation": evaluate(classifier, test_set),
+                    "benchmark": benchmark(classifier, [text for text, _ in test_set], options["batch_size"]),
+                    "artifacts": (vectorizer, model),
+                }
+                candidates.append(candidate)
+                self.report(candidate)
+
+        chosen = select(candidates, options["latency_budget_ms"])
+        if chosen is None:
+            raise CommandError("No candidate is within the latency budget")
+        self.stdout.write(f"Selected {chosen['params']}")
+        if options["dry_run"]:
+            return
+
+        version = options["model_version"] or datetime.datetime.now().strftime("v%Y%m%d%H%M%S")
+        metrics = {
+            "version": version,
+            "data": options["data"],
+            "train_examples": len(train_set),
+            "test_examples": len(test_set),
+            "selected": chosen["params"],
+            "candidates": [{key: value for key, value in candidate.items() if key != "artifacts"}
+                           for candidate in candidates],
+        }
+        vectorizer, model = chosen["artifacts"]
+        try:
+            path = ModelRegistry(options["registry"]).publish(
+                version, vectorizer, model, metrics=metrics, activate=options["activate"]
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"Published {version} to {path}" + (" and activated it" if options["activate"] else ""))
+
+    def report(self, candidate):
+        evaluation, bench = candidate["evaluation"], candidate["benchmark"]
+        self.stdout.write(
+            f"{candidate['params']}: accuracy {evaluation['accuracy']:.3f}, macro F1 {evaluation['macro_f1']:.3f}, "
+            f"single p50/p95 {bench['single_row_ms']['p50']}/{bench['single_row_ms']['p95']} ms, "
+            f"batched p50 {bench['batched_ms_per_message']['p50']} ms/msg, "
+            f"model {bench['model_bytes'] // 1024} KiB, vectorizer {bench['vectorizer_bytes'] // 1024} KiB"
+        )
+        for label, scores in evaluation["per_category"].items():
+            self.stdout.write(f"    {label:<24} P {scores['precision']:.2f}  R {scores['recall']:.2f}  "
+                              f"F1 {scores['f1']:.2f}  n={scores['support']}")
@@ -0,0 +1,93 @@
+import datetime
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def entry_timestamp(entry, default):
+    """The ISO timestamp some history entries carry, else ``default``"""
+    try:
+        timestamp = datetime.datetime.fromisoformat(entry["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        return default
+    if django.utils.timezone.is_naive(timestamp):
+        timestamp = django.utils.timezone.make_aware(timestamp)
+    return timestamp
+
+
+def copy_chat_history(apps, schema_editor):
+    """Move the JSON chat_history of every open session into ChatTurn rows"""
+    ChatSession = apps.get_model("chatbot_api", "ChatSession")
+    ChatTurn = apps.get_model("chatbot_api", "ChatTurn")
+    for chat_session in ChatSession.objects.iterator():
+        turns = [
+            ChatTurn(
+                session=chat_session,
+                sequence=sequence,
+                user_text=entry.get("user"),
+                bot_text=entry.get("bot"),
+                node_id=chat_session.state,
+                timestamp=entry_timestamp(entry, chat_session.updated_at),
+            )
+            for sequence, entry in enumerate(
+                (entry for entry in chat_session.chat_history or [] if isinstance(entry, dict)), start=1
+            )
+        ]
+        ChatTurn.objects.bulk_create(turns)
+        chat_session.turn_count = len(turns)
+        chat_session.save(update_fields=["turn_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot_api", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatsession",
+            name="turn_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name="ChatTurn",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("sequence", models.PositiveIntegerField()),
+                ("user_text", models.TextField(blank=True, null=True)),
+                ("bot_text", models.TextField(blank=True, null=True)),
+                ("node_id", models.CharField(blank=True, default="", max_length=50)),
+                ("timestamp", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "session",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="turns",
+                        to="chatbot_api.chatsession",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["session", "sequence"],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("session", "sequence"), name="unique_chat_turn_sequence"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(copy_chat_history, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="chatsession",
+            name="chat_history",
+        ),
+    ]
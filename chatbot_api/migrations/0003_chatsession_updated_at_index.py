@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot_api", "0002_chatturn"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="chatsession",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
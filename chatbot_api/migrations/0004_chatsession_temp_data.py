@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot_api", "0003_chatsession_updated_at_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatsession",
+            name="temp_data",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
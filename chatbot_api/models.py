@@ -1,41 +1,202 @@
 # models.py
-from django.db import models
+import copy
+from django.db import models, transaction
 from django.utils import timezone
 from datetime import timedelta, datetime
 
 class ChatSession(models.Model):
     objects = models.Manager()
+
+    # Fields a conversation turn may change; flush() writes back only those that did
+    TRACKED_FIELDS = ("turn_count", "state", "mistake_count", "selected_language", "temp_data")
     
     session_id = models.CharField(max_length=255, unique=True)  # Unique identifier for the session
-    chat_history = models.JSONField(default=list, blank=True)  # Stores the chat history as JSON
+    turn_count = models.PositiveIntegerField(default=0)  # Sequence number of the last logged ChatTurn
     state = models.CharField(max_length=20, default="start")  # Default state for the session
     mistake_count = models.IntegerField()  # Counter for mistakes
     selected_language = models.CharField(max_length=20, default="Unknown")  # Add this field
+    temp_data = models.JSONField(default=dict, blank=True)  # Form answers kept across turns, e.g. the account being verified
     created_at = models.DateTimeField(auto_now_add=True)  # Timestamp for when the session is created
-    updated_at = models.DateTimeField(auto_now=True)  # Timestamp for the last update to the session
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # Timestamp for the last update to the session
+
+    # Inactivity after which a session expires and is archived by the sweeper
+    SESSION_TIMEOUT = timedelta(seconds=30)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.mark_clean()
+        return instance
 
     def save(self, *args, **kwargs):
         if self.mistake_count is None:
             self.mistake_count = 0
         super().save(*args, **kwargs)
+        self.mark_clean()
 
-    def __str__(self):
-        return str(self.session_id)  # Returns the session ID as a string representation
+    def mark_clean(self):
+        """Remember the stored values of the tracked fields"""
+        # temp_data is changed in place, so compare against a copy
+        self._stored = {name: getattr(self, name) for name in self.TRACKED_FIELDS}
+        self._stored["temp_data"] = copy.deepcopy(self.temp_data)
+
+    def changed_fields(self):
+        """Tracked fields whose value differs from what is stored"""
+        stored = getattr(self, "_stored", None)
+        if stored is None:
+            return list(self.TRACKED_FIELDS)
+        return [name for name in self.TRACKED_FIELDS if getattr(self, name) != stored[name]]
+
+    @property
+    def pending_turns(self):
+        """Turns recorded during the current request and not yet written to the log"""
+        if not hasattr(self, "_pending_turns"):
+            self._pending_turns = []
+        return self._pending_turns
+
+    def add_turn(self, user, bot):
+        """Record a user message and the bot's reply"""
+        self.pending_turns.append({"user": user, "bot": bot, "timestamp": timezone.now()})
+
+    def set_reply(self, bot):
+        """Replace the bot's reply of the turn recorded last"""
+        if self.pending_turns:
+            self.pending_turns[-1]["bot"] = bot
+
+    def stamp_turns(self):
+        """Tag the turns recorded by this request with the node the request ended on"""
+        for entry in self.pending_turns:
+            entry.setdefault("node_id", self.state)
+
+    def build_turns(self):
+        """Pending turns as unsaved ChatTurn rows, numbered after the stored ones"""
+        return [
+            ChatTurn(
+                session=self,
+                sequence=self.turn_count + position,
+                user_text=entry["user"],
+                bot_text=entry["bot"],
+                node_id=entry.get("node_id", self.state),
+                timestamp=entry["timestamp"],
+            )
+            for position, entry in enumerate(self.pending_turns, start=1)
+        ]
+
+    def flush(self):
+        """End-of-turn unit of work: append the new turns and update the changed fields.
+
+        Nothing is written when the turn changed nothing.
+        """
+        return bool(ChatSession.flush_many([self]))
+
+    @classmethod
+    def flush_many(cls, sessions, touch=True):
+        """Write the pending turns and changed fields of several sessions at once.
+
+        One INSERT of ChatTurn rows and one UPDATE (a bulk one for several
+        sessions) in a single transaction. With touch=False updated_at is
+        written as held on the instances instead of being set to now.
+        Sessions deleted during the turn, e.g. archived on exit, are skipped.
+        Returns the sessions that were written.
+        """
+        now = timezone.now()
+        turns = []
+        dirty = []
+        fields = set()
+        for chat_session in sessions:
+            if chat_session.pk is None:
+                continue
+            new_turns = chat_session.build_turns()
+            chat_session.turn_count += len(new_turns)
+            changed = chat_session.changed_fields()
+            if not changed:
+                continue
+            turns.extend(new_turns)
+            dirty.append(chat_session)
+            fields.update(changed)
+            if touch:
+                chat_session.updated_at = now
+        if not dirty:
+            return []
+
+        fields = sorted(fields) + ["updated_at"]
+        try:
+            with transaction.atomic():
+                if turns:
+                    ChatTurn.objects.bulk_create(turns)
+                if len(dirty) == 1:
+                    cls.objects.filter(pk=dirty[0].pk).update(
+                        **{name: getattr(dirty[0], name) for name in fields}
+                    )
+                else:
+                    cls.objects.bulk_update(dirty, fields)
+        except Exception:
+            # Nothing was stored: keep the turns pending for the next flush
+            for chat_session in dirty:
+                chat_session.turn_count = chat_session._stored["turn_count"]
+            raise
+        for chat_session in dirty:
+            chat_session.pending_turns.clear()
+            chat_session.mark_clean()
+        return dirty
+
+    def iter_turns(self):
+        """Stream the conversation from the turn log, then the turns not yet flushed"""
+        if self.pk is not None:
+            for turn in self.turns.order_by("sequence").iterator():
+                yield turn.as_message()
+        for entry in self.pending_turns:
+            yield {
+                "user": entry["user"],
+                "bot": entry["bot"],
+                "timestamp": entry["timestamp"].isoformat(),
+                "node_id": entry.get("node_id", self.state)
+            }
 
     def get_chat_history(self):
         """Return the chat history in a structured format"""
         return {
-            "messages": self.chat_history,
+            "messages": list(self.iter_turns()),
             "created_at": self.created_at,
             "updated_at": self.updated_at,
             "current_state": self.state
         }
 
     def is_session_expired(self):
-        """Check if session has been inactive for more than 5 minutes"""
-        timeout_duration = timedelta(seconds=30)  # 5 minutes = 300 seconds
-        current_time = timezone.now()
-        last_updated = timezone.localtime(self.updated_at)
-        return current_time - last_updated > timeout_duration
+        """Check if session has been inactive for longer than SESSION_TIMEOUT"""
+        return timezone.now() - self.updated_at > self.SESSION_TIMEOUT
+
+    @classmethod
+    def expired(cls, now=None):
+        """Sessions inactive for longer than SESSION_TIMEOUT, via the updated_at index"""
+        return cls.objects.filter(updated_at__lt=(now or timezone.now()) - cls.SESSION_TIMEOUT)
+
+
+class ChatTurn(models.Model):
+    """One user message and the bot's reply. Turns are appended, never rewritten."""
+    objects = models.Manager()
+
+    session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name="turns")
+    sequence = models.PositiveIntegerField()  # 1-based position in the conversation
+    user_text = models.TextField(null=True, blank=True)
+    bot_text = models.TextField(null=True, blank=True)
+    node_id = models.CharField(max_length=50, blank=True, default="")  # State after the turn
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ["session", "sequence"]
+        constraints = [
+            models.UniqueConstraint(fields=["session", "sequence"], name="unique_chat_turn_sequence")
+        ]
 
+    def __str__(self):
+        return f"{self.session_id}#{self.sequence}"
 
+    def as_message(self):
+        """The turn in the shape get_chat_history() has always returned"""
+        return {
+            "user": self.user_text,
+            "bot": self.bot_text,
+            "timestamp": self.timestamp.isoformat(),
+            "node_id": self.node_id
+        }
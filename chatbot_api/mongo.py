@@ -0,0 +1,41 @@
+import os
+import threading
+from django.conf import settings
+from pymongo import MongoClient
+
+# One pooled client per process, created on first use. A client must not be
+# used across fork(), so a child process gets its own.
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def get_client():
+    """Return this process's MongoClient, creating it on first use"""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _lock:
+        if _client is None or _client_pid != pid:
+            if not settings.MONGO_URI:
+                raise ValueError("MONGO_URI environment variable is not set")
+            _client = MongoClient(
+                settings.MONGO_URI,
+                maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+                connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT_MS,
+            )
+            _client_pid = pid
+            print(f"[INFO] MongoDB client created (pid {pid}, pool size {settings.MONGO_MAX_POOL_SIZE})")
+    return _client
+
+
+def get_collection():
+    """Return the collection finished conversations are archived to"""
+    if settings.MONGO_DB is None:
+        raise ValueError("MONGO_DB environment variable is not set")
+    if settings.MONGO_COLLECTION is None:
+        raise ValueError("MONGO_COLLECTION environment variable is not set")
+    return get_client()[settings.MONGO_DB][settings.MONGO_COLLECTION]
@@ -0,0 +1,48 @@
+import json
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+
+def render_body(data):
+    """Render response data to JSON bytes exactly as DRF's JSONRenderer would"""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class NodeResponse(HttpResponse):
+    """Response with a body rendered ahead of time.
+
+    It is a plain Django response, so DRF passes it through without running
+    a renderer on it.
+    """
+
+    def __init__(self, body, status=200):
+        super().__init__(body, content_type="application/json", status=status)
+
+    @property
+    def data(self):
+        """Decoded body, for callers that expect a DRF-style ``data`` attribute"""
+        return json.loads(self.content)
+
+
+def response_json(response):
+    """JSON body of a chatbot response, rendering DRF Responses when needed"""
+    if isinstance(response, Response):
+        return JSONRenderer().render(response.data)
+    return response.content
+
+
+def to_http_response(response):
+    """Render a handler's DRF Response outside of an APIView (e.g. in async views)"""
+    if not isinstance(response, Response):
+        return response
+    return NodeResponse(response_json(response), status=response.status_code)
+
+
+def render_batch(session_ids, responses):
+    """Render batch results, splicing in the already rendered turn bodies"""
+    results = []
+    for session_id, response in zip(session_ids, responses):
+        head = render_body({"session_id": session_id, "status": response.status_code})
+        results.append(head[:-1] + b',"response":' + response_json(response) + b"}")
+    return b'{"results":[' + b",".join(results) + b"]}"
@@ -0,0 +1,511 @@
+import asyncio
+import atexit
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+from django.utils import timezone
+from .models import ChatSession
+
+
+def load_sessions(session_ids):
+    """Fetch the sessions in one query and create the missing ones in one INSERT.
+
+    Returns ({session_id: session}, set of created session ids).
+    """
+    sessions = ChatSession.objects.in_bulk(session_ids, field_name="session_id")
+    missing = [session_id for session_id in session_ids if session_id not in sessions]
+    if missing:
+        new_sessions = ChatSession.objects.bulk_create(
+            [ChatSession(session_id=session_id, mistake_count=0) for session_id in missing]
+        )
+        for chat_session in new_sessions:
+            chat_session.mark_clean()
+            sessions[chat_session.session_id] = chat_session
+    return sessions, set(missing)
+
+
+class SessionConflict(Exception):
+    """A turn could not get, or lost, exclusive use of its session; its changes were not stored"""
+
+    def __init__(self, session_ids):
+        super().__init__(f"Session in use by another request: {', '.join(map(str, session_ids))}")
+        self.session_ids = list(session_ids)
+
+
+def forget_request_state(chat_session):
+    """Drop what a handler cached for the current request only"""
+    chat_session.__dict__.pop("prefetched", None)
+
+
+class SessionStore:
+    """Where conversation sessions live between turns.
+
+    A turn checks its session out, advances it in memory and checks it back
+    in; the backend decides when the database sees the change. checkin()
+    with commit=False is used when the turn failed.
+    """
+
+    def checkout(self, session_id):
+        """Return (session, created) for a session id, creating the session if needed"""
+        raise NotImplementedError
+
+    def checkin(self, chat_session, commit=True):
+        """Hand a session back after its turn"""
+        raise NotImplementedError
+
+    def checkout_many(self, session_ids):
+        """Return ({session_id: session}, set of created session ids)"""
+        sessions, created = {}, set()
+        for session_id in session_ids:
+            sessions[session_id], is_new = self.checkout(session_id)
+            if is_new:
+                created.add(session_id)
+        return sessions, created
+
+    def checkin_many(self, sessions, commit=True):
+        for chat_session in sessions:
+            self.checkin(chat_session, commit)
+
+    def restart(self, chat_session):
+        """A new session under the id of one archived while checked out; it stays checked out"""
+        return ChatSession.objects.create(session_id=chat_session.session_id, mistake_count=0)
+
+    async def acheckout(self, session_id):
+        """Async checkout() for the async endpoint; ORM work stays on the shared sync thread"""
+        return await sync_to_async(self.checkout)(session_id)
+
+    async def acheckin(self, chat_session, commit=True):
+        await sync_to_async(self.checkin)(chat_session, commit)
+
+    @contextmanager
+    def session(self, session_id):
+        """Check a session out for the duration of a ``with`` block"""
+        chat_session, created = self.checkout(session_id)
+        try:
+            yield chat_session, created
+        except BaseException:
+            self.checkin(chat_session, commit=False)
+            raise
+        self.checkin(chat_session)
+
+    def flush(self):
+        """Write out anything the store holds back (nothing for write-through stores)"""
+
+
+class OrmSessionStore(SessionStore):
+    """Sessions read from and written to the database on every turn"""
+
+    def checkout(self, session_id):
+        return ChatSession.objects.get_or_create(session_id=session_id)
+
+    async def acheckout(self, session_id):
+        return await ChatSession.objects.aget_or_create(session_id=session_id)
+
+    def checkout_many(self, session_ids):
+        return load_sessions(session_ids)
+
+    def checkin(self, chat_session, commit=True):
+        forget_request_state(chat_session)
+        if commit:
+            chat_session.flush()
+
+    def checkin_many(self, sessions, commit=True):
+        sessions = list(sessions)
+        for chat_session in sessions:
+            forget_request_state(chat_session)
+        if commit:
+            ChatSession.flush_many(sessions)
+
+
+class _Entry:
+    """A cached session and the lock held by whoever is using it"""
+
+    __slots__ = ("session", "lock", "last_used", "evicted")
+
+    def __init__(self):
+        self.session = None
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.evicted = False
+
+
+class MemorySessionStore(SessionStore):
+    """In-process LRU of sessions with idle expiry and write-behind.
+
+    Hot sessions are served from memory. Changed sessions are written by a
+    background thread every ``flush_interval`` seconds, so the database sees
+    at most one coalesced write per session per interval; sessions leaving
+    the cache are written first. The cache is per process: run one worker
+    process, or route each session to the same one.
+    """
+
+    def __init__(self, max_size=10000, ttl=300, flush_interval=1.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()  # session_id -> _Entry, least recently used first
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+        atexit.register(self.flush)
+
+    def _entry(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                entry = self._entries[session_id] = _Entry()
+            self._entries.move_to_end(session_id)
+            return entry
+
+    def _acquire(self, session_id):
+        """Lock the entry of a session, retrying if it was evicted meanwhile"""
+        while True:
+            entry = self._entry(session_id)
+            entry.lock.acquire()
+            if not entry.evicted:
+                return entry
+            entry.lock.release()
+
+    def checkout(self, session_id):
+        self._start_flusher()
+        entry = self._acquire(session_id)
+        created = False
+        try:
+            if entry.session is None:
+                entry.session, created = ChatSession.objects.get_or_create(session_id=session_id)
+        except BaseException:
+            entry.lock.release()
+            raise
+        self._evict_overflow()
+        return entry.session, created
+
+    async def acheckout(self, session_id):
+        self._start_flusher()
+        # Waiting for another turn of this session must not hold up the shared
+        # sync thread, so only the lock wait runs on a worker thread
+        acquiring = asyncio.ensure_future(sync_to_async(self._acquire, thread_sensitive=False)(session_id))
+        try:
+            entry = await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # The worker thread still takes the lock; give it back when it does
+            acquiring.add_done_callback(
+                lambda done: done.cancelled() or done.exception() or done.result().lock.release()
+            )
+            raise
+        created = False
+        try:
+            if entry.session is None:
+                entry.session, created = await ChatSession.objects.aget_or_create(session_id=session_id)
+        except BaseException:
+            entry.lock.release()
+            raise
+        await sync_to_async(self._evict_overflow)()
+        return entry.session, created
+
+    def checkout_many(self, session_ids):
+        self._start_flusher()
+        # A fixed lock order keeps two batches sharing sessions from deadlocking
+        entries = {session_id: self._acquire(session_id) for session_id in sorted(set(session_ids))}
+        try:
+            missing = [session_id for session_id, entry in entries.items() if entry.session is None]
+            loaded, created = load_sessions(missing) if missing else ({}, set())
+        except BaseException:
+            for entry in entries.values():
+                entry.lock.release()
+            raise
+        for session_id, chat_session in loaded.items():
+            entries[session_id].session = chat_session
+        self._evict_overflow()
+        return {session_id: entry.session for session_id, entry in entries.items()}, created
+
+    def restart(self, chat_session):
+        new_session = super().restart(chat_session)
+        # The entry lock is still held by the caller's checkout
+        self._entries[chat_session.session_id].session = new_session
+        return new_session
+
+    def checkin(self, chat_session, commit=True):
+        forget_request_state(chat_session)
+        session_id = chat_session.session_id
+        with self._lock:
+            entry = self._entries[session_id]
+            if chat_session.pk is None or (chat_session.is_session_expired()
+                                           and session_id not in self._dirty):
+                # Archived on exit, or expired and left for the sweeper
+                entry.session = None
+                self._dirty.discard(session_id)
+            elif not commit and session_id not in self._dirty:
+                # Reload the stored state rather than keep a half-applied turn
+                entry.session = None
+            else:
+                if not commit:
+                    print(f"[WARN] Turn failed on session {session_id} with unwritten changes; keeping them")
+                entry.session = chat_session
+                if chat_session.pending_turns or chat_session.changed_fields():
+                    chat_session.updated_at = timezone.now()
+                    self._dirty.add(session_id)
+            entry.last_used = time.monotonic()
+        entry.lock.release()
+
+    def flush(self):
+        """Write every changed session that no turn is using right now"""
+        with self._lock:
+            candidates = [self._entries[session_id] for session_id in self._dirty
+                          if session_id in self._entries]
+        entries = [entry for entry in candidates if entry.lock.acquire(blocking=False)]
+        try:
+            sessions = [entry.session for entry in entries if entry.session is not None]
+            if sessions:
+                ChatSession.flush_many(sessions, touch=False)
+            with self._lock:
+                self._dirty.difference_update(chat_session.session_id for chat_session in sessions)
+        finally:
+            for entry in entries:
+                entry.lock.release()
+
+    def _evict(self, session_id, entry):
+        """Drop an entry whose lock the caller holds, writing it out first if needed"""
+        if session_id in self._dirty and entry.session is not None:
+            ChatSession.flush_many([entry.session], touch=False)
+        with self._lock:
+            self._dirty.discard(session_id)
+            if self._entries.get(session_id) is entry:
+                del self._entries[session_id]
+            entry.evicted = True
+
+    def _evict_overflow(self):
+        """Keep the cache within max_size, skipping sessions that are in use"""
+        with self._lock:
+            excess = len(self._entries) - self.max_size
+            oldest = list(self._entries.items())[:max(excess, 0) * 2]
+        for session_id, entry in oldest:
+            if excess <= 0:
+                break
+            if entry.lock.acquire(blocking=False):
+                try:
+                    self._evict(session_id, entry)
+                    excess -= 1
+                finally:
+                    entry.lock.release()
+
+    def _evict_idle(self):
+        """Drop sessions nobody has touched for ttl seconds"""
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            idle = [(session_id, entry) for session_id, entry in self._entries.items()
+                    if entry.last_used < cutoff]
+        for session_id, entry in idle:
+            if entry.lock.acquire(blocking=False):
+                try:
+                    self._evict(session_id, entry)
+                finally:
+                    entry.lock.release()
+
+    def _start_flusher(self):
+        """Start the write-behind thread once per process (threads do not survive a fork)"""
+        pid = os.getpid()
+        if self._flusher_pid == pid:
+            return
+        with self._lock:
+            if self._flusher_pid == pid:
+                return
+            self._flusher_pid = pid
+            threading.Thread(target=self._run_flusher, name="session-write-behind", daemon=True).start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                self._evict_idle()
+            except Exception as e:
+                print(f"[ERROR] Session write-behind failed: {e}")
+            finally:
+                close_old_connections()
+
+
+class CacheSessionStore(SessionStore):
+    """Sessions kept in a Django cache shared by all workers, written through to the database.
+
+    Point ``alias`` at a Redis or Memcached entry of CACHES; the default
+    local-memory cache stands in for the shared server during development.
+
+    Workers take turns on a session through a lease: a lock key added with
+    cache.add() that expires after ``lease`` seconds, waited for at most
+    ``wait`` seconds. The cached entry carries a version bumped on every
+    check-in. A turn whose lease expired, or whose session version moved
+    since checkout, is refused with SessionConflict instead of overwriting
+    the newer state.
+    """
+
+    KEY_PREFIX = "chat_session:"
+    LOCK_PREFIX = "chat_session_lock:"
+    POLL_SECONDS = 0.01
+
+    def __init__(self, alias="default", timeout=300, lease=60, wait=10):
+        self.alias = alias
+        self.timeout = timeout
+        self.lease = lease
+        self.wait = wait
+        # session_id -> (lease token, version seen at checkout); only the lease holder touches its entry
+        self._leases = {}
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, session_id):
+        return f"{self.KEY_PREFIX}{session_id}"
+
+    def lock_key(self, session_id):
+        return f"{self.LOCK_PREFIX}{session_id}"
+
+    def _take_lease(self, session_id):
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait
+        while not self.cache.add(self.lock_key(session_id), token, self.lease):
+            if time.monotonic() >= deadline:
+                raise SessionConflict([session_id])
+            time.sleep(self.POLL_SECONDS)
+        return token
+
+    async def _atake_lease(self, session_id):
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait
+        while not await self.cache.aadd(self.lock_key(session_id), token, self.lease):
+            if time.monotonic() >= deadline:
+                raise SessionConflict([session_id])
+            await asyncio.sleep(self.POLL_SECONDS)
+        return token
+
+    def _release(self, tokens):
+        """Delete the lock keys still holding our tokens ({session_id: token})"""
+        for session_id in tokens:
+            self._leases.pop(session_id, None)
+        held = self.cache.get_many([self.lock_key(session_id) for session_id in tokens])
+        self.cache.delete_many([self.lock_key(session_id) for session_id, token in tokens.items()
+                                if held.get(self.lock_key(session_id)) == token])
+
+    def _load(self, session_ids, tokens):
+        """Read the sessions under their leases, from the cache or else the database"""
+        cached = self.cache.get_many([self.key(session_id) for session_id in session_ids])
+        sessions = {}
+        for session_id in session_ids:
+            entry = cached.get(self.key(session_id))
+            if entry is not None:
+                version, sessions[session_id] = entry
+                self._leases[session_id] = (tokens[session_id], version)
+        missing = [session_id for session_id in session_ids if session_id not in sessions]
+        loaded, created = load_sessions(missing) if missing else ({}, set())
+        for session_id in loaded:
+            # Version None: the cache held no entry
+            self._leases[session_id] = (tokens[session_id], None)
+        sessions.update(loaded)
+        return sessions, created
+
+    def checkout(self, session_id):
+        token = self._take_lease(session_id)
+        try:
+            sessions, created = self._load([session_id], {session_id: token})
+        except BaseException:
+            self._release({session_id: token})
+            raise
+        return sessions[session_id], session_id in created
+
+    async def acheckout(self, session_id):
+        # The lease wait sleeps on the event loop rather than the shared sync thread
+        token = await self._atake_lease(session_id)
+        try:
+            sessions, created = await sync_to_async(self._load)([session_id], {session_id: token})
+        except BaseException:
+            await sync_to_async(self._release)({session_id: token})
+            raise
+        return sessions[session_id], session_id in created
+
+    def checkout_many(self, session_ids):
+        # A fixed lease order keeps two batches sharing sessions from waiting on each other
+        tokens = {}
+        try:
+            for session_id in sorted(set(session_ids)):
+                tokens[session_id] = self._take_lease(session_id)
+            return self._load(list(tokens), tokens)
+        except BaseException:
+            self._release(tokens)
+            raise
+
+    def checkin(self, chat_session, commit=True):
+        self.checkin_many([chat_session], commit)
+
+    def checkin_many(self, sessions, commit=True):
+        sessions = list(sessions)
+        leases = {chat_session.session_id: self._leases.pop(chat_session.session_id) for chat_session in sessions}
+        tokens = {session_id: token for session_id, (token, _) in leases.items()}
+        for chat_session in sessions:
+            forget_request_state(chat_session)
+        try:
+            if not commit:
+                # Next checkout reloads the stored state rather than a half-applied turn
+                self.cache.delete_many([self.key(session_id) for session_id in leases])
+                return
+            # Compare the lease and version with what checkout saw before writing anything
+            held = self.cache.get_many([self.lock_key(session_id) for session_id in leases]
+                                       + [self.key(session_id) for session_id in leases])
+            conflicts = [
+                session_id for session_id, (token, version) in leases.items()
+                if held.get(self.lock_key(session_id)) != token
+                or (held[self.key(session_id)][0] if self.key(session_id) in held else None) != version
+            ]
+            sessions = [chat_session for chat_session in sessions if chat_session.session_id not in conflicts]
+            ChatSession.flush_many(sessions)
+            keep, drop = {}, []
+            for chat_session in sessions:
+                key = self.key(chat_session.session_id)
+                if chat_session.pk is not None and not chat_session.is_session_expired():
+                    keep[key] = ((leases[chat_session.session_id][1] or 0) + 1, chat_session)
+                else:
+                    drop.append(key)
+            if keep:
+                self.cache.set_many(keep, self.timeout)
+            if drop:
+                self.cache.delete_many(drop)
+            if conflicts:
+                print(f"[WARN] Dropped turns on sessions changed by another request: {conflicts}")
+                raise SessionConflict(conflicts)
+        finally:
+            self._release(tokens)
+
+
+def build_session_store():
+    """Create the store selected by settings.CHAT_SESSION_STORE"""
+    backend = getattr(settings, "CHAT_SESSION_STORE", "orm")
+    if backend == "orm":
+        return OrmSessionStore()
+    if backend == "memory":
+        if not getattr(settings, "CHAT_SESSION_STICKY_ROUTING", False):
+            print("[WARN] CHAT_SESSION_STORE=memory keeps sessions in this process only: with several "
+                  "worker processes each one holds its own copy and overwrites the others' turns. "
+                  "Run a single worker, or route each session to one worker and set CHAT_SESSION_STICKY_ROUTING=true")
+        return MemorySessionStore(
+            max_size=settings.CHAT_SESSION_CACHE_SIZE,
+            ttl=settings.CHAT_SESSION_CACHE_TTL,
+            flush_interval=settings.CHAT_SESSION_FLUSH_INTERVAL,
+        )
+    if backend == "cache":
+        return CacheSessionStore(
+            alias=settings.CHAT_SESSION_CACHE_ALIAS,
+            timeout=settings.CHAT_SESSION_CACHE_TTL,
+            lease=settings.CHAT_SESSION_LEASE_SECONDS,
+            wait=settings.CHAT_SESSION_LEASE_WAIT,
+        )
+    raise ValueError(f"Unknown CHAT_SESSION_STORE: {backend}")
+
+
+session_store = build_session_store()
+print(f"[INFO] Session store: {type(session_store).__name__}")
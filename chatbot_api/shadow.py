@@ -0,0 +1,163 @@
+import bisect
+import os
+import queue
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+
+class LatencyHistogram:
+    """Latencies counted in fixed log-spaced buckets from 10 us to about 15 s.
+
+    Percentiles are read off the bucket bounds, so they are accurate to one
+    bucket (25%), and the histogram stays a few hundred bytes however many
+    samples it takes.
+    """
+
+    BOUNDS_MS = [0.01 * 1.25 ** i for i in range(64)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile, in ms"""
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.BOUNDS_MS[i] if i < len(self.BOUNDS_MS) else self.max_ms
+        return self.max_ms
+
+    def dump(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 4) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 4),
+            "p95_ms": round(self.percentile(95), 4),
+            "p99_ms": round(self.percentile(99), 4),
+            "max_ms": round(self.max_ms, 4),
+            # Non-empty buckets only, keyed by upper bound
+            "buckets": {
+                (f"{self.BOUNDS_MS[i]:.4g}" if i < len(self.BOUNDS_MS) else "inf"): n
+                for i, n in enumerate(self.counts) if n
+            },
+        }
+
+
+class ShadowEvaluator:
+    """Runs a candidate intent model next to the live one on real messages.
+
+    submit() is called on the request path after the live model answered;
+    it only puts the message on a bounded queue and drops it when the queue
+    is full (or outside ``sample_rate``), so shadow work can never slow or
+    block a request. A background thread runs the live and the candidate
+    model on each queued message and records their agreement, the confusion
+    of top labels (live -> candidate) and the latency of both models.
+    """
+
+    def __init__(self, max_queue=256, sample_rate=1.0):
+        self.max_queue = max_queue
+        self.sample_rate = sample_rate
+        self.candidate = None
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.submitted = 0
+            self.dropped = 0
+            self.compared = 0
+            self.agreed = 0
+            self.errors = 0
+            self.confusion = defaultdict(Counter)
+            self.latency = {"live": LatencyHistogram(), "candidate": LatencyHistogram()}
+            self.started_at = time.time()
+
+    def start(self, candidate):
+        """Shadow ``candidate`` from now on, with fresh counters"""
+        self.candidate = candidate
+        self.reset()
+
+    def stop(self):
+        candidate, self.candidate = self.candidate, None
+        return candidate
+
+    def submit(self, text, live):
+        """Queue a message classified by the ``live`` IntentClassifier, if there is room"""
+        if self.candidate is None or random.random() >= self.sample_rate:
+            return
+        self.submitted += 1
+        try:
+            self._ensure_started().put_nowait((text, live))
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_started(self):
+        """Start the worker once per process (threads do not survive a fork)"""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._queue = queue.Queue(maxsize=self.max_queue)
+                    self._pid = pid
+                    threading.Thread(target=self._run, args=(self._queue,),
+                                     name="intent-shadow", daemon=True).start()
+        return self._queue
+
+    def _run(self, pending_queue):
+        while True:
+            text, live = pending_queue.get()
+            candidate = self.candidate
+            if candidate is None:
+                continue
+            try:
+                self._compare(text, live, candidate)
+            except Exception as e:
+                self.errors += 1
+                print(f"[ERROR] Shadow classification failed: {e}")
+
+    def _compare(self, text, live, candidate):
+        start = time.perf_counter()
+        live_labels = live.labels_for(live.predict_rows([text])[0])
+        live_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        candidate_labels = candidate.labels_for(candidate.predict_rows([text])[0])
+        candidate_seconds = time.perf_counter() - start
+        with self._lock:
+            self.compared += 1
+            self.agreed += live_labels == candidate_labels
+            live_top = live_labels[0] if live_labels else "none"
+            self.confusion[live_top][candidate_labels[0] if candidate_labels else "none"] += 1
+            self.latency["live"].add(live_seconds)
+            self.latency["candidate"].add(candidate_seconds)
+
+    def dump(self):
+        with self._lock:
+            return {
+                "candidate": self.candidate.version if self.candidate else None,
+                "since": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+                "sample_rate": self.sample_rate,
+                "submitted": self.submitted,
+                "dropped": self.dropped,
+                "compared": self.compared,
+                "errors": self.errors,
+                "agreement": round(self.agreed / self.compared, 4) if self.compared else None,
+                "confusion": {live: dict(counts) for live, counts in self.confusion.items()},
+                "latency": {name: histogram.dump() for name, histogram in self.latency.items()},
+            }
@@ -0,0 +1,231 @@
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURE_FILE = Path(__file__).resolve().parent.parent / "node_data" / "upstream_fixture.json"
+
+# Endpoints are matched on the last path segment, so any BILLING_API_BASE_URL prefix works
+ENDPOINTS = ("GetAccountBalance", "GetAccountNumber", "chat")
+
+
+class Behaviour:
+    """Latency, errors and hangs injected into the replies of one endpoint.
+
+    Each request waits a delay drawn from ``distribution`` around
+    ``latency_ms`` (``spread`` is the relative half-width for "uniform" and
+    the sigma for "lognormal", whose median is ``latency_ms``). A share
+    ``error_rate`` of requests answers ``error_status``, and ``timeout_rate``
+    never answers: the connection is held for ``hang_seconds`` and closed.
+    """
+
+    DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+    def __init__(self, latency_ms=0.0, distribution="fixed", spread=0.5, error_rate=0.0,
+                 error_status=503, timeout_rate=0.0, hang_seconds=30.0):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {distribution!r}, expected one of {self.DISTRIBUTIONS}")
+        self.latency_ms = float(latency_ms)
+        self.distribution = distribution
+        self.spread = float(spread)
+        self.error_rate = float(error_rate)
+        self.error_status = int(error_status)
+        self.timeout_rate = float(timeout_rate)
+        self.hang_seconds = float(hang_seconds)
+
+    def updated(self, **changes):
+        """A copy with the given settings changed (None leaves a setting as is)"""
+        config = self.config()
+        config.update((key, value) for key, value in changes.items() if value is not None)
+        return Behaviour(**config)
+
+    def delay(self, rng):
+        """Seconds to wait before answering"""
+        if self.latency_ms <= 0:
+            return 0.0
+        if self.distribution == "uniform":
+            ms = rng.uniform(self.latency_ms * (1 - self.spread), self.latency_ms * (1 + self.spread))
+        elif self.distribution == "exponential":
+            ms = rng.expovariate(1 / self.latency_ms)
+        elif self.distribution == "lognormal":
+            ms = self.latency_ms * math.exp(rng.gauss(0, self.spread))
+        else:
+            ms = self.latency_ms
+        return max(ms, 0.0) / 1000
+
+    def outcome(self, rng):
+        """Draw "timeout", "error" or "ok" for the next request"""
+        draw = rng.random()
+        if draw < self.timeout_rate:
+            return "timeout"
+        if draw < self.timeout_rate + self.error_rate:
+            return "error"
+        return "ok"
+
+    def config(self):
+        return {
+            "latency_ms": self.latency_ms,
+            "distribution": self.distribution,
+            "spread": self.spread,
+            "error_rate": self.error_rate,
+            "error_status": self.error_status,
+            "timeout_rate": self.timeout_rate,
+            "hang_seconds": self.hang_seconds,
+        }
+
+
+class StubUpstreams:
+    """The billing API and the solar chat service, answered from a fixture dataset.
+
+    The fixture holds "accounts" ({account: balance}), "contacts"
+    ({contact: account}), "chat" answers ([{"keywords", "response"}]) with a
+    "chat_default", and "behaviour" per endpoint with a "default" for the
+    rest. ``generate`` adds that many synthetic accounts 9000000000... with
+    contacts 0700000000..., so load tests can spread over many numbers.
+    """
+
+    def __init__(self, fixture, behaviour=None, generate=0, seed=None):
+        self.accounts = {str(number): float(balance) for number, balance in fixture.get("accounts", {}).items()}
+        self.contacts = {str(number): str(account) for number, account in fixture.get("contacts", {}).items()}
+        self.chat_answers = [(tuple(word.lower() for word in answer["keywords"]), answer["response"])
+                             for answer in fixture.get("chat", [])]
+        self.chat_default = fixture.get("chat_default", "I'm sorry, I don't have information about that.")
+        rng = random.Random(seed)
+        for i in range(generate):
+            account = f"{9000000000 + i}"
+            self.accounts[account] = round(rng.uniform(0, 20000), 2)
+            self.contacts[f"{700000000 + i:010d}"] = account
+
+        configured = fixture.get("behaviour", {})
+        default = Behaviour(**configured.get("default", {}))
+        self.behaviours = {
+            endpoint: default.updated(**configured.get(endpoint, {})) for endpoint in ENDPOINTS
+        }
+        if behaviour:
+            self.update_behaviour(**behaviour)
+        self.requests = Counter()
+        self.outcomes = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path=FIXTURE_FILE, **options):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f), **options)
+
+    def update_behaviour(self, endpoint=None, **changes):
+        """Change the behaviour of one endpoint, or of all of them"""
+        for name in ([endpoint] if endpoint else ENDPOINTS):
+            if name not in self.behaviours:
+                raise ValueError(f"Unknown endpoint {name!r}, expected one of {ENDPOINTS}")
+            self.behaviours[name] = self.behaviours[name].updated(**changes)
+
+    def plan(self, endpoint):
+        """(outcome, delay in seconds) of the next request to an endpoint"""
+        behaviour = self.behaviours[endpoint]
+        with self._lock:
+            outcome = behaviour.outcome(self._rng)
+            delay = behaviour.hang_seconds if outcome == "timeout" else behaviour.delay(self._rng)
+            self.requests[endpoint] += 1
+            self.outcomes[outcome] += 1
+        return outcome, delay, behaviour
+
+    def balance(self, account_number):
+        """GetAccountBalance reply: YES,<balance> or NO"""
+        balance = self.accounts.get(account_number or "")
+        return "NO" if balance is None else f"YES,{balance:.2f}"
+
+    def account_for(self, contact_number):
+        """GetAccountNumber reply: the account of a contact number, or an empty body"""
+        return self.contacts.get(contact_number or "", "")
+
+    def chat(self, question):
+        """/chat/ reply: the first answer whose keywords occur in the question"""
+        question = (question or "").lower()
+        for keywords, response in self.chat_answers:
+            if any(word in question for word in keywords):
+                return {"response": response}
+        return {"response": self.chat_default}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "accounts": len(self.accounts),
+                "contacts": len(self.contacts),
+                "requests": dict(self.requests),
+                "outcomes": dict(self.outcomes),
+                "behaviour": {endpoint: behaviour.config() for endpoint, behaviour in self.behaviours.items()},
+            }
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """Serves the stub endpoints, plus GET /_stub/ (stats) and POST /_stub/ (change behaviour)"""
+
+    protocol_version = "HTTP/1.1"
+    stubs = None  # set on the subclass make_server() builds
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        endpoint = url.path.rstrip("/").rsplit("/", 1)[-1]
+        if endpoint == "_stub":
+            return self._reply(200, self.stubs.stats())
+        if endpoint == "GetAccountBalance":
+            return self._serve(endpoint, lambda: self.stubs.balance(query.get("accountNumber")))
+        if endpoint == "GetAccountNumber":
+            return self._serve(endpoint, lambda: self.stubs.account_for(query.get("contactNumber")))
+        self._reply(404, "Not Found")
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        except ValueError:
+            return self._reply(400, {"detail": "Invalid JSON body"})
+        endpoint = urlsplit(self.path).path.rstrip("/").rsplit("/", 1)[-1]
+        if endpoint == "_stub":
+            try:
+                self.stubs.update_behaviour(**body)
+            except (TypeError, ValueError) as e:
+                return self._reply(400, {"detail": str(e)})
+            return self._reply(200, self.stubs.stats())
+        if endpoint == "chat":
+            return self._serve(endpoint, lambda: self.stubs.chat(body.get("question")))
+        self._reply(404, "Not Found")
+
+    def _serve(self, endpoint, answer):
+        outcome, delay, behaviour = self.stubs.plan(endpoint)
+        time.sleep(delay)
+        if outcome == "timeout":
+            # Never answer; the client's read timeout fires first
+            self.close_connection = True
+            return
+        if outcome == "error":
+            return self._reply(behaviour.error_status, "Service Unavailable")
+        self._reply(200, answer())
+
+    def _reply(self, status, payload):
+        if isinstance(payload, str):
+            body, content_type = payload.encode("utf-8"), "text/plain; charset=utf-8"
+        else:
+            body, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(stubs, host="127.0.0.1", port=8080):
+    """A threaded HTTP server answering from ``stubs``; call serve_forever() on it"""
+    handler = type("BoundStubRequestHandler", (StubRequestHandler,), {"stubs": stubs})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
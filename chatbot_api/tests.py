@@ -1,3 +1,1783 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import os
+import queue
+import tempfile
+import threading
+from unittest import mock
+import httpx
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from pymongo.errors import AutoReconnect, BulkWriteError, ServerSelectionTimeoutError
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.feature_extraction.text import TfidfVectorizer
+from asgiref.sync import sync_to_async
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from .chat_history import ArchiveQueue, ExpirySweeper, archive_sessions, build_archive
+from .circuit import CircuitBreaker, CircuitOpenError, circuit_breakers
+from .classifier import InferenceBatcher, IntentClassifier, ModelRegistry
+from . import engine
+from .engine import advance
+from .features import CompactVectorizer
+from .forest import CompiledForest
+from .intent_cache import PredictionCache, normalize_text
+from .keywords import KeywordMatcher
+from .lookup_cache import LookupCache, billing_cache
+from .models import ChatSession, ChatTurn
+from .responses import response_json
+from .session_store import CacheSessionStore, MemorySessionStore, OrmSessionStore, SessionConflict
+from .shadow import LatencyHistogram, ShadowEvaluator
+from .stub_upstream import StubUpstreams, make_server
+from .training import labelled_turns
+from .tree import conversation_graph, node_body
+from .upstream import billing_url, get_session
+from .utils import GREETING_REPLY
+from node_data.handlers.bill_inquiries import BillInquiriesHandler
+from node_data.handlers.fault_reporting import FaultReportingHandler
 
-# Create your tests here.
+
+def writes(queries):
+    """The INSERT and UPDATE statements among captured queries"""
+    return [query["sql"] for query in queries if query["sql"].lstrip().upper().startswith(("INSERT", "UPDATE"))]
+
+
+class ChatSessionFlushTests(TestCase):
+    def setUp(self):
+        self.chat_session = ChatSession.objects.create(session_id="s1", mistake_count=0)
+
+    def test_unchanged_session_is_not_written(self):
+        with self.assertNumQueries(0):
+            self.assertFalse(self.chat_session.flush())
+        self.assertEqual(ChatSession.flush_many([self.chat_session]), [])
+
+    def test_changed_fields_are_the_tracked_fields_that_differ(self):
+        self.assertEqual(self.chat_session.changed_fields(), [])
+        self.chat_session.state = "english_start"
+        self.chat_session.selected_language = "English"
+        self.assertEqual(self.chat_session.changed_fields(), ["state", "selected_language"])
+        self.chat_session.state = "start"
+        self.assertEqual(self.chat_session.changed_fields(), ["selected_language"])
+
+    def test_update_covers_only_changed_fields(self):
+        self.chat_session.state = "english_start"
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.chat_session.flush())
+        updates = [sql for sql in writes(queries) if sql.startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        assigned = updates[0].split(" SET ", 1)[1].split(" WHERE ", 1)[0]
+        self.assertIn('"state"', assigned)
+        self.assertIn('"updated_at"', assigned)
+        for name in ("mistake_count", "selected_language", "turn_count", "session_id", "created_at"):
+            self.assertNotIn(f'"{name}"', assigned)
+        self.assertEqual(self.chat_session.changed_fields(), [])
+
+    def test_turns_and_fields_written_with_one_insert_and_one_update(self):
+        self.chat_session.add_turn("English", "Hi, how can I help you today?")
+        self.chat_session.add_turn("my bill", "Please select an option:")
+        self.chat_session.state = "bill_inquiries"
+        with CaptureQueriesContext(connection) as queries:
+            self.chat_session.flush()
+        statements = writes(queries)
+        self.assertEqual([sql.split()[0] for sql in statements], ["INSERT", "UPDATE"])
+        self.assertIn("chatbot_api_chatturn", statements[0])
+        self.assertEqual(
+            list(ChatTurn.objects.filter(session=self.chat_session).values_list("sequence", "user_text")),
+            [(1, "English"), (2, "my bill")],
+        )
+        self.chat_session.refresh_from_db()
+        self.assertEqual((self.chat_session.turn_count, self.chat_session.state), (2, "bill_inquiries"))
+
+    def test_failed_update_rolls_back_the_turns(self):
+        self.chat_session.add_turn("English", "Hi, how can I help you today?")
+        self.chat_session.state = "english_start"
+        with mock.patch("django.db.models.query.QuerySet.update", side_effect=RuntimeError("db down")):
+            with self.assertRaises(RuntimeError):
+                self.chat_session.flush()
+        # Same atomic block: the inserted turn is gone and stays pending
+        self.assertFalse(ChatTurn.objects.exists())
+        self.assertEqual(self.chat_session.turn_count, 0)
+        self.assertEqual(len(self.chat_session.pending_turns), 1)
+        self.chat_session.flush()
+        self.assertEqual(ChatTurn.objects.get().sequence, 1)
+
+    def test_flush_many_writes_only_dirty_sessions_in_bulk(self):
+        clean = ChatSession.objects.create(session_id="s2", mistake_count=0)
+        other = ChatSession.objects.create(session_id="s3", mistake_count=0)
+        self.chat_session.state = "english_start"
+        other.add_turn("Sinhala", "කරුණාකර විකල්පයක් තෝරන්න:")
+        other.selected_language = "Sinhala"
+        with CaptureQueriesContext(connection) as queries:
+            written = ChatSession.flush_many([self.chat_session, clean, other])
+        self.assertEqual(written, [self.chat_session, other])
+        self.assertEqual([sql.split()[0] for sql in writes(queries)], ["INSERT", "UPDATE"])
+        self.assertEqual(ChatTurn.objects.get().session, other)
+
+
+class FakeCollection:
+    """insert_many into a dict, reporting duplicate _ids the way Mongo does"""
+
+    def __init__(self):
+        self.documents = {}
+
+    def insert_many(self, documents, ordered=True):
+        errors = []
+        for index, document in enumerate(documents):
+            if document["_id"] in self.documents:
+                errors.append({"index": index, "code": 11000, "errmsg": "E11000 duplicate key error"})
+            else:
+                self.documents[document["_id"]] = document
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [], "nInserted": len(documents) - len(errors)})
+
+
+class FlakyCollection(FakeCollection):
+    """A FakeCollection that is unreachable on the calls numbered in ``failing`` (from 1).
+
+    With ``lose_ack`` a failing call stores the documents before it fails,
+    as when Mongo wrote them but the reply never arrived.
+    """
+
+    def __init__(self, failing=(), lose_ack=False):
+        super().__init__()
+        self.failing = failing
+        self.lose_ack = lose_ack
+        self.calls = 0
+
+    def insert_many(self, documents, ordered=True):
+        self.calls += 1
+        if self.calls in self.failing:
+            if self.lose_ack:
+                super().insert_many(documents, ordered)
+                raise AutoReconnect("connection closed")
+            raise ServerSelectionTimeoutError("No servers found")
+        super().insert_many(documents, ordered)
+
+
+class ArchiveQueueTests(SimpleTestCase):
+    """Transcripts reach Mongo once, through retries, the journal and its replay"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal = os.path.join(directory.name, "archive_journal.jsonl")
+        self.sleep = mock.patch("chatbot_api.chat_history.time").start().sleep
+        mock.patch("chatbot_api.chat_history.random.uniform", return_value=1.0).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def archive(self, collection, **options):
+        mock.patch("chatbot_api.chat_history.get_collection", return_value=collection).start()
+        archive = ArchiveQueue(self.journal, **{"retries": 3, "backoff": 0.5, "max_backoff": 8.0, **options})
+        self.addCleanup(archive.close)
+        return archive
+
+    def documents(self, count, first=1):
+        started = datetime.datetime(2026, 10, 1, 9, 30)
+        return [{"_id": f"{pk}:{started.isoformat()}", "session_id": f"s{pk}", "session_start": started}
+                for pk in range(first, first + count)]
+
+    def journaled(self):
+        if not os.path.exists(self.journal):
+            return []
+        with open(self.journal, encoding="utf-8") as f:
+            return [line for line in f if line.strip()]
+
+    def wait_for(self, condition, message):
+        for _ in range(500):
+            if condition():
+                return
+            threading.Event().wait(0.01)
+        self.fail(message)
+
+    def test_failed_inserts_are_retried_with_backoff(self):
+        collection = FlakyCollection(failing=range(1, 4))
+        archive = self.archive(collection, retries=5, max_backoff=1.5)
+        self.assertTrue(archive._insert(self.documents(2)))
+        self.assertEqual([call.args[0] for call in self.sleep.call_args_list], [0.5, 1.0, 1.5])
+        self.assertEqual((collection.calls, len(collection.documents)), (4, 2))
+
+    def test_unreachable_mongo_spills_to_the_journal(self):
+        collection = FlakyCollection(failing=range(1, 1000))
+        archive = self.archive(collection)
+        self.assertFalse(archive._insert(self.documents(1)))
+        self.assertEqual(collection.calls, 3)
+        for document in self.documents(2):
+            archive.enqueue(document)
+        self.wait_for(lambda: len(self.journaled()) == 2, "The failed batch was not journaled")
+        self.assertEqual(collection.documents, {})
+
+    def test_full_queue_spills_to_the_journal(self):
+        archive = self.archive(FakeCollection(), max_size=1)
+        with mock.patch.object(archive, "ensure_started"):
+            for document in self.documents(3):
+                archive.enqueue(document)
+        self.assertEqual(len(self.journaled()), 2)
+        archive.close()
+        self.assertEqual(len(self.journaled()), 3)
+
+    def test_journal_is_replayed_on_startup_and_removed(self):
+        self.archive(FlakyCollection(failing=range(1, 1000))).spill(self.documents(3))
+        collection = FakeCollection()
+        archive = self.archive(collection)
+        archive.ensure_started()
+        self.wait_for(lambda: len(collection.documents) == 3, "The journal was not replayed")
+        self.wait_for(lambda: not os.path.exists(self.journal), "The replayed journal was kept")
+        self.assertEqual(collection.documents["1:2026-10-01T09:30:00"]["session_start"],
+                         datetime.datetime(2026, 10, 1, 9, 30))
+        self.assertEqual(os.listdir(os.path.dirname(self.journal)), [])
+
+    def test_replay_journals_what_still_fails(self):
+        # The first batch is stored, then Mongo goes away
+        collection = FlakyCollection(failing=range(2, 1000))
+        archive = self.archive(collection, batch_size=2)
+        archive.spill(self.documents(5))
+        self.assertEqual(archive.replay(), 2)
+        self.assertEqual(len(collection.documents), 2)
+        self.assertEqual(len(self.journaled()), 3)
+        collection.failing = ()
+        self.assertEqual(archive.replay(), 3)
+        self.assertEqual((len(collection.documents), self.journaled()), (5, []))
+
+    def test_documents_are_stored_once(self):
+        collection = FlakyCollection(failing={1}, lose_ack=True)
+        archive = self.archive(collection)
+        documents = self.documents(3)
+        # The first attempt stored the batch but failed; the retry only finds duplicates
+        self.assertTrue(archive._insert(documents))
+        self.assertEqual(collection.calls, 2)
+        # A journal holding transcripts Mongo already has, plus a new one
+        archive.spill(documents[:2] + self.documents(1, first=4))
+        self.assertEqual(archive.replay(), 3)
+        self.assertEqual(sorted(collection.documents), [document["_id"] for document in self.documents(4)])
+        self.assertEqual(self.journaled(), [])
+
+
+class ExpirySweeperTests(TestCase):
+    def test_overlapping_sweeps_archive_each_session_once(self):
+        expired_at = datetime.datetime.now(datetime.timezone.utc) - ChatSession.SESSION_TIMEOUT * 2
+        for session_id in ("s1", "s2"):
+            chat_session = ChatSession.objects.create(session_id=session_id, mistake_count=0)
+            chat_session.add_turn("English", "Hi, how can I help you today?")
+            chat_session.flush()
+        ChatSession.objects.update(updated_at=expired_at)
+        collection = FakeCollection()
+        sessions = list(ChatSession.objects.order_by("pk"))
+        with mock.patch("chatbot_api.chat_history.get_collection", return_value=collection):
+            # Another worker archived s1 but had not deleted it yet
+            archive_sessions(sessions[:1])
+            self.assertEqual(ExpirySweeper().sweep(), 2)
+        self.assertEqual(sorted(document["session_id"] for document in collection.documents.values()), ["s1", "s2"])
+        self.assertEqual(ChatSession.objects.count(), 0)
+
+
+class OrmSessionStoreTests(TestCase):
+    def test_checkout_creates_and_checkin_writes(self):
+        store = OrmSessionStore()
+        chat_session, created = store.checkout("s1")
+        self.assertTrue(created)
+        chat_session.state = "english_start"
+        store.checkin(chat_session)
+        self.assertEqual(ChatSession.objects.get(session_id="s1").state, "english_start")
+
+    def test_failed_turn_is_not_written(self):
+        store = OrmSessionStore()
+        chat_session, _ = store.checkout("s1")
+        chat_session.state = "english_start"
+        store.checkin(chat_session, commit=False)
+        self.assertEqual(ChatSession.objects.get(session_id="s1").state, "start")
+
+
+class MemorySessionStoreTests(TestCase):
+    def setUp(self):
+        self.store = MemorySessionStore(max_size=2, ttl=300, flush_interval=60)
+        # No write-behind thread; the tests call flush() themselves
+        self.store._flusher_pid = os.getpid()
+
+    def turn(self, session_id, state, commit=True):
+        chat_session, created = self.store.checkout(session_id)
+        chat_session.state = state
+        self.store.checkin(chat_session, commit)
+        return chat_session, created
+
+    def test_checkin_holds_writes_until_flush(self):
+        self.turn("s1", "english_start")
+        self.assertEqual(ChatSession.objects.get(session_id="s1").state, "start")
+        with self.assertNumQueries(0):
+            chat_session, created = self.store.checkout("s1")
+        self.assertFalse(created)
+        self.assertEqual(chat_session.state, "english_start")
+        self.store.checkin(chat_session)
+        self.store.flush()
+        self.assertEqual(ChatSession.objects.get(session_id="s1").state, "english_start")
+        with self.assertNumQueries(0):
+            self.store.flush()
+
+    def test_failed_turn_on_clean_session_reloads_stored_state(self):
+        self.turn("s1", "english_start")
+        self.store.flush()
+        self.turn("s1", "sinhala_start", commit=False)
+        chat_session, _ = self.store.checkout("s1")
+        self.assertEqual(chat_session.state, "english_start")
+        self.store.checkin(chat_session)
+
+    def test_overflow_evicts_least_recent_after_writing_it(self):
+        self.turn("s1", "english_start")
+        self.turn("s2", "english_start")
+        self.turn("s3", "english_start")
+        self.assertEqual(list(self.store._entries), ["s2", "s3"])
+        self.assertEqual(ChatSession.objects.get(session_id="s1").state, "english_start")
+        self.assertEqual(self.store._dirty, {"s2", "s3"})
+
+    def test_idle_sessions_are_written_and_dropped(self):
+        self.turn("s1", "english_start")
+        self.store.ttl = 0
+        self.store._evict_idle()
+        self.assertEqual(len(self.store._entries), 0)
+        self.assertEqual(ChatSession.objects.get(session_id="s1").state, "english_start")
+
+    def test_checkout_waits_for_the_turn_holding_the_session(self):
+        chat_session, _ = self.store.checkout("s1")
+        acquired = threading.Event()
+        waiter = threading.Thread(target=lambda: (self.store._acquire("s1"), acquired.set()))
+        waiter.start()
+        self.assertFalse(acquired.wait(0.1))
+        self.store.checkin(chat_session)
+        self.assertTrue(acquired.wait(5))
+        waiter.join()
+
+
+class CacheSessionStoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.store = CacheSessionStore(alias="default", timeout=300, lease=60, wait=0.05)
+
+    def test_checkin_writes_through_and_caches(self):
+        chat_session, created = self.store.checkout("s1")
+        self.assertTrue(created)
+        chat_session.state = "start"
+        self.store.checkin(chat_session)
+        self.assertEqual(ChatSession.objects.get(session_id="s1").state, "start")
+        with self.assertNumQueries(0):
+            chat_session, created = self.store.checkout("s1")
+        self.assertEqual((chat_session.state, created), ("start", False))
+        self.store.checkin(chat_session, commit=False)
+        self.assertIsNone(cache.get(self.store.key("s1")))
+
+    def test_second_checkout_waits_for_the_lease(self):
+        chat_session, _ = self.store.checkout("s1")
+        with self.assertRaises(SessionConflict):
+            self.store.checkout("s1")
+        self.store.checkin(chat_session)
+        other, _ = self.store.checkout("s1")
+        self.store.checkin(other)
+
+    def test_turn_that_outlived_its_lease_is_not_stored(self):
+        stale, _ = self.store.checkout("s1")
+        # The lease expires and another turn checks the session out and in
+        cache.delete(self.store.lock_key("s1"))
+        self.store._leases["s1"], lease = None, self.store._leases["s1"]
+        fresh, _ = self.store.checkout("s1")
+        fresh.state = "english_start"
+        self.store.checkin(fresh)
+        self.store._leases["s1"] = lease
+
+        stale.state = "sinhala_start"
+        with self.assertRaises(SessionConflict):
+            self.store.checkin(stale)
+        self.assertEqual(ChatSession.objects.get(session_id="s1").state, "english_start")
+        self.assertEqual(cache.get(self.store.key("s1"))[1].state, "english_start")
+
+
+CORPUS = [
+    ("my bill is too high this month", "bill", "urgent"),
+    ("how much is my electricity bill", "bill", "normal"),
+    ("I want to pay my bill online", "bill", "normal"),
+    ("bill amount looks wrong please check", "bill", "urgent"),
+    ("there is a power cut in my area", "fault", "urgent"),
+    ("no electricity since morning", "fault", "urgent"),
+    ("the street light is not working", "fault", "normal"),
+    ("sparks coming from the meter", "fault", "urgent"),
+    ("how do I get solar panels installed", "solar", "normal"),
+    ("solar net metering application status", "solar", "normal"),
+    ("my solar inverter shows an error", "solar", "urgent"),
+    ("solar payment not received this month", "solar", "urgent"),
+    ("apply for a new connection", "connection", "normal"),
+    ("new connection for my house please", "connection", "normal"),
+    ("connection request pending for weeks", "connection", "urgent"),
+    ("change the name on my account", "other", "normal"),
+]
+
+
+class CompiledForestTests(SimpleTestCase):
+    """The compiled forest answers exactly what the sklearn forest does"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        texts = [text for text, _, _ in CORPUS]
+        cls.vectorizer = TfidfVectorizer(ngram_range=(1, 2)).fit(texts)
+        cls.X_train = cls.vectorizer.transform(texts)
+        cls.labels = np.array([(intent, priority) for _, intent, priority in CORPUS])
+        probes = texts + ["bill solar", "power cut new connection", "", "qwerty zxcvb", "check meter status"]
+        cls.X = cls.vectorizer.transform(probes)
+
+    def assert_same(self, forest, X):
+        compiled = CompiledForest.from_sklearn(forest)
+        np.testing.assert_array_equal(compiled.predict(X), forest.predict(X))
+        expected = forest.predict_proba(X)
+        actual = compiled.predict_proba(X)
+        if forest.n_outputs_ == 1:
+            np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-12)
+        else:
+            for k, proba in enumerate(expected):
+                np.testing.assert_allclose(actual[:, k, :proba.shape[1]], proba, rtol=0, atol=1e-12)
+                self.assertFalse(actual[:, k, proba.shape[1]:].any())
+        self.assertEqual(compiled.mismatches(forest, X), 0)
+
+    def test_all_zero_rows_are_in_the_probes(self):
+        self.assertGreaterEqual(int((self.X.getnnz(axis=1) == 0).sum()), 2)
+
+    def test_single_output(self):
+        forest = RandomForestClassifier(n_estimators=25, random_state=0).fit(self.X_train, self.labels[:, 0])
+        self.assert_same(forest, self.X)
+
+    def test_multi_output_with_different_class_counts(self):
+        forest = RandomForestClassifier(n_estimators=25, random_state=0).fit(self.X_train, self.labels)
+        self.assertEqual([len(classes) for classes in forest.classes_], [5, 2])
+        self.assert_same(forest, self.X)
+
+    def test_saved_arrays_answer_the_same(self):
+        forest = RandomForestClassifier(n_estimators=10, max_depth=3, random_state=1).fit(self.X_train, self.labels)
+        compiled = CompiledForest.from_sklearn(forest)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "forest.compiled")
+            compiled.save(path, source="v1")
+            self.assertIsNone(CompiledForest.load(path, source="v2"))
+            loaded = CompiledForest.load(path, source="v1")
+            np.testing.assert_array_equal(loaded.predict(self.X), forest.predict(self.X))
+            del loaded
+
+
+class CompactVectorizerTests(SimpleTestCase):
+    """The compact vectorizer builds exactly the matrix of the TfidfVectorizer it came from"""
+
+    TEXTS = [text for text, _, _ in CORPUS] + [
+        "මගේ බිල්පත ගැන විමසීමක්", "என் மின் கட்டணம் அதிகம்", "Bill BILL bill!!", "solar-panel, new_connection",
+    ]
+    PROBES = TEXTS + ["", "a I", "zzz unknown words", "bill bill bill bill", "BILL Solar Metering", "බිල්පත bill"]
+
+    def assert_same(self, **options):
+        vectorizer = TfidfVectorizer(**options).fit(self.TEXTS)
+        compact = CompactVectorizer.from_tfidf(vectorizer)
+        expected = vectorizer.transform(self.PROBES)
+        actual = compact.transform(self.PROBES)
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertEqual((actual != expected).nnz, 0, options)
+        return compact
+
+    def test_default_options(self):
+        self.assert_same()
+
+    def test_ngrams_stop_words_and_sublinear_tf(self):
+        self.assert_same(ngram_range=(1, 3), stop_words="english", sublinear_tf=True)
+        self.assert_same(ngram_range=(2, 2))
+
+    def test_norms_and_case(self):
+        for options in ({"norm": "l1"}, {"norm": None}, {"lowercase": False}, {"smooth_idf": False}):
+            self.assert_same(**options)
+
+    def test_saved_arrays_give_the_same_matrix(self):
+        compact = self.assert_same(ngram_range=(1, 2))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "vectorizer.compact")
+            compact.save(path, source="v1")
+            loaded = CompactVectorizer.load(path, source="v1")
+            self.assertEqual((loaded.transform(self.PROBES) != compact.transform(self.PROBES)).nnz, 0)
+            del loaded
+
+    def test_other_analyzers_are_refused(self):
+        for options in ({"analyzer": "char"}, {"binary": True}, {"use_idf": False}, {"strip_accents": "unicode"}):
+            with self.assertRaises(ValueError):
+                CompactVectorizer.from_tfidf(TfidfVectorizer(**options).fit(self.TEXTS))
+
+
+class KeywordMatcherTests(SimpleTestCase):
+    KEYWORDS = {
+        "greetings": ["hi", "hello"],
+        "Bill Inquiries": ["bill", "electricity bill", "bill payment"],
+        "Fault Reporting": ["power cut", "no electricity", "he"],
+        "Solar Services": ["solar", "solar panel", "she"],
+    }
+
+    def setUp(self):
+        self.matcher = KeywordMatcher(self.KEYWORDS)
+
+    def test_only_whole_words_match(self):
+        self.assertEqual(self.matcher.matches("this is shipping"), set())
+        self.assertEqual(self.matcher.matches("billing question"), set())
+        self.assertEqual(self.matcher.matches("power cutter"), set())
+        self.assertEqual(self.matcher.matches("Hi!"), {"greetings"})
+        self.assertEqual(self.matcher.matches("there is a POWER   cut, again"), {"Fault Reporting"})
+
+    def test_overlapping_keywords(self):
+        # "solar panel" contains "solar"; "bill payment" starts where "electricity bill" ends
+        self.assertEqual(self.matcher.classify("solar panel broken"), "Solar Services")
+        self.assertEqual(self.matcher.classify("electricity bill payment"), "Bill Inquiries")
+        # "he" ends inside "she", reached through a failure link, but is not a whole word there
+        self.assertEqual(self.matcher.matches("she"), {"Solar Services"})
+        self.assertEqual(self.matcher.matches("he said she"), {"Fault Reporting", "Solar Services"})
+
+    def test_several_categories_are_ambiguous(self):
+        self.assertIsNone(self.matcher.classify("no electricity and my bill"))
+        self.assertIsNone(self.matcher.classify("nothing known here"))
+        self.assertEqual(self.matcher.classify("hello"), "greetings")
+        self.assertEqual(
+            {key: self.matcher.stats()[key] for key in ("hits", "ambiguous", "misses")},
+            {"hits": 1, "ambiguous": 1, "misses": 1},
+        )
+
+    def test_ambiguous_and_unmatched_messages_go_to_the_model(self):
+        labels = ("greetings", "Bill Inquiries", "Fault Reporting")
+        vectorizer = mock.Mock(transform=lambda texts: texts)
+        model = mock.Mock()
+        model.predict.side_effect = lambda texts: [(0, 0, 1) for _ in texts]
+        classifier = IntentClassifier(vectorizer, model, labels=labels, keywords=self.matcher)
+        try:
+            results = classifier.classify_many(
+                ["my bill please", "no electricity and my bill", "solar panel", "what now"]
+            )
+        finally:
+            classifier.close()
+        # Keyword hit; ambiguous; category outside the labels; no keyword
+        self.assertEqual(results, [["Bill Inquiries"], ["Fault Reporting"], ["Fault Reporting"], ["Fault Reporting"]])
+        model.predict.assert_called_once_with(["no electricity and my bill", "solar panel", "what now"])
+
+
+class InferenceBatcherTests(SimpleTestCase):
+    """Messages from many threads are classified together, and every caller gets an answer"""
+
+    def predict_all(self, batcher, texts):
+        """predict() each text from its own thread; returns text -> row or exception"""
+        results = {}
+
+        def predict(text):
+            try:
+                results[text] = batcher.predict(text)
+            except Exception as e:
+                results[text] = e
+
+        threads = [threading.Thread(target=predict, args=(text,)) for text in texts]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def wait_queued(self, batcher, count):
+        for _ in range(500):
+            if batcher._queue is not None and batcher._queue.qsize() >= count:
+                return
+            threading.Event().wait(0.01)
+        self.fail(f"{count} messages were never queued")
+
+    def test_concurrent_messages_share_a_batch(self):
+        predict_rows = mock.Mock(side_effect=lambda texts: [(len(text),) for text in texts])
+        batcher = InferenceBatcher(predict_rows, window=5.0, max_batch=4)
+        self.addCleanup(batcher.close)
+        threads, results = self.predict_all(batcher, ["a", "bb", "ccc", "dddd"])
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, {"a": (1,), "bb": (2,), "ccc": (3,), "dddd": (4,)})
+        predict_rows.assert_called_once()
+        self.assertEqual((batcher.batches, batcher.messages), (1, 4))
+
+    def test_a_failed_batch_fails_every_caller(self):
+        error = ValueError("model broke")
+        batcher = InferenceBatcher(mock.Mock(side_effect=error), window=5.0, max_batch=3)
+        self.addCleanup(batcher.close)
+        threads, results = self.predict_all(batcher, ["a", "b", "c"])
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, {"a": error, "b": error, "c": error})
+        # The worker survives the error
+        batcher.predict_rows = lambda texts: [(0,) for _ in texts]
+        batcher.max_batch = 1
+        self.assertEqual(batcher.predict("d"), (0,))
+
+    def test_close_fails_messages_still_queued(self):
+        started, release = threading.Event(), threading.Event()
+
+        def predict_rows(texts):
+            started.set()
+            release.wait(5)
+            return [(1,) for _ in texts]
+
+        batcher = InferenceBatcher(predict_rows, window=0, max_batch=1, timeout=5)
+        busy, busy_results = self.predict_all(batcher, ["first"])
+        started.wait(5)
+        queued, results = self.predict_all(batcher, ["second", "third"])
+        self.wait_queued(batcher, 2)
+        batcher.close()
+        for thread in queued:
+            thread.join(1)
+        self.assertEqual({text: str(result) for text, result in results.items()},
+                         {"second": "Intent batcher closed", "third": "Intent batcher closed"})
+        # The batch already running still completes
+        release.set()
+        busy[0].join(5)
+        self.assertEqual(busy_results, {"first": (1,)})
+        # A later message starts a new worker
+        self.assertEqual(batcher.predict("fourth"), (1,))
+        batcher.close()
+
+
+class LatencyHistogramTests(SimpleTestCase):
+    def test_percentiles_are_bucket_bounds(self):
+        histogram = LatencyHistogram()
+        self.assertEqual((histogram.percentile(50), histogram.dump()["mean_ms"]), (0.0, 0.0))
+        for _ in range(90):
+            histogram.add(0.001)
+        for _ in range(10):
+            histogram.add(0.1)
+        stats = histogram.dump()
+        self.assertEqual((stats["count"], stats["mean_ms"], stats["max_ms"]), (100, 10.9, 100.0))
+        # Accurate to one bucket: at or above the sample, by less than 25%
+        self.assertTrue(1.0 <= stats["p50_ms"] < 1.25, stats)
+        self.assertTrue(100.0 <= stats["p95_ms"] < 125.0, stats)
+        self.assertEqual(sorted(stats["buckets"].values()), [10, 90])
+
+    def test_samples_past_the_last_bound(self):
+        histogram = LatencyHistogram()
+        histogram.add(0.001)
+        histogram.add(60.0)
+        self.assertEqual(histogram.percentile(99), 60000.0)
+        self.assertEqual(histogram.dump()["buckets"]["inf"], 1)
+
+
+class ShadowEvaluatorTests(SimpleTestCase):
+    LABELS = ("bill", "fault")
+
+    def classifier(self, version, rows):
+        """An IntentClassifier predicting ``rows[text]``"""
+        model = mock.Mock()
+        model.predict.side_effect = lambda texts: [rows[text] for text in texts]
+        return IntentClassifier(mock.Mock(transform=lambda texts: texts), model, labels=self.LABELS, version=version)
+
+    def test_a_full_queue_drops_messages_instead_of_blocking(self):
+        shadow = ShadowEvaluator(max_queue=2)
+        live = self.classifier("v1", {})
+        shadow.submit("no candidate yet", live)
+        shadow.start(self.classifier("v2", {}))
+        # No worker drains the queue
+        with mock.patch.object(shadow, "_ensure_started", return_value=queue.Queue(maxsize=2)):
+            for text in ("a", "b", "c", "d", "e"):
+                shadow.submit(text, live)
+        report = shadow.dump()
+        self.assertEqual((report["candidate"], report["submitted"], report["dropped"], report["compared"]),
+                         ("v2", 5, 3, 0))
+
+    def test_sample_rate(self):
+        shadow = ShadowEvaluator(sample_rate=0.25)
+        shadow.start(self.classifier("v2", {}))
+        with mock.patch.object(shadow, "_ensure_started", return_value=queue.Queue()), \
+                mock.patch("chatbot_api.shadow.random.random", side_effect=[0.1, 0.3, 0.2, 0.9]):
+            for text in ("a", "b", "c", "d"):
+                shadow.submit(text, None)
+        self.assertEqual(shadow.submitted, 2)
+
+    def test_agreement_confusion_and_latency(self):
+        live = self.classifier("v1", {"my bill": (1, 0), "power cut": (0, 1), "hello": (0, 0), "bill cut": (1, 0)})
+        candidate = self.classifier("v2", {"my bill": (1, 0), "power cut": (0, 1), "hello": (1, 0), "bill cut": (1, 1)})
+        shadow = ShadowEvaluator()
+        shadow.start(candidate)
+        # Each comparison times the live model (2 ms) and then the candidate (10 ms)
+        with mock.patch("chatbot_api.shadow.time") as clock:
+            clock.perf_counter.side_effect = [0.0, 0.002, 1.0, 1.010] * 4
+            for text in ("my bill", "power cut", "hello", "bill cut"):
+                shadow.submit(text, live)
+            for _ in range(500):
+                if shadow.compared + shadow.errors == 4:
+                    break
+                threading.Event().wait(0.01)
+        report = shadow.dump()
+        self.assertEqual((report["compared"], report["errors"], report["agreement"]), (4, 0, 0.5))
+        self.assertEqual(report["confusion"], {"bill": {"bill": 2}, "fault": {"fault": 1}, "none": {"bill": 1}})
+        self.assertEqual((report["latency"]["live"]["count"], report["latency"]["live"]["mean_ms"]), (4, 2.0))
+        self.assertEqual(report["latency"]["candidate"]["mean_ms"], 10.0)
+        self.assertTrue(10.0 <= report["latency"]["candidate"]["p50_ms"] < 12.5)
+
+    def test_stop_ends_the_comparisons(self):
+        shadow = ShadowEvaluator()
+        candidate = self.classifier("v2", {})
+        shadow.start(candidate)
+        self.assertIs(shadow.stop(), candidate)
+        shadow.submit("my bill", self.classifier("v1", {}))
+        self.assertEqual((shadow.submitted, shadow.dump()["candidate"]), (0, None))
+
+
+class PredictionCacheTests(SimpleTestCase):
+    def test_messages_normalize_alike(self):
+        self.assertEqual(normalize_text("  My BILL,   please!! "), "my bill please")
+        self.assertEqual(normalize_text("account 1234567890"), normalize_text("Account 42."))
+        self.assertEqual(normalize_text("බිල්පත?"), normalize_text("බිල්පත"))
+        self.assertNotEqual(normalize_text("bill"), normalize_text("bills"))
+        cache = PredictionCache()
+        cache.put("My bill, please!", "v1", ("Bill Inquiries",))
+        self.assertEqual(cache.get("my   BILL please", "v1"), ("Bill Inquiries",))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = PredictionCache(max_size=2)
+        cache.put("a", "v1", ("x",))
+        cache.put("b", "v1", ("y",))
+        self.assertEqual(cache.get("a", "v1"), ("x",))
+        cache.put("c", "v1", ("z",))
+        self.assertIsNone(cache.get("b", "v1"))
+        self.assertEqual((cache.get("a", "v1"), cache.get("c", "v1")), (("x",), ("z",)))
+        stats = cache.stats()
+        self.assertEqual((stats["size"], stats["hits"], stats["misses"], stats["hit_rate"]), (2, 3, 1, 0.75))
+
+    def test_new_model_version_empties_the_cache(self):
+        cache = PredictionCache()
+        cache.put("my bill", "v1", ("Bill Inquiries",))
+        cache.put("power cut", "v1", ("Fault Reporting",))
+        self.assertIsNone(cache.get("my bill", "v2"))
+        self.assertEqual(cache.stats()["size"], 0)
+        # Old answers do not come back with the old version either
+        self.assertIsNone(cache.get("power cut", "v1"))
+        cache.put("power cut", "v2", ())
+        self.assertEqual((cache.get("power cut", "v2"), cache.stats()["version"]), ((), "v2"))
+
+
+class IntentClassifierBatchTests(SimpleTestCase):
+    """classify_many() answers each message exactly as classify() does"""
+
+    LABELS = ("bill", "fault", "solar", "connection")
+    PROBES = [text for text, _, _ in CORPUS] + [
+        "bill solar", "power cut new connection", "", "qwerty zxcvb", "My BILL!!", "my bill", "solar solar solar",
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        texts = [text for text, _, _ in CORPUS]
+        cls.vectorizer = TfidfVectorizer(ngram_range=(1, 2)).fit(texts)
+        Y = np.array([[intent == label for label in cls.LABELS] for _, intent, _ in CORPUS], dtype=int)
+        cls.forest = RandomForestClassifier(n_estimators=15, random_state=0).fit(cls.vectorizer.transform(texts), Y)
+
+    def classifiers(self):
+        """Fresh sklearn and compiled classifiers, so no answer comes from a shared cache"""
+        sklearn = IntentClassifier(self.vectorizer, self.forest, labels=self.LABELS, version="v1", batch_window=0)
+        compiled = IntentClassifier(CompactVectorizer.from_tfidf(self.vectorizer),
+                                    CompiledForest.from_sklearn(self.forest),
+                                    labels=self.LABELS, version="v1", batch_window=0)
+        for classifier in (sklearn, compiled):
+            self.addCleanup(classifier.close)
+        return sklearn, compiled
+
+    def test_batched_labels_equal_single_row_labels(self):
+        single = [self.classifiers()[0].classify(text) for text in self.PROBES]
+        self.assertTrue(any(single) and not all(single))
+        for classifier in self.classifiers():
+            with self.subTest(model=type(classifier.model).__name__):
+                self.assertEqual(classifier.classify_many(self.PROBES), single)
+                self.assertEqual([classifier.labels_for(row) for row in classifier.predict_rows(self.PROBES)], single)
+                # Now answered from the cache
+                self.assertEqual(classifier.classify_many(self.PROBES), single)
+
+    def test_only_cache_misses_reach_the_model(self):
+        classifier = self.classifiers()[0]
+        classifier.classify("my bill is too high this month")
+        with mock.patch.object(classifier, "predict_rows", wraps=classifier.predict_rows) as predict_rows:
+            classifier.classify_many(["My bill is too high this month!", "no electricity since morning", "my bill"])
+        predict_rows.assert_called_once_with(["no electricity since morning", "my bill"])
+
+    def test_warmup_runs_the_model_without_caching(self):
+        classifier = self.classifiers()[0]
+        with mock.patch.object(classifier, "predict_rows", wraps=classifier.predict_rows) as predict_rows:
+            classifier.warmup()
+        predict_rows.assert_called_once_with(IntentClassifier.WARMUP_MESSAGES)
+        self.assertEqual(classifier.cache.stats()["size"], 0)
+
+
+class ModelRegistryTests(SimpleTestCase):
+    """Versions are loaded, checked and swapped in; other workers follow the manifest"""
+
+    LABELS = ("bill", "fault")
+    SMOKE_SET = [("my bill is too high this month", "bill"), ("there is a power cut in my area", "fault")]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        texts = [text for text, _, _ in CORPUS]
+        cls.vectorizer = TfidfVectorizer().fit(texts)
+        cls.X = cls.vectorizer.transform(texts)
+        cls.Y = np.array([(intent == "bill", intent == "fault") for _, intent, _ in CORPUS], dtype=int)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        for version, seed in (("v1", 0), ("v2", 1), ("v3", 2)):
+            self.publish(version, RandomForestClassifier(n_estimators=5, random_state=seed).fit(self.X, self.Y),
+                         activate=version == "v1")
+
+    def publish(self, version, model, activate=False):
+        writer = ModelRegistry(self.path)
+        writer.publish(version, self.vectorizer, model, labels=self.LABELS, activate=activate)
+
+    def registry(self):
+        registry = ModelRegistry(self.path, smoke_set=self.SMOKE_SET, min_accuracy=0.5, poll_interval=0,
+                                 shadow=ShadowEvaluator(max_queue=4))
+        registry.load()
+        return registry
+
+    def manifest(self, registry):
+        manifest = registry.read_manifest()
+        return manifest["active"], manifest["previous"], manifest.get("shadow")
+
+    def bump_manifest(self, registry):
+        # As a write by another process at a later time would
+        mtime = os.stat(registry.manifest_path).st_mtime_ns + 1_000_000_000
+        os.utime(registry.manifest_path, ns=(mtime, mtime))
+
+    def test_load_serves_the_active_version(self):
+        registry = self.registry()
+        self.assertEqual((registry.active.version, registry.previous), ("v1", None))
+        self.assertEqual(registry.classify("my bill is too high this month"), ["bill"])
+        self.assertEqual(registry.stats()["model_registry"]["available"], ["v1", "v2", "v3"])
+
+    def test_activate_and_rollback(self):
+        registry = self.registry()
+        v1 = registry.active
+        registry.activate("v2")
+        self.assertEqual((registry.active.version, registry.previous), ("v2", v1))
+        self.assertEqual(self.manifest(registry), ("v2", "v1", None))
+        v2 = registry.active
+        registry.rollback()
+        self.assertEqual((registry.active, registry.previous), (v1, v2))
+        self.assertEqual(self.manifest(registry), ("v1", "v2", None))
+        with self.assertRaises(ValueError):
+            registry.activate("v9")
+        self.assertEqual(registry.active, v1)
+
+    def test_dropped_classifier_is_closed_on_the_next_swap(self):
+        registry = self.registry()
+        v1 = registry.active
+        with mock.patch.object(v1, "close") as close:
+            registry.activate("v2")
+            registry.activate("v3")
+            # Out of the registry, but a request that read it before may still use it
+            self.assertNotIn(v1, (registry.active, registry.previous))
+            close.assert_not_called()
+            registry.rollback()
+            close.assert_called_once_with()
+
+    def test_shadow_candidate_is_promoted(self):
+        registry = self.registry()
+        with self.assertRaises(ValueError):
+            registry.start_shadow("v1")
+        registry.start_shadow("v2")
+        candidate = registry.shadow.candidate
+        self.assertEqual(candidate.version, "v2")
+        self.assertEqual(self.manifest(registry), ("v1", None, "v2"))
+        registry.activate("v2")
+        self.assertIs(registry.active, candidate)
+        self.assertIsNone(registry.shadow.candidate)
+        self.assertEqual(self.manifest(registry), ("v2", "v1", None))
+
+    def test_stopped_shadow_is_closed_on_the_next_swap(self):
+        registry = self.registry()
+        registry.start_shadow("v3")
+        candidate = registry.shadow.candidate
+        with mock.patch.object(candidate, "close") as close:
+            registry.stop_shadow()
+            self.assertIsNone(registry.shadow.candidate)
+            self.assertEqual(self.manifest(registry), ("v1", None, None))
+            close.assert_not_called()
+            registry.activate("v2")
+            close.assert_called_once_with()
+
+    def test_refresh_follows_another_process(self):
+        registry, other = self.registry(), self.registry()
+        registry.activate("v2")
+        registry.start_shadow("v3")
+        self.bump_manifest(registry)
+        other.refresh()
+        self.assertEqual((other.active.version, other.previous.version), ("v2", "v1"))
+        self.assertEqual(other.shadow.candidate.version, "v3")
+        # Unchanged manifest: nothing is reloaded
+        with mock.patch.object(other, "load_version") as load_version:
+            other.refresh()
+        load_version.assert_not_called()
+
+    def test_refresh_keeps_serving_when_a_version_fails_its_check(self):
+        registry = self.registry()
+        wrong = RandomForestClassifier(n_estimators=5, random_state=0).fit(self.X, np.c_[self.Y, self.Y[:, :1]])
+        self.publish("v4", wrong, activate=True)
+        self.bump_manifest(registry)
+        registry.refresh()
+        self.assertEqual((registry.active.version, registry.rejected), ("v1", 1))
+        self.assertIn("predicts 3 labels", registry.last_error)
+
+    def test_watcher_polls_the_manifest(self):
+        registry, other = self.registry(), self.registry()
+        registry.activate("v3")
+        self.bump_manifest(registry)
+
+        class StopWatching(Exception):
+            pass
+
+        with mock.patch("chatbot_api.classifier.time.sleep", side_effect=[None, StopWatching]):
+            with self.assertRaises(StopWatching):
+                other._watch()
+        self.assertEqual(other.active.version, "v3")
+
+    @override_settings(INTENT_MODEL_ADMIN_TOKEN="secret")
+    def test_admin_endpoint(self):
+        registry = self.registry()
+        url = "/api/chatbot/model/"
+
+        def post(body, token="secret"):
+            headers = {"HTTP_X_ADMIN_TOKEN": token} if token else {}
+            return self.client.post(url, body, content_type="application/json", **headers)
+
+        with mock.patch("chatbot_api.views.model_registry", registry):
+            self.assertEqual(self.client.get(url).status_code, 403)
+            self.assertEqual(post({"action": "rollback"}, token=None).status_code, 403)
+            self.assertEqual(post({"action": "rollback"}, token="wrong").status_code, 403)
+            with override_settings(INTENT_MODEL_ADMIN_TOKEN=""):
+                self.assertEqual(post({"action": "rollback"}, token="secret").status_code, 403)
+            self.assertEqual(self.client.get(url, HTTP_X_ADMIN_TOKEN="secret").json()["active"], "v1")
+
+            self.assertEqual(post({"action": "rollback"}).status_code, 400)
+            self.assertEqual(post({"action": "activate", "version": "v9"}).status_code, 400)
+            self.assertEqual(post({"action": "promote"}).status_code, 400)
+            self.assertEqual(post({"action": "activate", "version": "v2"}).json()["active"], "v2")
+            report = post({"action": "shadow", "version": "v3"}).json()
+            self.assertEqual(report["shadow"]["candidate"], "v3")
+            self.assertIsNone(post({"action": "stop_shadow"}).json()["shadow"]["candidate"])
+            report = post({"action": "rollback"}).json()
+        self.assertEqual((report["active"], report["previous"]), ("v1", "v2"))
+
+
+class ConversationGraphTests(SimpleTestCase):
+    """The compiled graph, the state dispatch built from it and its pre-rendered bodies"""
+
+    def all_nodes(self):
+        for nodes in (conversation_graph.root, *conversation_graph.categories.values()):
+            yield from nodes.items()
+
+    def test_graph_is_compiled_read_only(self):
+        self.assertEqual(conversation_graph.root["start"]["options"], ("Sinhala", "English", "Tamil"))
+        self.assertEqual(conversation_graph.owners["awaiting_district"], "fault_reporting")
+        self.assertEqual(conversation_graph.owners["solar_details"], "solar_service")
+        # Root end nodes stay with the view
+        self.assertNotIn("exit", conversation_graph.owners)
+        with self.assertRaises(TypeError):
+            conversation_graph.root["start"]["message"] = "changed"
+
+    def test_node_lookup_by_language(self):
+        self.assertIs(conversation_graph.node("start"), conversation_graph.root["start"])
+        self.assertIsNone(conversation_graph.node("no_such_node"))
+        for language, nodes in conversation_graph.languages.items():
+            for node_id, node in nodes.items():
+                self.assertIs(conversation_graph.node(node_id, language), node)
+        self.assertIs(conversation_graph.node("awaiting_district", "French"),
+                      conversation_graph.categories["fault_reporting"]["awaiting_district"])
+        self.assertEqual(conversation_graph.get_next_node("fault_reporting", "Report a Fault", "English"),
+                         "awaiting_district")
+        self.assertIsNone(conversation_graph.get_next_node("awaiting_district", "Colombo", "English"))
+
+    def test_dispatch_table(self):
+        table = conversation_graph.dispatch_table({"fault_reporting": "fault", "solar_service": "solar"})
+        self.assertEqual(set(table.values()), {"fault", "solar"})
+        self.assertEqual(table["awaiting_fault_type"], "fault")
+        self.assertEqual(table["solar_unavailable"], "solar")
+        self.assertNotIn("bill_inquiries", table)
+        self.assertEqual(engine.STATE_HANDLERS["awaiting_district"], FaultReportingHandler().handle_fault_report)
+        self.assertEqual(engine.STATE_HANDLERS["billing_unavailable"], BillInquiriesHandler().handle_bill_inquiry)
+        self.assertEqual({state for state, category in conversation_graph.owners.items()
+                          if category in ("bill_inquiries", "solar_service", "fault_reporting")},
+                         set(engine.STATE_HANDLERS))
+
+    def test_prerendered_bodies_match_drf(self):
+        for node_id, node in self.all_nodes():
+            with self.subTest(node=node_id):
+                expected = JSONRenderer().render(node_body(node))
+                self.assertEqual(conversation_graph.response(node).content, expected)
+                # A node the graph did not compile is rendered on the spot, the same way
+                self.assertEqual(conversation_graph.response(dict(node)).content, expected)
+
+
+class FaultReportingResponseTests(TestCase):
+    """Fault reporting hops answer with the graph's response of the node, as every other hop does"""
+
+    def test_hops_use_the_graph_response(self):
+        nodes = FaultReportingHandler().nodes
+        chat_session = ChatSession.objects.create(session_id="f1", mistake_count=0, selected_language="English",
+                                                  state="fault_reporting")
+        for message, state in (("Report a Fault", "awaiting_district"), ("Colombo", "awaiting_town"),
+                               ("Dehiwala", "awaiting_identifier"), ("1234567890", "awaiting_fault_type")):
+            response = advance(chat_session, message)
+            self.assertEqual(chat_session.state, state)
+            self.assertEqual(response_json(response), conversation_graph.response(nodes[state]).content)
+            self.assertEqual(response_json(response), JSONRenderer().render(node_body(nodes[state])))
+        self.assertEqual(response.data["type"], "menu")
+
+
+class TurnLabellingTests(TestCase):
+    """Each turn carries the node it led to, and training labels turns one by one"""
+
+    def converse(self, messages, intents):
+        chat_session = ChatSession.objects.create(session_id="s1", mistake_count=0)
+        advance(chat_session, None, created=True)
+        with mock.patch("chatbot_api.utils.model_registry") as registry:
+            registry.classify.side_effect = intents
+            for message in messages:
+                advance(chat_session, message)
+        return chat_session
+
+    def test_turns_record_the_node_they_led_to(self):
+        chat_session = self.converse(["English", "hello", "my bill is wrong"], [["greetings"], ["Bill Inquiries"]])
+        chat_session.flush()
+        self.assertEqual(
+            list(ChatTurn.objects.order_by("sequence").values_list("user_text", "node_id")),
+            [("English", "english_start"), ("hello", "english_start"), ("hello", "english_start"),
+             ("my bill is wrong", "bill_inquiries"), ("my bill is wrong", "bill_inquiries")],
+        )
+
+    def test_turns_are_labelled_by_their_own_node(self):
+        chat_session = self.converse(["English", "hello", "blah", "my bill is wrong"],
+                                     [["greetings"], [], ["Bill Inquiries"]])
+        # Later turns move on to other nodes and the session ends elsewhere
+        chat_session.add_turn("1234567890", "Please wait")
+        chat_session.state = "exit"
+        chat_session.stamp_turns()
+        document = build_archive(chat_session, chat_session.iter_turns(), None)
+        self.assertEqual(document["selected_category"], "Unknown")
+        self.assertEqual(labelled_turns([document]), [("hello", "greetings"), ("my bill is wrong", "Bill Inquiries")])
+
+    def test_archives_without_node_ids_are_labelled_by_the_entry_message(self):
+        def document(category, *turns):
+            return {
+                "selected_language": "English",
+                "selected_category": category,
+                "chat_messages": [{"user_message": user, "bot_response": bot} for user, bot in turns],
+            }
+
+        documents = [
+            document("Unknown", ("English", "Hi, how can I help you today?"), ("hi", GREETING_REPLY),
+                     ("solar", None), ("solar", "Welcome! Please select an option")),
+            # Bill and fault open with the same message: the final category decides
+            document("Bill Inquiries", ("my bill", None), ("my bill", "Please select an option:")),
+            document("Unknown", ("power cut", None), ("power cut", "Please select an option:")),
+            document("Bill Inquiries", ("mi bill", "Sorry, I couldn't understand that. Please try again.")),
+            {**document("Bill Inquiries", ("my bill", "Please select an option:")), "selected_language": "Sinhala"},
+        ]
+        self.assertEqual(
+            labelled_turns(documents),
+            [("hi", "greetings"), ("solar", "Solar Services"), ("my bill", "Bill Inquiries")],
+        )
+
+
+class LookupCacheAsyncTests(SimpleTestCase):
+    """aget_or_load() sends one lookup per key however many tasks ask at once"""
+
+    def setUp(self):
+        self.cache = LookupCache(ttl=60, negative_ttl=15)
+        self.calls = 0
+
+    async def lookup(self, value="ok", delay=0.05, error=None):
+        self.calls += 1
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return value
+
+    def test_concurrent_tasks_share_one_lookup(self):
+        async def run():
+            results = await asyncio.gather(*[self.cache.aget_or_load("key", self.lookup) for _ in range(5)])
+            cached = await self.cache.aget_or_load("key", self.lookup)
+            return results, cached
+
+        results, cached = asyncio.run(run())
+        self.assertEqual((results, cached, self.calls), (["ok"] * 5, "ok", 1))
+        self.assertEqual({key: self.cache.stats()[key] for key in ("misses", "coalesced", "hits", "in_flight")},
+                         {"misses": 1, "coalesced": 4, "hits": 1, "in_flight": 0})
+
+    def test_errors_reach_every_waiter_and_are_not_cached(self):
+        async def run():
+            return await asyncio.gather(
+                *[self.cache.aget_or_load("key", lambda: self.lookup(error=ValueError("down"))) for _ in range(3)],
+                return_exceptions=True,
+            )
+
+        self.assertTrue(all(isinstance(result, ValueError) for result in asyncio.run(run())))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.get("key"), None)
+
+    def test_result_invalidated_in_flight_is_not_cached(self):
+        async def run():
+            task = asyncio.ensure_future(self.cache.aget_or_load("key", self.lookup))
+            await asyncio.sleep(0.01)
+            self.cache.invalidate("key")
+            return await task
+
+        self.assertEqual(asyncio.run(run()), "ok")
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_waiter_looks_up_itself_when_the_leader_is_cancelled(self):
+        async def run():
+            leader = asyncio.ensure_future(self.cache.aget_or_load("key", lambda: self.lookup("first")))
+            await asyncio.sleep(0.01)
+            waiter = asyncio.ensure_future(self.cache.aget_or_load("key", lambda: self.lookup("second")))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await waiter
+
+        self.assertEqual(asyncio.run(run()), "second")
+        self.assertEqual(self.calls, 2)
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker("billing", window=10, min_calls=4, failure_rate=0.5, slow_call_seconds=2.0,
+                                      slow_call_rate=0.75, open_seconds=15, clock=self.clock)
+
+    def call(self, seconds=0.1, failed=False):
+        probe = self.breaker.before_call()
+        self.breaker.record(seconds, failed, probe=probe)
+        return probe
+
+    def open_circuit(self):
+        for failed in (False, True, False, True):
+            self.call(failed=failed)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_failure_rate_opens_only_after_min_calls(self):
+        for _ in range(3):
+            self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.call()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.clock.now += 5
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.before_call()
+        self.assertEqual(raised.exception.retry_in, 10)
+        self.assertEqual(self.breaker.stats()["rejected"], 1)
+
+    def test_slow_calls_open_the_circuit(self):
+        for seconds in (2.5, 3.0, 0.1, 2.0):
+            self.call(seconds)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_successful_probe_closes_the_circuit(self):
+        self.open_circuit()
+        self.clock.now += 15
+        self.assertTrue(self.breaker.before_call())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        # One probe at a time
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+        self.breaker.record(0.1, False, probe=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.stats()["calls"], 0)
+        self.assertFalse(self.call(failed=True))
+
+    def test_failed_or_slow_probe_opens_again(self):
+        self.open_circuit()
+        for seconds, failed in ((0.1, True), (2.5, False)):
+            self.clock.now += 14.9
+            with self.assertRaises(CircuitOpenError):
+                self.breaker.before_call()
+            self.clock.now += 0.1
+            self.assertTrue(self.call(seconds, failed))
+            self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+            self.assertEqual(self.breaker.opened_at, self.clock.now)
+        self.assertEqual(self.breaker.times_opened, 3)
+
+    def test_calls_leave_the_window_with_their_second(self):
+        for _ in range(3):
+            self.call(failed=True)
+        # Still inside the 10 s window: the fourth failure opens the circuit
+        self.clock.now += 9.5
+        self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        breaker = CircuitBreaker("solar", window=10, min_calls=4, clock=self.clock)
+        for _ in range(3):
+            breaker.record(0.1, True)
+        self.clock.now += 10
+        self.assertEqual(breaker.stats()["calls"], 0)
+        breaker.record(0.1, True)
+        self.assertEqual((breaker.state, breaker.stats()["calls"]), (CircuitBreaker.CLOSED, 1))
+
+
+class ExtractIdentifiersTests(SimpleTestCase):
+    extract = staticmethod(BillInquiriesHandler.extract_identifiers)
+
+    def test_labelled_numbers(self):
+        self.assertEqual(self.extract("account 1234567890, phone 0714445598"), ("1234567890", "0714445598"))
+        self.assertEqual(self.extract("my mobile is 071-444-5598 and a/c 123 456 7890"), ("1234567890", "0714445598"))
+
+    def test_labelled_numbers_in_reverse_order(self):
+        self.assertEqual(self.extract("phone 0714445598, account 1234567890"), ("1234567890", "0714445598"))
+
+    def test_single_number(self):
+        self.assertEqual(self.extract("1234567890"), ("1234567890", None))
+        self.assertEqual(self.extract("contact number 0714445598"), (None, "0714445598"))
+        self.assertEqual(BillInquiriesHandler.extract_mobile_number("0714445598"), "0714445598")
+
+    def test_one_unmarked_number_fills_the_missing_one(self):
+        self.assertEqual(self.extract("account 1234567890 and 0714445598"), ("1234567890", "0714445598"))
+        self.assertEqual(self.extract("phone 0714445598 and 1234567890"), ("1234567890", "0714445598"))
+
+    def test_two_unlabelled_numbers_are_not_guessed(self):
+        self.assertEqual(self.extract("1234567890 0714445598"), (None, None))
+        self.assertEqual(self.extract("phone 0714445598, 1234567890 or 1234567891"), (None, "0714445598"))
+
+    def test_no_number(self):
+        self.assertEqual(self.extract("my bill is wrong, call 12345"), (None, None))
+
+
+class BillingInvalidationTests(TestCase):
+    """Invalidated billing lookups go to the billing API again"""
+
+    def setUp(self):
+        billing_cache.clear()
+        self.addCleanup(billing_cache.clear)
+        self.handler = BillInquiriesHandler()
+        fetch_account = mock.patch.object(self.handler, "_fetch_account_balance",
+                                          side_effect=lambda number: {'valid': True, 'balance': 100.0})
+        fetch_contact = mock.patch.object(self.handler, "_fetch_contact_account",
+                                          side_effect=lambda number: {'account_number': "1234567890"})
+        self.fetch_account = fetch_account.start()
+        self.fetch_contact = fetch_contact.start()
+        self.addCleanup(mock.patch.stopall)
+
+    def lookup(self):
+        self.handler.validate_account_number_with_api("1234567890")
+        self.handler.validate_contact_number_with_api("0714445598")
+
+    def test_cached_until_invalidated(self):
+        cache = LookupCache(ttl=60)
+        load = mock.Mock(return_value="value")
+        cache.get_or_load("key", load)
+        cache.get_or_load("key", load)
+        self.assertTrue(cache.invalidate("key"))
+        self.assertFalse(cache.invalidate("key"))
+        cache.get_or_load("key", load)
+        self.assertEqual(load.call_count, 2)
+
+    def test_invalidated_account_and_its_contacts_are_looked_up_again(self):
+        self.lookup()
+        self.lookup()
+        self.assertEqual((self.fetch_account.call_count, self.fetch_contact.call_count), (1, 1))
+        self.assertEqual(self.handler.invalidate_account("1234567890"), 2)
+        self.lookup()
+        self.assertEqual((self.fetch_account.call_count, self.fetch_contact.call_count), (2, 2))
+        self.assertEqual(self.handler.invalidate_contact("0714445598"), 1)
+        self.lookup()
+        self.assertEqual((self.fetch_account.call_count, self.fetch_contact.call_count), (2, 3))
+
+    def test_shown_balance_is_invalidated(self):
+        chat_session = ChatSession.objects.create(session_id="s1", mistake_count=0, state="verification")
+        chat_session.temp_data = {}
+        self.handler._verify_account_number(chat_session, "account 1234567890, phone 0714445598")
+        self.assertEqual(chat_session.state, "display_balance")
+        self.lookup()
+        self.assertEqual((self.fetch_account.call_count, self.fetch_contact.call_count), (2, 2))
+
+    @override_settings(INTENT_MODEL_ADMIN_TOKEN="secret")
+    def test_admin_endpoint_invalidates(self):
+        self.lookup()
+        url = "/api/chatbot/billing-cache/"
+        body = {"accounts": ["1234567890"], "contacts": ["0714445598"]}
+        self.assertEqual(self.client.post(url, body, content_type="application/json").status_code, 403)
+        self.assertEqual(self.client.post(url, body, content_type="application/json",
+                                          HTTP_X_ADMIN_TOKEN="wrong").status_code, 403)
+        response = self.client.post(url, body, content_type="application/json", HTTP_X_ADMIN_TOKEN="secret")
+        self.assertEqual((response.status_code, response.json()["invalidated"]), (200, 2))
+        self.lookup()
+        self.assertEqual((self.fetch_account.call_count, self.fetch_contact.call_count), (2, 2))
+        response = self.client.post(url, {"accounts": "1234567890"}, content_type="application/json",
+                                    HTTP_X_ADMIN_TOKEN="secret")
+        self.assertEqual(response.status_code, 400)
+
+
+class RunBatchTests(TestCase):
+    """run_batch() and the batch endpoint, with each session store"""
+
+    EXIT_TA = "வெளியேறு"
+
+    def setUp(self):
+        cache.clear()
+        mock.patch("chatbot_api.engine.start_workers").start()
+        self.archived = mock.patch("chatbot_api.chat_history.archive_queue").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def stores(self):
+        memory = MemorySessionStore(max_size=100, ttl=300, flush_interval=60)
+        memory._flusher_pid = os.getpid()
+        return [OrmSessionStore(), memory, CacheSessionStore(alias="default", lease=60, wait=0.05)]
+
+    def run_with(self, store, turns):
+        with mock.patch.object(engine, "session_store", store):
+            responses = engine.run_batch(turns)
+        store.flush()
+        return responses
+
+    def test_turns_of_a_session_apply_in_order(self):
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+                ChatSession.objects.all().delete()
+                responses = self.run_with(store, [("s1", None), ("s1", "Tamil"), ("s1", "பில் விசாரணைகள்")])
+                self.assertEqual([response.status_code for response in responses], [200, 200, 200])
+                chat_session = ChatSession.objects.get(session_id="s1")
+                self.assertEqual((chat_session.state, chat_session.selected_language), ("bill_inquiries", "Tamil"))
+                self.assertEqual(list(chat_session.turns.order_by("sequence").values_list("user_text", flat=True)),
+                                 ["Tamil", "பில் விசாரணைகள்"])
+
+    def test_sessions_share_one_checkout_and_one_checkin(self):
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+                ChatSession.objects.all().delete()
+                self.run_with(store, [("s1", None), ("s2", None)])
+                with mock.patch.object(store, "checkout_many", wraps=store.checkout_many) as checkout, \
+                        mock.patch.object(store, "checkin_many", wraps=store.checkin_many) as checkin:
+                    self.run_with(store, [("s1", "English"), ("s2", "Sinhala"), ("s3", None)])
+                self.assertEqual((checkout.call_count, checkin.call_count), (1, 1))
+                self.assertEqual(sorted(checkout.call_args.args[0]), ["s1", "s2", "s3"])
+                self.assertEqual(dict(ChatSession.objects.values_list("session_id", "state")),
+                                 {"s1": "english_start", "s2": "sinhala_menu", "s3": "start"})
+
+    def test_exit_then_a_new_turn_in_the_same_batch(self):
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+                ChatSession.objects.all().delete()
+                first = self.run_with(store, [("s1", None)])[0]
+                old_pk = ChatSession.objects.get(session_id="s1").pk
+                with mock.patch.object(store, "restart", wraps=store.restart) as restart:
+                    responses = self.run_with(store, [("s1", "Tamil"), ("s1", self.EXIT_TA), ("s1", "bye"), ("s1", "hello")])
+                self.assertEqual(restart.call_count, 1)
+                self.assertEqual([response.status_code for response in responses], [200] * 4)
+                self.assertEqual(responses[2].data["type"], "end")
+                self.assertEqual(response_json(responses[3]), response_json(first))
+                chat_session = ChatSession.objects.get(session_id="s1")
+                self.assertNotEqual(chat_session.pk, old_pk)
+                self.assertEqual((chat_session.state, chat_session.turn_count), ("start", 0))
+                # The session is checked in and can be checked out again
+                self.assertEqual(self.run_with(store, [("s1", "English")])[0].status_code, 200)
+                self.assertEqual(ChatSession.objects.get(session_id="s1").state, "english_start")
+
+    def test_conflict_answers_409_for_that_session_only(self):
+        store = CacheSessionStore(alias="default", lease=60, wait=0.05)
+        self.run_with(store, [("s1", None), ("s2", None)])
+        real_advance = engine.advance
+
+        def advance_losing_s2_lease(chat_session, user_message, created=False):
+            if chat_session.session_id == "s2":
+                # The lease runs out and another request takes the session
+                cache.delete(store.lock_key("s2"))
+                lease = store._leases.pop("s2")
+                other, _ = store.checkout("s2")
+                store.checkin(other)
+                store._leases["s2"] = lease
+            return real_advance(chat_session, user_message, created)
+
+        with mock.patch.object(engine, "session_store", store), \
+                mock.patch.object(engine, "advance", side_effect=advance_losing_s2_lease):
+            response = self.client.post("/api/chatbot/batch/", {"turns": [
+                {"session_id": "s1", "message": "English"}, {"session_id": "s2", "message": "English"},
+            ]}, content_type="application/json")
+        results = response.json()["results"]
+        self.assertEqual([(result["session_id"], result["status"]) for result in results], [("s1", 200), ("s2", 409)])
+        self.assertEqual(results[1]["response"]["type"], "conflict")
+        self.assertEqual(dict(ChatSession.objects.values_list("session_id", "state")),
+                         {"s1": "english_start", "s2": "start"})
+
+    def test_batch_endpoint_validates_and_keeps_turn_order(self):
+        with mock.patch.object(engine, "session_store", OrmSessionStore()):
+            bad = self.client.post("/api/chatbot/batch/", {"turns": [{"message": "x"}]}, content_type="application/json")
+            response = self.client.post("/api/chatbot/batch/", {"turns": [
+                {"session_id": "s2"}, {"session_id": "s1"}, {"session_id": "s2", "message": "English"},
+            ]}, content_type="application/json")
+        self.assertEqual(bad.status_code, 400)
+        results = response.json()["results"]
+        self.assertEqual([(result["session_id"], result["status"]) for result in results],
+                         [("s2", 200), ("s1", 200), ("s2", 200)])
+        self.assertEqual(results[2]["response"]["message"], "Hi, how can I help you today?")
+
+
+def serve_stubs(test, stubs):
+    """Serve ``stubs`` on a free port for the duration of a test; the port is set on them"""
+    server = make_server(stubs, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    stubs.port = server.server_address[1]
+    return stubs
+
+
+class UpstreamRetryTests(SimpleTestCase):
+    """Only idempotent GETs are retried, on failed connections and 502/503/504, never after a read timeout"""
+
+    def setUp(self):
+        self.stubs = serve_stubs(self, StubUpstreams({"accounts": {"1234567890": 10}}, behaviour={"latency_ms": 0}))
+        base = f"http://127.0.0.1:{self.stubs.port}"
+        overrides = override_settings(
+            BILLING_API_BASE_URL=f"{base}/CCLECO/Main", SOLAR_CHAT_URL=f"{base}/chat/",
+            UPSTREAM_RETRIES=2, UPSTREAM_RETRY_BACKOFF=0, UPSTREAM_READ_TIMEOUT=0.3, CIRCUIT_MIN_CALLS=100,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        mock.patch("chatbot_api.upstream._session", None).start()
+        mock.patch.dict(circuit_breakers, clear=True).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def get_balance(self):
+        return get_session().get(billing_url("GetAccountBalance"), params={"accountNumber": "1234567890"})
+
+    def test_gateway_errors_are_retried(self):
+        for error_status in (502, 503, 504):
+            with self.subTest(status=error_status):
+                self.stubs.requests.clear()
+                self.stubs.update_behaviour(error_rate=1.0, error_status=error_status)
+                self.assertEqual(self.get_balance().status_code, error_status)
+                self.assertEqual(self.stubs.requests["GetAccountBalance"], 3)
+
+    def test_other_errors_are_not_retried(self):
+        self.stubs.update_behaviour(error_rate=1.0, error_status=500)
+        self.assertEqual(self.get_balance().status_code, 500)
+        self.assertEqual(self.stubs.requests["GetAccountBalance"], 1)
+
+    def test_read_timeout_is_not_retried(self):
+        self.stubs.update_behaviour(timeout_rate=1.0, hang_seconds=1.0)
+        with self.assertRaises(requests.exceptions.ConnectionError) as raised:
+            self.get_balance()
+        self.assertIn("Read timed out", str(raised.exception))
+        self.assertEqual(self.stubs.requests["GetAccountBalance"], 1)
+
+    def test_post_is_never_retried(self):
+        self.stubs.update_behaviour(error_rate=1.0, error_status=503)
+        response = get_session().post(settings.SOLAR_CHAT_URL, json={"question": "net metering"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.stubs.requests["chat"], 1)
+
+    def test_success_after_a_gateway_error(self):
+        self.stubs.update_behaviour(error_rate=0.5, error_status=502)
+        # Seeded draws: the first request fails and a retry gets through
+        with mock.patch.object(self.stubs, "_rng", mock.Mock(random=mock.Mock(side_effect=[0.1, 0.9]))):
+            response = self.get_balance()
+        self.assertEqual((response.status_code, response.text), (200, "YES,10.00"))
+        self.assertEqual(self.stubs.requests["GetAccountBalance"], 2)
+
+
+class StubUpstreamFlowTests(TestCase):
+    """Whole conversations against the stub billing API and solar chat service"""
+
+    def setUp(self):
+        self.billing = serve_stubs(self, StubUpstreams.from_file(behaviour={"latency_ms": 0}, seed=0))
+        self.solar = serve_stubs(self, StubUpstreams.from_file(behaviour={"latency_ms": 0}, seed=0))
+        overrides = override_settings(
+            BILLING_API_BASE_URL=f"http://127.0.0.1:{self.billing.port}/CCLECO/Main",
+            SOLAR_CHAT_URL=f"http://127.0.0.1:{self.solar.port}/chat/",
+            UPSTREAM_RETRIES=0, UPSTREAM_READ_TIMEOUT=2, SOLAR_CHAT_READ_TIMEOUT=2,
+            CIRCUIT_MIN_CALLS=2, CIRCUIT_FAILURE_RATE=0.5, CIRCUIT_OPEN_SECONDS=60,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # A fresh upstream session (built with these settings) and fresh breakers
+        mock.patch("chatbot_api.upstream._session", None).start()
+        mock.patch.dict(circuit_breakers, clear=True).start()
+        mock.patch("chatbot_api.engine.start_workers").start()
+        mock.patch.object(engine, "session_store", OrmSessionStore()).start()
+        self.addCleanup(mock.patch.stopall)
+        billing_cache.clear()
+        self.addCleanup(billing_cache.clear)
+
+    def converse(self, session_id, *messages):
+        """Send the messages in turn; returns the last reply"""
+        for message in messages:
+            response = self.client.post("/api/chatbot/", {"session_id": session_id, "message": message},
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_bill_balance(self):
+        reply = self.converse("b1", None, "English", "my bill", "Bill Balance Check", "1234567890")
+        self.assertEqual(reply["fields"], ["contact_number"])
+        reply = self.converse("b1", "0714445598")
+        self.assertIn("Current Balance: Rs. 1234.50", reply["message"])
+        self.assertEqual(ChatSession.objects.get(session_id="b1").state, "display_balance")
+        self.assertEqual(self.billing.requests, {"GetAccountBalance": 1, "GetAccountNumber": 1})
+
+        reply = self.converse("b2", None, "English", "my bill", "Bill Balance Check", "2345678901", "0714445598")
+        self.assertIn("not associated with account 2345678901", reply["message"])
+        reply = self.converse("b2", "Try Again", "0771234567")
+        self.assertIn("Current Balance: Rs. 5870.25", reply["message"])
+
+    def test_bill_numbers_in_one_message(self):
+        reply = self.converse("b1", None, "English", "my bill", "account 1234567890, phone 0714445598")
+        self.assertIn("Current Balance: Rs. 1234.50", reply["message"])
+        reply = self.converse("b2", None, "English", "my bill", "Bill Balance Check", "9999999999")
+        self.assertEqual(reply["message"], "Invalid account number. Please try again.")
+
+    def test_solar_question(self):
+        reply = self.converse("c1", None, "English", "solar", "Solar Details", "what about net metering?")
+        self.assertEqual(reply["type"], "message")
+        self.assertIn("net metering", reply["message"])
+        reply = self.converse("c1", "tell me a joke")
+        self.assertIn("I don't have information about that", reply["message"])
+        self.assertEqual(self.solar.requests, {"chat": 2})
+
+    def test_failing_upstreams_open_their_circuits(self):
+        self.billing.update_behaviour(error_rate=1.0)
+        self.solar.update_behaviour(error_rate=1.0)
+        self.converse("b1", None, "English", "my bill", "Bill Balance Check")
+        for _ in range(2):
+            reply = self.converse("b1", "1234567890")
+            self.assertEqual(reply["message"], "Invalid account number. Please try again.")
+        # Two failures of two calls: the billing circuit is open and the API is not called
+        reply = self.converse("b1", "1234567890")
+        self.assertEqual(reply["message"],
+                         "Our billing service is temporarily unavailable. Please try again in a few minutes.")
+        self.assertEqual(ChatSession.objects.get(session_id="b1").state, "billing_unavailable")
+        self.assertEqual(self.billing.requests, {"GetAccountBalance": 2})
+        self.assertEqual(circuit_breakers[f"127.0.0.1:{self.billing.port}"].state, CircuitBreaker.OPEN)
+
+        # The solar service has its own circuit, still closed
+        self.converse("c1", None, "English", "solar", "Solar Details")
+        for _ in range(2):
+            reply = self.converse("c1", "what about net metering?")
+            self.assertEqual(reply["message"], "Error: 503, Unable to get response from the chatbot.")
+        reply = self.converse("c1", "what about net metering?")
+        self.assertEqual(reply["options"], ["Try Again", "exit"])
+        self.assertEqual(ChatSession.objects.get(session_id="c1").state, "solar_unavailable")
+        self.assertEqual(self.solar.requests, {"chat": 2})
+
+
+class AsyncChatbotAPITests(TestCase):
+    """The async endpoint: async checkout, upstream prefetch, and its 408 and 409 answers"""
+
+    URL = "/api/chatbot/async/"
+
+    def setUp(self):
+        cache.clear()
+        billing_cache.clear()
+        self.addCleanup(billing_cache.clear)
+        self.store = OrmSessionStore()
+        mock.patch("chatbot_api.views.session_store", self.store).start()
+        mock.patch("chatbot_api.views.start_workers").start()
+        mock.patch("chatbot_api.chat_history.sweeper").start()
+        self.upstream_calls = []
+        for module in ("bill_inquiries", "solar_service"):
+            mock.patch(f"node_data.handlers.{module}.get_async_client", self.async_client_for_upstreams).start()
+            # Every lookup of a turn must have been prefetched on the event loop
+            mock.patch(f"node_data.handlers.{module}.get_session",
+                       side_effect=AssertionError("blocking upstream call")).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def answer(self, request):
+        self.upstream_calls.append(request.url.path.rstrip("/").rsplit("/", 1)[-1])
+        if request.url.path.endswith("GetAccountBalance"):
+            return httpx.Response(200, text="YES,1234.50")
+        if request.url.path.endswith("GetAccountNumber"):
+            return httpx.Response(200, text="1234567890")
+        return httpx.Response(200, json={"response": "Net metering credits what your panels export."})
+
+    def async_client_for_upstreams(self):
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.answer))
+
+    async def converse(self, session_id, *messages, expect=200):
+        for message in messages:
+            response = await self.async_client.post(self.URL, {"session_id": session_id, "message": message},
+                                                    content_type="application/json")
+            self.assertEqual(response.status_code, expect, response.content)
+        return response.json()
+
+    async def test_checkout_and_checkin(self):
+        memory = MemorySessionStore(max_size=100, ttl=300, flush_interval=60)
+        memory._flusher_pid = os.getpid()
+        for store in (OrmSessionStore(), memory, CacheSessionStore(alias="default", lease=60, wait=0.05)):
+            with self.subTest(store=type(store).__name__):
+                await ChatSession.objects.all().adelete()
+                chat_session, created = await store.acheckout("a1")
+                self.assertTrue(created)
+                chat_session.state = "english_start"
+                await store.acheckin(chat_session)
+                await sync_to_async(store.flush)()
+                chat_session, created = await store.acheckout("a1")
+                self.assertEqual((created, chat_session.state), (False, "english_start"))
+                await store.acheckin(chat_session)
+                self.assertEqual((await ChatSession.objects.aget(session_id="a1")).state, "english_start")
+
+    async def test_bill_lookups_are_prefetched(self):
+        reply = await self.converse("a1", None, "English", "my bill", "Bill Balance Check", "1234567890")
+        self.assertEqual(reply["fields"], ["contact_number"])
+        reply = await self.converse("a1", "0714445598")
+        self.assertIn("Current Balance: Rs. 1234.50", reply["message"])
+        self.assertEqual(self.upstream_calls, ["GetAccountBalance", "GetAccountNumber"])
+
+    async def test_solar_answer_is_prefetched(self):
+        reply = await self.converse("a2", None, "English", "solar", "Solar Details", "what is net metering")
+        self.assertEqual(reply, {"message": "Net metering credits what your panels export.", "type": "message"})
+        self.assertEqual(self.upstream_calls, ["chat"])
+
+    def test_prefetchers_cover_the_upstream_states(self):
+        self.assertEqual(sorted(state for state in ("bill_inquiries", "solar_service", "fault_reporting")
+                                if engine.STATE_PREFETCHERS.get(state)), ["bill_inquiries", "solar_service"])
+        self.assertIsNotNone(engine.STATE_PREFETCHERS.get("contact_verification"))
+
+    async def test_expired_session_answers_408(self):
+        await self.converse("a1", None, "English")
+        await ChatSession.objects.filter(session_id="a1").aupdate(
+            updated_at=datetime.datetime.now(datetime.timezone.utc) - ChatSession.SESSION_TIMEOUT * 2)
+        reply = await self.converse("a1", "my bill", expect=408)
+        self.assertEqual(reply["type"], "timeout")
+        self.assertEqual((await ChatSession.objects.aget(session_id="a1")).state, "english_start")
+
+    async def test_session_held_elsewhere_answers_409(self):
+        store = CacheSessionStore(alias="default", lease=60, wait=0.05)
+        with mock.patch("chatbot_api.views.session_store", store):
+            await self.converse("a1", None)
+            # Another worker holds the session's lease
+            await cache.aadd(store.lock_key("a1"), "other-worker", 60)
+            reply = await self.converse("a1", "English", expect=409)
+            self.assertEqual(reply["type"], "conflict")
+            await cache.adelete(store.lock_key("a1"))
+            await self.converse("a1", "English")
+        self.assertEqual((await ChatSession.objects.aget(session_id="a1")).state, "english_start")
+
+    async def test_invalid_body_answers_400(self):
+        response = await self.async_client.post(self.URL, b"{not json", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+class BillVerificationStateTests(TestCase):
+    """The account being verified is kept on the session, so any worker can run the next turn"""
+
+    def setUp(self):
+        cache.clear()
+        billing_cache.clear()
+        self.addCleanup(billing_cache.clear)
+        handler = BillInquiriesHandler()
+        mock.patch.object(handler, "_fetch_account_balance",
+                          side_effect=lambda number: {'valid': True, 'balance': 1234.5}).start()
+        mock.patch.object(handler, "_fetch_contact_account",
+                          side_effect=lambda number: {'account_number': "1234567890"}).start()
+        mock.patch("chatbot_api.engine.start_workers").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def turn(self, store, message):
+        with mock.patch.object(engine, "session_store", store):
+            response = engine.run_turn("b1", message)
+        store.flush()
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_contact_turn_on_another_worker(self):
+        workers = {
+            "orm": (OrmSessionStore(), OrmSessionStore()),
+            "cache": (CacheSessionStore(alias="default", lease=60, wait=0.05),
+                      CacheSessionStore(alias="default", lease=60, wait=0.05)),
+        }
+        for name, (first, second) in workers.items():
+            with self.subTest(store=name):
+                cache.clear()
+                ChatSession.objects.all().delete()
+                ChatSession.objects.create(session_id="b1", mistake_count=0, state="bill_inquiries",
+                                           selected_language="English")
+                self.turn(first, "Bill Balance Check")
+                self.assertEqual(self.turn(first, "1234567890")["fields"], ["contact_number"])
+                self.assertEqual(ChatSession.objects.get(session_id="b1").temp_data,
+                                 {"account": "1234567890", "balance": 1234.5})
+                reply = self.turn(second, "0714445598")
+                self.assertIn("Current Balance: Rs. 1234.50", reply["message"])
+
+    def test_rejected_account_is_forgotten(self):
+        store = OrmSessionStore()
+        ChatSession.objects.create(session_id="b1", mistake_count=0, state="verification",
+                                   selected_language="English", temp_data={"account": "1234567890", "balance": 1.0})
+        with mock.patch.object(BillInquiriesHandler(), "_fetch_account_balance", return_value={'valid': False}):
+            self.assertEqual(self.turn(store, "2345678901")["message"], "Invalid account number. Please try again.")
+        self.assertEqual(ChatSession.objects.get(session_id="b1").temp_data, {})
+
+    def test_in_place_changes_are_flushed(self):
+        chat_session = ChatSession.objects.create(session_id="s1", mistake_count=0)
+        self.assertEqual(chat_session.changed_fields(), [])
+        chat_session.temp_data["account"] = "1234567890"
+        self.assertEqual(chat_session.changed_fields(), ["temp_data"])
+        self.assertTrue(chat_session.flush())
+        self.assertEqual(ChatSession.objects.get(pk=chat_session.pk).temp_data, {"account": "1234567890"})
+        self.assertEqual(chat_session.changed_fields(), [])
+
+
+class ChatTurnMigrationTests(TransactionTestCase):
+    """0002 moves chat_history into ChatTurn rows and drops the column"""
+
+    migrate_from = [("chatbot_api", "0001_initial")]
+    migrate_to = [("chatbot_api", "0002_chatturn")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_histories_survive_in_order(self):
+        apps = self.migrate(self.migrate_from)
+        OldChatSession = apps.get_model("chatbot_api", "ChatSession")
+        history = [
+            {"user": None, "bot": "Please choose a language:"},
+            {"user": "English", "bot": "Hi, how can I help you today?", "timestamp": "2025-01-20T09:15:00.250000"},
+            "not a turn",
+            {"user": "my bill", "bot": "Please select an option:", "timestamp": "2025-01-20T09:15:07+05:30"},
+        ]
+        migrated = OldChatSession.objects.create(
+            session_id="s1", chat_history=history, state="bill_inquiries", mistake_count=0,
+        )
+        OldChatSession.objects.create(session_id="s2", chat_history=[], mistake_count=0)
+        updated_at = OldChatSession.objects.get(pk=migrated.pk).updated_at
+
+        apps = self.migrate(self.migrate_to)
+        ChatSession = apps.get_model("chatbot_api", "ChatSession")
+        ChatTurn = apps.get_model("chatbot_api", "ChatTurn")
+        chat_session = ChatSession.objects.get(session_id="s1")
+        self.assertEqual(chat_session.turn_count, 3)
+        self.assertEqual(chat_session.updated_at, updated_at)
+        turns = list(ChatTurn.objects.filter(session=chat_session).order_by("sequence"))
+        self.assertEqual(
+            [(turn.sequence, turn.user_text, turn.bot_text, turn.node_id) for turn in turns],
+            [
+                (1, None, "Please choose a language:", "bill_inquiries"),
+                (2, "English", "Hi, how can I help you today?", "bill_inquiries"),
+                (3, "my bill", "Please select an option:", "bill_inquiries"),
+            ],
+        )
+        self.assertEqual(
+            [turn.timestamp for turn in turns],
+            [
+                updated_at,
+                datetime.datetime(2025, 1, 20, 9, 15, 0, 250000, tzinfo=datetime.timezone.utc),
+                datetime.datetime(2025, 1, 20, 3, 45, 7, tzinfo=datetime.timezone.utc),
+            ],
+        )
+        empty = ChatSession.objects.get(session_id="s2")
+        self.assertEqual((empty.turn_count, ChatTurn.objects.filter(session=empty).count()), (0, 0))
+        self.assertNotIn("chat_history", [field.name for field in ChatSession._meta.get_fields()])
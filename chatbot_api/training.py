@@ -0,0 +1,211 @@
+import pickle
+import time
+import tracemalloc
+import numpy as np
+from bson import json_util
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import precision_recall_fscore_support
+from .chat_history import get_selected_category
+from .classifier import INTENT_LABELS, IntentClassifier, compact_vectorizer, compile_intent_model
+from .tree import conversation_graph
+from .utils import GREETING_REPLY, get_category_node_mapping
+
+TRAINING_LANGUAGE = "English"
+
+
+def read_transcripts(path):
+    """Archived conversations from a dump of the documents save_chat_history writes.
+
+    Accepts a JSON array or one document per line (mongoexport output or the
+    archive journal); Extended JSON values such as dates are decoded.
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        return json_util.loads(text)
+    return [json_util.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def menu_options():
+    """Every option text of every menu, in all languages"""
+    options = set()
+    for nodes in (conversation_graph.root, *conversation_graph.categories.values()):
+        for node in nodes.values():
+            options.update(node.get("options", ()))
+    return options
+
+
+def node_label(node_id, labels=INTENT_LABELS):
+    """Intent label of the category a node belongs to, or None"""
+    label = get_selected_category(conversation_graph.owners.get(node_id, node_id))
+    return label if label in labels else None
+
+
+def entry_message_labels(labels=INTENT_LABELS):
+    """{entry node message: labels of the categories that open with it}, for archives without node ids"""
+    found = {}
+    for category, node_id in get_category_node_mapping().items():
+        node = conversation_graph.node(node_id, TRAINING_LANGUAGE)
+        if node and category in labels:
+            found.setdefault(node["message"], set()).add(category)
+    return found
+
+
+def labelled_turns(documents, labels=INTENT_LABELS):
+    """(text, label) pairs of the free-text messages the intent model classified.
+
+    Only English conversations reach the model. Menu selections, empty
+    messages and digit-only form answers are skipped. Each message is
+    labelled on its own: greetings when the bot greeted back, else the
+    category of the node it led to, for messages sent at a classification
+    node. Archives written before turns carried a node_id are labelled by
+    matching the reply against the entry messages of the categories; when
+    several categories open with that message, the one the conversation
+    ended in is used if it is among them.
+    """
+    options = menu_options()
+    classifying = {node_id for node_id, node in conversation_graph.root.items() if node.get("type") == "classification"}
+    entry_labels = entry_message_labels(labels)
+    examples = []
+    for document in documents:
+        if document.get("selected_language") != TRAINING_LANGUAGE:
+            continue
+        previous = "start"
+        for message in document.get("chat_messages", []):
+            node_id = message.get("node_id")
+            at_classification = previous in classifying
+            previous = node_id
+            text = (message.get("user_message") or "").strip()
+            if not text or text in options or text.replace(" ", "").isdigit():
+                continue
+            reply = message.get("bot_response")
+            if reply == GREETING_REPLY:
+                label = "greetings"
+            elif node_id is None:
+                candidates = entry_labels.get(reply, set())
+                ended_in = document.get("selected_category")
+                label = next(iter(candidates)) if len(candidates) == 1 else ended_in if ended_in in candidates else None
+            else:
+                label = node_label(node_id, labels) if at_classification else None
+            if label in labels:
+                examples.append((text, label))
+    return examples
+
+
+def split_examples(examples, test_size=0.2, seed=0):
+    """Shuffle and split into training and test examples, per label"""
+    rng = np.random.default_rng(seed)
+    by_label = {}
+    for example in examples:
+        by_label.setdefault(example[1], []).append(example)
+    train, test = [], []
+    for label in sorted(by_label):
+        group = by_label[label]
+        rng.shuffle(group)
+        n_test = int(round(len(group) * test_size)) if len(group) > 1 else 0
+        test.extend(group[:n_test])
+        train.extend(group[n_test:])
+    return train, test
+
+
+def indicator_rows(texts_labels, labels=INTENT_LABELS):
+    """One 0/1 column per label, the target layout of the intent model"""
+    Y = np.zeros((len(texts_labels), len(labels)), dtype=int)
+    for i, (_, label) in enumerate(texts_labels):
+        Y[i, labels.index(label)] = 1
+    return Y
+
+
+def train(examples, labels=INTENT_LABELS, n_estimators=100, max_depth=None, seed=0):
+    """Fit a TF-IDF vectorizer and a multi-output random forest like V_5"""
+    vectorizer = TfidfVectorizer()
+    X = vectorizer.fit_transform([text for text, _ in examples])
+    model = RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, random_state=seed, n_jobs=-1)
+    model.fit(X, indicator_rows(examples, labels))
+    return vectorizer, model
+
+
+def serving_classifier(vectorizer, model, labels=INTENT_LABELS):
+    """The classifier as production would run it: compact vectorizer and compiled forest when they verify"""
+    return IntentClassifier(
+        compact_vectorizer(vectorizer) or vectorizer,
+        compile_intent_model(model, vectorizer) or model,
+        labels=labels,
+    )
+
+
+def evaluate(classifier, examples):
+    """Accuracy overall and precision, recall and F1 per category on held-out examples"""
+    labels = list(classifier.labels)
+    Y_true = indicator_rows(examples, labels)
+    Y_pred = np.array(classifier.predict_rows([text for text, _ in examples])).reshape(Y_true.shape)
+    precision, recall, f1, support = precision_recall_fscore_support(Y_true, Y_pred, zero_division=0)
+    return {
+        "examples": len(examples),
+        # The true label is among the predicted ones / exactly the predicted set
+        "accuracy": float((Y_pred[Y_true == 1] == 1).mean()) if examples else 0.0,
+        "exact_match": float((Y_pred == Y_true).all(axis=1).mean()) if examples else 0.0,
+        "macro_f1": float(f1[support > 0].mean()) if support.any() else 0.0,
+        "per_category": {
+            label: {"precision": float(p), "recall": float(r), "f1": float(f), "support": int(n)}
+            for label, p, r, f, n in zip(labels, precision, recall, f1, support)
+        },
+    }
+
+
+def percentiles_ms(timings):
+    timings = np.asarray(timings) * 1000
+    return {name: round(float(np.percentile(timings, q)), 4)
+            for name, q in (("p50", 50), ("p95", 95), ("p99", 99))}
+
+
+def benchmark(classifier, texts, batch_size=32, repeat=3):
+    """Single-row and batched inference latency, and memory of the loaded model"""
+    texts = list(texts) or list(classifier.WARMUP_MESSAGES)
+    classifier.warmup()
+    single = []
+    for _ in range(repeat):
+        for text in texts:
+            start = time.perf_counter()
+            classifier.predict_rows([text])
+            single.append(time.perf_counter() - start)
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    batched = []
+    for _ in range(repeat):
+        for batch in batches:
+            start = time.perf_counter()
+            classifier.predict_rows(batch)
+            batched.append((time.perf_counter() - start) / len(batch))
+
+    tracemalloc.start()
+    classifier.predict_rows(batches[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "single_row_ms": percentiles_ms(single),
+        "batched_ms_per_message": percentiles_ms(batched),
+        "batch_size": batch_size,
+        "model_bytes": footprint(classifier.model),
+        "vectorizer_bytes": footprint(classifier.vectorizer),
+        "batch_peak_alloc_bytes": peak,
+    }
+
+
+def footprint(component):
+    """Bytes a loaded vectorizer or model holds: its arrays if compacted, else its pickle"""
+    if hasattr(component, "ARRAYS"):
+        return int(component.nbytes)
+    return len(pickle.dumps(component))
+
+
+def select(candidates, latency_budget_ms=None):
+    """Best macro F1 among the candidates within the single-row p95 budget, faster on ties"""
+    eligible = [c for c in candidates
+                if latency_budget_ms is None
+                or c["benchmark"]["single_row_ms"]["p95"] <= latency_budget_ms]
+    if not eligible:
+        return None
+    return max(eligible, key=lambda c: (round(c["evaluation"]["macro_f1"], 4),
+                                        -c["benchmark"]["single_row_ms"]["p95"]))
@@ -1,42 +1,152 @@
-# # tree.py
-# import json
-# from typing import Optional, Dict, Any
+import json
+from pathlib import Path
+from types import MappingProxyType
+from .responses import NodeResponse, render_body
 
-# class Tree:
-#     def __init__(self, tree_file: str):
-#         with open(tree_file, "r") as f:
-#             self.tree = json.load(f)
+NODE_DATA_DIR = Path(__file__).resolve().parent.parent / "node_data"
+TREE_FILE = NODE_DATA_DIR / "tree_structure.json"
+CATEGORIES_DIR = NODE_DATA_DIR / "categories"
 
-#     def get_node(self, node_key: str) -> Optional[Dict[str, Any]]:
-#         """Get node information from the tree."""
-#         return self.tree.get(node_key)
+# Category files are named either "<prefix>_<category>.json" or after the language
+LANGUAGE_FILES = {
+    "English": ("en_", "english"),
+    "Sinhala": ("si_", "sinhala"),
+    "Tamil": ("ta_", "tamil"),
+}
 
-#     def get_next_node(self, current_node_key: str, user_input: str) -> Optional[str]:
-#         """Get the next node key based on current node and user input."""
-#         current_node = self.get_node(current_node_key)
-#         if not current_node or "next" not in current_node:
-#             return None
-#         return current_node["next"].get(user_input)
 
-#     def is_valid_option(self, node_key: str, user_input: str) -> bool:
-#         """Check if user input is valid for the current node."""
-#         node = self.get_node(node_key)
-#         return bool(node and "options" in node and user_input in node["options"])
+def freeze(value):
+    """Recursively convert JSON data into read-only mappings and tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
 
 
-import json
+def node_body(node):
+    """Response payload for a static hop onto ``node``"""
+    return {
+        "message": node["message"],
+        "type": node["type"],
+        "options": list(node.get("options", [])),
+        "fields": list(node.get("fields", [])),
+    }
+
+
+def file_language(path):
+    """Return the language a category file belongs to, or None if unknown"""
+    name = path.stem.lower()
+    for language, (prefix, full_name) in LANGUAGE_FILES.items():
+        if name.startswith(prefix) or name == full_name:
+            return language
+    return None
+
+
+class ConversationGraph:
+    """Every conversation node compiled once and shared by the view and all handlers.
+
+    ``root`` holds the nodes from tree_structure.json, ``categories`` the merged
+    nodes of each category folder, ``languages`` the category nodes keyed by
+    language and ``owners`` maps each state to the category whose handler runs it.
+    The response of every node is rendered to JSON bytes once, see ``response()``.
+    """
+
+    def __init__(self, tree_file=TREE_FILE, categories_dir=CATEGORIES_DIR):
+        with open(tree_file, encoding="utf-8") as f:
+            self.root = freeze(json.load(f))
+
+        categories = {}
+        localized = []
+        for category_dir in sorted(p for p in Path(categories_dir).iterdir() if p.is_dir()):
+            nodes = {}
+            for language in LANGUAGE_FILES:
+                for path in sorted(category_dir.glob("*.json")):
+                    if file_language(path) != language or path.stat().st_size == 0:
+                        continue
+                    with open(path, encoding="utf-8") as f:
+                        data = freeze(json.load(f))
+                    nodes.update(data)
+                    localized.append((language, category_dir.name, data))
+            if nodes:
+                categories[category_dir.name] = MappingProxyType(nodes)
 
-class Tree:
-    def __init__(self, tree_file):
-        with open(tree_file, "r") as f:
-            self.tree = json.load(f)
+        self.categories = MappingProxyType(categories)
+        self.owners = MappingProxyType(self._build_owners())
 
-    def get_node(self, node_key):
-        return self.tree.get(node_key)
+        languages = {language: {} for language in LANGUAGE_FILES}
+        for language, category, data in localized:
+            languages[language].update(
+                (node_id, node) for node_id, node in data.items()
+                if self.owners.get(node_id) == category
+            )
+        self.languages = MappingProxyType(
+            {language: MappingProxyType(nodes) for language, nodes in languages.items()}
+        )
+        self._bodies = self._render_bodies()
+        print(f"[INFO] Conversation graph compiled: {len(self.root)} root nodes, "
+              f"{len(self.owners)} handler states, {len(self._bodies)} pre-rendered responses")
 
-    def get_next_node(self, current_node_key, user_input):
-        current_node = self.get_node(current_node_key)
+    def _render_bodies(self):
+        """Render the static response of every node once, keyed by node identity.
+
+        Nodes are immutable and kept alive by the graph, so their ids stay valid.
+        """
+        bodies = {}
+        for nodes in (self.root, *self.categories.values()):
+            for node in nodes.values():
+                bodies[id(node)] = render_body(node_body(node))
+        return bodies
+
+    def _build_owners(self):
+        """Assign every category node to its category, leaving root end nodes to the view"""
+        owners = {}
+        for category, nodes in self.categories.items():
+            for node_id in nodes:
+                root_node = self.root.get(node_id)
+                if root_node and root_node["type"] == "end":
+                    continue
+                if node_id in owners:
+                    print(f"[WARN] Node '{node_id}' defined by both {owners[node_id]} and {category}")
+                    continue
+                owners[node_id] = category
+        return owners
+
+    def category(self, name):
+        """Return the merged nodes of one category (empty if it has no node files)"""
+        return self.categories.get(name, MappingProxyType({}))
+
+    def node(self, node_id, language=None):
+        """Look a node up by language and id; states no handler owns come from the root tree"""
+        category = self.owners.get(node_id)
+        if category is None:
+            return self.root.get(node_id)
+        nodes = self.languages.get(language, {})
+        if node_id in nodes:
+            return nodes[node_id]
+        return self.categories[category][node_id]
+
+    def response(self, node):
+        """Serve the pre-rendered static response of a node"""
+        body = self._bodies.get(id(node))
+        if body is None:
+            body = render_body(node_body(node))
+        return NodeResponse(body)
+
+    def get_next_node(self, current_node_key, user_input, language=None):
+        """Return the next node key for a menu option, or None"""
+        current_node = self.node(current_node_key, language)
         if not current_node or current_node["type"] != "menu":
             return None
-        next_node_key = current_node["next"].get(user_input)
-        return next_node_key
+        return current_node["next"].get(user_input)
+
+    def dispatch_table(self, handlers):
+        """Resolve the owning handler of every state once: {state: handler}"""
+        return {
+            state: handlers[category]
+            for state, category in self.owners.items()
+            if category in handlers
+        }
+
+
+conversation_graph = ConversationGraph()
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .circuit import circuit_for
+
+# One pooled session per process, created on first use; pooled sockets
+# must not be shared across fork(), so a child process gets its own
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+# Threads that run blocking upstream calls side by side, see run_concurrently()
+_executor = None
+_executor_pid = None
+
+# One pooled async client per event loop; a client cannot be shared across loops
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def billing_url(endpoint):
+    """URL of a billing API endpoint, e.g. billing_url("GetAccountBalance")"""
+    return f"{settings.BILLING_API_BASE_URL.rstrip('/')}/{endpoint}"
+
+
+def build_retry():
+    """Bounded retries with jittered exponential backoff, for idempotent GETs only.
+
+    Only failed connection attempts and 502/503/504 replies are retried. A
+    read timeout is not: the upstream may still be working on the request,
+    and retrying would multiply a full read timeout per attempt.
+    """
+    return Retry(
+        total=settings.UPSTREAM_RETRIES,
+        connect=settings.UPSTREAM_RETRIES,
+        read=0,
+        status=settings.UPSTREAM_RETRIES,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        backoff_factor=settings.UPSTREAM_RETRY_BACKOFF,
+        backoff_jitter=settings.UPSTREAM_RETRY_BACKOFF,
+        raise_on_status=False,
+    )
+
+
+class UpstreamSession(requests.Session):
+    """A session whose calls default to the configured connect and read timeouts.
+
+    Every call goes through the circuit breaker of its host: errors and 5xx
+    replies count as failures, and an open circuit raises CircuitOpenError
+    without touching the network.
+    """
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", (settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_READ_TIMEOUT))
+        breaker = circuit_for(url)
+        probe = breaker.before_call()
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, **kwargs)
+        except BaseException as e:
+            breaker.record(time.perf_counter() - start, True, probe, type(e).__name__)
+            raise
+        failed = response.status_code >= 500
+        breaker.record(time.perf_counter() - start, failed, probe, f"HTTP {response.status_code}" if failed else None)
+        return response
+
+
+class CircuitTransport(httpx.AsyncBaseTransport):
+    """httpx transport that sends every request through the circuit breaker of its host"""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        breaker = circuit_for(request.url)
+        probe = breaker.before_call()
+        start = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException as e:
+            breaker.record(time.perf_counter() - start, True, probe, type(e).__name__)
+            raise
+        failed = response.status_code >= 500
+        breaker.record(time.perf_counter() - start, failed, probe, f"HTTP {response.status_code}" if failed else None)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def get_session():
+    """Return this process's keep-alive requests session, creating it on first use.
+
+    Connections to each upstream host are pooled and reused across requests
+    and threads; every call gets separate connect and read timeouts.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+    with _lock:
+        if _session is None or _session_pid != pid:
+            session = UpstreamSession()
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=settings.UPSTREAM_POOL_SIZE,
+                max_retries=build_retry(),
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session, _session_pid = session, pid
+            print(f"[INFO] Upstream HTTP session created (pid {pid}, pool size {settings.UPSTREAM_POOL_SIZE})")
+    return _session
+
+
+def get_async_client():
+    """Return the keep-alive httpx client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.UPSTREAM_READ_TIMEOUT, connect=settings.UPSTREAM_CONNECT_TIMEOUT),
+            # httpx retries failed connection attempts only
+            transport=CircuitTransport(httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(max_connections=settings.UPSTREAM_POOL_SIZE),
+                retries=settings.UPSTREAM_RETRIES,
+            )),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def run_concurrently(*calls):
+    """Run blocking upstream calls side by side and return their results in order.
+
+    The first call runs on the calling thread and the rest on a shared
+    thread pool. An exception of any call is re-raised.
+    """
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ThreadPoolExecutor(max_workers=settings.UPSTREAM_POOL_SIZE,
+                                               thread_name_prefix="upstream-call")
+                _executor_pid = pid
+    futures = [_executor.submit(call) for call in calls[1:]]
+    try:
+        first = calls[0]()
+    finally:
+        # Wait for the others either way, so none outlives the turn
+        wait(futures)
+    return [first, *(future.result() for future in futures)]
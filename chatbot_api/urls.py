@@ -1,6 +1,11 @@
 from django.urls import path
-from .views import ChatbotAPI
+from .views import ChatbotAPI, ChatbotBatchAPI, AsyncChatbotAPI, ChatbotStatsAPI, ChatbotModelAPI, BillingCacheAPI
 
 urlpatterns = [
     path("chatbot/", ChatbotAPI.as_view(), name="chatbot_api"),
+    path("chatbot/batch/", ChatbotBatchAPI.as_view(), name="chatbot_api_batch"),
+    path("chatbot/async/", AsyncChatbotAPI.as_view(), name="chatbot_api_async"),
+    path("chatbot/stats/", ChatbotStatsAPI.as_view(), name="chatbot_api_stats"),
+    path("chatbot/model/", ChatbotModelAPI.as_view(), name="chatbot_api_model"),
+    path("chatbot/billing-cache/", BillingCacheAPI.as_view(), name="chatbot_api_billing_cache"),
 ]
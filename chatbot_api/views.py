@@ -1,208 +1,190 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.renderers import JSONRenderer
 from rest_framework import status
-from .models import ChatSession
-from .utils import handle_english_message, intent_model  # Add intent_model import
-from .chat_history import save_chat_history, check_session_timeout  # Import methods from chat_history.py
+from .chat_history import check_session_timeout
+import hmac
 import json
-from pymongo import MongoClient 
-import datetime
-import os
-from dotenv import load_dotenv
+from .engine import run_turn, run_batch, advance, start_workers, STATE_PREFETCHERS, SESSION_EXPIRED, SESSION_CONFLICT
+from .session_store import session_store, SessionConflict
+from .circuit import circuit_stats
+from .classifier import model_registry
+from .lookup_cache import billing_cache
+from .responses import NodeResponse, to_http_response, render_batch
 from node_data.handlers.bill_inquiries import BillInquiriesHandler
-from node_data.handlers.solar_service import SolarServiceHandler  # Import SolarServiceHandler
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 
-# # Load environment variables
-# load_dotenv()
-
-# # Initialize MongoDB client and collection with environment variables
-# MONGO_URI = os.getenv('MONGO_URI')
-# MONGO_DB = os.getenv('MONGO_DB', 'default_db')
-# MONGO_COLLECTION = os.getenv('MONGO_COLLECTION', 'default_collection')
-
-# client = MongoClient(MONGO_URI)
-# db = client[MONGO_DB]
-# collection = db[MONGO_COLLECTION]
-
-# Load the conversation tree
-with open("node_data/tree_structure.json", encoding="utf-8") as f:
-    tree_structure = json.load(f)
-
-categories = [
-    'greetings', 
-    'Fault Reporting', 
-    'Bill Inquiries', 
-    'New Connection Requests', 
-    'Incident Reports', 
-    'Solar Services' 
-]
 
 class ChatbotAPI(APIView):
-    def __init__(self):
-        super().__init__()
-        self.bill_handler = BillInquiriesHandler()
-        self.solar_handler = SolarServiceHandler()  # Initialize SolarServiceHandler
-
-    def get_category_node_mapping(self):
-        return {
-            'Fault Reporting': 'fault_reporting',
-            'Bill Inquiries': 'bill_inquiries',
-            'New Connection Requests': 'new_connection',
-            'Incident Reports': 'fault_reporting',
-            'Solar Services': 'solar_service'
-        }
-
-    # def get_selected_category(self, state):
-    #     category_mapping = {
-    #         'fault_reporting': 'Fault Reporting',
-    #         'bill_inquiries': 'Bill Inquiries',
-    #         'new_connection': 'New Connection Requests',
-    #         'solar_service': 'Solar Services',
-    #         'other_services': 'Other Services'
-    #     }
-    #     return category_mapping.get(state, "Unknown")
+    renderer_classes = [JSONRenderer]
+
+    def perform_content_negotiation(self, request, force=False):
+        # The chatbot only ever answers JSON, so skip Accept header negotiation
+        renderer = self.renderer_classes[0]()
+        return (renderer, renderer.media_type)
 
     def post(self, request):
         session_id = request.data.get("session_id")
         user_message = request.data.get("message")
 
-        chat_session, created = ChatSession.objects.get_or_create(session_id=session_id)
-        
-        # Handle session timeout
-        if not created and check_session_timeout(chat_session):
-            return Response({
-                "message": "Session has expired due to inactivity. Please start a new session.",
-                "type": "timeout"
-            }, status=status.HTTP_408_REQUEST_TIMEOUT)
-
-        # Handle new session
-        if created:
-            current_node = tree_structure["start"]
-            chat_session.state = "start"
-            chat_session.save()
-            return Response({
-                "message": current_node["message"],
-                "type": current_node["type"],
-                "options": current_node["options"]
-            })
-
-        current_node = tree_structure.get(chat_session.state)
-        
-        # Preserve language selection through the entire session
-        if chat_session.state == "start" and user_message in current_node["options"]:
-            next_node_key = current_node["next"][user_message]
-            next_node = tree_structure[next_node_key]
-            chat_session.selected_language = user_message
-            chat_session.state = next_node_key
-            chat_session.chat_history.append({
-                "user": user_message,
-                "bot": next_node["message"],
-                "timestamp": datetime.datetime.now().isoformat()
-            })
-            chat_session.save()
-            return Response({
-                "message": next_node["message"],
-                "type": next_node["type"],
-                "options": next_node.get("options", [])
-            })
-
-        if not current_node:
-            # Don't reset to start if in bill inquiry flow
-            if not chat_session.state.startswith(('verification', 'contact_verification', 'display_balance')):
-                chat_session.state = "start"
-                chat_session.save()
-                return Response({
-                    "message": tree_structure["start"]["message"],
-                    "type": "menu",
-                    "options": tree_structure["start"]["options"]
-                })
-
-        # Handle bill inquiries with state preservation
-        if chat_session.state.startswith(('bill_', 'verification', 'contact_verification', 'display_balance')):
-            return self.bill_handler.handle_bill_inquiry(chat_session, user_message, current_node)
-
-        # Handle solar services with state preservation
-        if chat_session.state.startswith('solar_service'):
-            return self.solar_handler.handle_solar_service(chat_session, user_message, current_node)
-
-        if chat_session.state == "solar_details":
-            return self.solar_handler.handle_solar_service(chat_session, user_message, "solar_details")
-
-        if current_node["type"] == "menu":
-            if user_message in current_node["options"]:
-                next_node_key = current_node["next"][user_message]
-                next_node = tree_structure[next_node_key]
-                if next_node_key == "bill_inquiries":
-                    chat_session.state = "bill_inquiries"
-                    chat_session.save()
-                    return self.bill_handler.handle_bill_inquiry(chat_session, user_message, tree_structure[next_node_key])
-                if next_node_key == "solar_service":
-                    chat_session.state = "solar_service"
-                    chat_session.save()
-                    return self.solar_handler.handle_solar_service(chat_session, user_message, tree_structure[next_node_key])
-                chat_session.state = next_node_key
-                chat_session.chat_history.append({
-                    "user": user_message,
-                    "bot": next_node["message"]
-                })
-                chat_session.save()
-                return Response({
-                    "message": next_node["message"],
-                    "type": next_node["type"],
-                    "options": next_node.get("options", [])
-                })
+        return run_turn(session_id, user_message)
+
+
+class ChatbotBatchAPI(ChatbotAPI):
+    """Many turns in one request, for the telephony gateway.
+
+    Body: {"turns": [{"session_id": ..., "message": ...}, ...]}. Sessions are
+    checked out of the session store together and written back in one bulk
+    update; the results come back in the order of the turns.
+    """
+
+    MAX_TURNS = 500
+
+    def post(self, request):
+        turns = request.data.get("turns") if isinstance(request.data, dict) else None
+        if (not isinstance(turns, list) or not turns or len(turns) > self.MAX_TURNS
+                or not all(isinstance(turn, dict) and turn.get("session_id") for turn in turns)):
             return Response({
-                "message": "Please select a valid option",
-                "type": "menu",
-                "options": current_node["options"]
-            })
-
-        if current_node["type"] == "message" or current_node["type"] == "classification":
-            chat_session.chat_history.append({
-                "user": user_message,
-                "bot": None
-            })
-            if chat_session.state == "english_start":
-                return handle_english_message(chat_session, user_message, categories, tree_structure)
-            try:
-                intent = intent_model.predict([user_message])[0]
-                response_message = f"Identified intent: {intent}"
-                next_node_key = current_node.get("next", {}).get(intent)
-                if next_node_key:
-                    chat_session.state = next_node_key
-                    next_node_data = tree_structure[next_node_key]
-                    chat_session.chat_history[-1]["bot"] = response_message
-                    chat_session.save()
-                    if next_node_key == "solar_service":
-                        return self.solar_handler.handle_solar_service(chat_session, user_message, next_node_data)
-                    return Response({
-                        "message": response_message,
-                        "type": "menu",
-                        "options": next_node_data["options"]
-                    })
-            except Exception:
-                return Response({
-                    "message": "I couldn't understand. Would you like to:",
-                    "type": "menu",
-                    "options": ["Try Again", "Main Menu", "Exit"]
-                })
-
-        if current_node["type"] == "end":
-            if save_chat_history(session_id, chat_session, user_message):
-                chat_session.delete()
-                return Response({
-                    "message": current_node["message"],
-                    "type": "end"
-                })
+                "message": f"Expected 1-{self.MAX_TURNS} turns, each with a session_id",
+                "type": "error"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        turns = [(turn["session_id"], turn.get("message")) for turn in turns]
+        responses = run_batch(turns)
+        return NodeResponse(render_batch([session_id for session_id, _ in turns], responses))
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncChatbotAPI(View):
+    """Async version of ChatbotAPI, meant to be served through chatbot_project.asgi.
+
+    The upstream calls a turn needs are awaited on the event loop, so a
+    worker is not held while a caller waits on the billing or solar
+    services. The turn itself is the same advance() the sync endpoint runs,
+    on a session checked out of the same session store.
+    """
+
+    async def post(self, request):
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError:
+            return JsonResponse({"message": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+        session_id = data.get("session_id")
+        user_message = data.get("message")
+
+        start_workers()
+        try:
+            return await self._run_turn(session_id, user_message)
+        except SessionConflict:
+            return JsonResponse(SESSION_CONFLICT, status=status.HTTP_409_CONFLICT)
+
+    async def _run_turn(self, session_id, user_message):
+        chat_session, created = await session_store.acheckout(session_id)
+        try:
+            if not created and check_session_timeout(chat_session):
+                response = JsonResponse(SESSION_EXPIRED, status=status.HTTP_408_REQUEST_TIMEOUT)
             else:
-                return Response({
-                    "message": "Error saving chat history. Please try again.",
-                    "type": "error"
-                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                # Await the upstream lookups this turn will need before running it
+                prefetch = STATE_PREFETCHERS.get(chat_session.state)
+                if prefetch and not created:
+                    await prefetch(chat_session, user_message)
+                response = to_http_response(
+                    await sync_to_async(advance)(chat_session, user_message, created)
+                )
+        except BaseException:
+            await session_store.acheckin(chat_session, commit=False)
+            raise
+        await session_store.acheckin(chat_session)
+        return response
+
+
+class ChatbotStatsAPI(APIView):
+    """Runtime counters for monitoring"""
+    renderer_classes = [JSONRenderer]
+
+    def get(self, request):
+        return Response({
+            **model_registry.stats(),
+            "billing_cache": billing_cache.stats(),
+            "upstream_circuits": circuit_stats(),
+        })
+
+
+class AdminAPI(APIView):
+    """Endpoints for operators, allowed with settings.INTENT_MODEL_ADMIN_TOKEN in X-Admin-Token"""
+    renderer_classes = [JSONRenderer]
+    denied_message = "Administration is not allowed"
+
+    def check_permissions(self, request):
+        token = getattr(settings, "INTENT_MODEL_ADMIN_TOKEN", "")
+        if not token or not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+            self.permission_denied(request, message=self.denied_message)
+
+
+class ChatbotModelAPI(AdminAPI):
+    """Inspect, activate and roll back intent model versions of the registry.
+
+    POST {"action": "activate", "version": "v6"} or {"action": "rollback"};
+    {"action": "shadow", "version": "v7"} runs v7 as a shadow candidate and
+    {"action": "stop_shadow"} ends that. GET includes the shadow report.
+    Requests must carry settings.INTENT_MODEL_ADMIN_TOKEN in X-Admin-Token;
+    the endpoint is disabled while that setting is empty. Other worker
+    processes follow the change through the registry manifest.
+    """
+    denied_message = "Model administration is not allowed"
+
+    def report(self):
+        stats = model_registry.stats()
+        return {**stats["model_registry"], "shadow": stats["intent_shadow"]}
+
+    def get(self, request):
+        return Response(self.report())
+
+    def post(self, request):
+        action = request.data.get("action")
+        try:
+            if action == "activate":
+                model_registry.activate(request.data.get("version"))
+            elif action == "rollback":
+                model_registry.rollback()
+            elif action == "shadow":
+                model_registry.start_shadow(request.data.get("version"))
+            elif action == "stop_shadow":
+                model_registry.stop_shadow()
+            else:
+                return Response({"message": "action must be 'activate', 'rollback', 'shadow' or 'stop_shadow'"},
+                                status=status.HTTP_400_BAD_REQUEST)
+        except (OSError, ValueError) as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.report())
 
-        if chat_session.state == "english_menu" and current_node["type"] == "message":
-            return handle_english_message(chat_session, user_message, categories, tree_structure)
 
-        return Response({"message": "Something went wrong"}, status=status.HTTP_400_BAD_REQUEST)
+class BillingCacheAPI(AdminAPI):
+    """Drop cached billing lookups known to be out of date, e.g. after a payment.
 
+    POST {"accounts": [...], "contacts": [...]} forgets those accounts (and
+    the contacts found for them) and contacts; {"clear": true} forgets
+    everything. Only the worker process serving the request is affected.
+    """
+    denied_message = "Billing cache administration is not allowed"
 
+    def get(self, request):
+        return Response(billing_cache.stats())
+
+    def post(self, request):
+        accounts = request.data.get("accounts") or []
+        contacts = request.data.get("contacts") or []
+        if not isinstance(accounts, list) or not isinstance(contacts, list):
+            return Response({"message": "accounts and contacts must be lists of numbers"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        handler = BillInquiriesHandler()
+        if request.data.get("clear"):
+            billing_cache.clear()
+        invalidated = sum(handler.invalidate_account(str(number)) for number in accounts)
+        invalidated += sum(handler.invalidate_contact(str(number)) for number in contacts)
+        return Response({"invalidated": invalidated, **billing_cache.stats()})
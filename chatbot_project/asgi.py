@@ -14,3 +14,10 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chatbot_project.settings")
 
 application = get_asgi_application()
+
+# Load the models before a preforking server (gunicorn --preload) forks its
+# workers, so they share one frozen copy
+if os.getenv("CHATBOT_PRELOAD", "true").lower() == "true":
+    from chatbot_api.preload import preload
+
+    preload()
@@ -131,21 +131,123 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 from dotenv import load_dotenv
 import os
-from pymongo import MongoClient
 
 load_dotenv()
 
-uri = os.getenv("MONGO_URI")
-database_name = os.getenv("MONGO_DB")
-collection_name = os.getenv("MONGO_COLLECTION")
-
-client = MongoClient(uri)
-if database_name is None:
-    raise ValueError("MONGO_DB environment variable is not set")
-db = client[database_name]
-if collection_name is None:
-    raise ValueError("MONGO_COLLECTION environment variable is not set")
-collection = db[collection_name]
+# MongoDB archive of finished conversations. The client is created on the
+# first archival (chatbot_api/mongo.py), so starting up does not need Mongo.
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DB = os.getenv("MONGO_DB")
+MONGO_COLLECTION = os.getenv("MONGO_COLLECTION")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "10"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+
+# Where chat sessions live between turns (see chatbot_api/session_store.py):
+# "orm" reads and writes the database on every turn, "memory" keeps hot sessions
+# in an in-process LRU and writes them behind every CHAT_SESSION_FLUSH_INTERVAL
+# seconds (one worker process, or sticky routing), "cache" keeps them in the
+# CACHES entry CHAT_SESSION_CACHE_ALIAS and writes through to the database.
+CHAT_SESSION_STORE = os.getenv("CHAT_SESSION_STORE", "orm")
+CHAT_SESSION_CACHE_SIZE = int(os.getenv("CHAT_SESSION_CACHE_SIZE", "10000"))
+CHAT_SESSION_CACHE_TTL = int(os.getenv("CHAT_SESSION_CACHE_TTL", "300"))
+CHAT_SESSION_FLUSH_INTERVAL = float(os.getenv("CHAT_SESSION_FLUSH_INTERVAL", "1.0"))
+CHAT_SESSION_CACHE_ALIAS = os.getenv("CHAT_SESSION_CACHE_ALIAS", "default")
+# "memory" with several worker processes is only safe when the load balancer
+# sends every request of a session to the same worker; say so here, otherwise
+# gunicorn.conf.py refuses to start more than one worker with it.
+CHAT_SESSION_STICKY_ROUTING = os.getenv("CHAT_SESSION_STICKY_ROUTING", "false").lower() == "true"
+# "cache": a turn leases its session for up to CHAT_SESSION_LEASE_SECONDS and
+# waits up to CHAT_SESSION_LEASE_WAIT seconds for another turn's lease;
+# turns that time out or outlive their lease get a 409 and are not stored.
+CHAT_SESSION_LEASE_SECONDS = int(os.getenv("CHAT_SESSION_LEASE_SECONDS", "60"))
+CHAT_SESSION_LEASE_WAIT = float(os.getenv("CHAT_SESSION_LEASE_WAIT", "10"))
+
+# Upstream services called by the conversation handlers. For load tests,
+# point BILLING_API_BASE_URL and SOLAR_CHAT_URL at "manage.py stub_upstreams".
+BILLING_API_BASE_URL = os.getenv("BILLING_API_BASE_URL", "http://124.43.163.177:8080/CCLECO/Main")
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "10"))
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "20"))
+# GETs that fail to connect or get a 502/503/504 are retried up to
+# UPSTREAM_RETRIES times (read timeouts are not), waiting about
+# UPSTREAM_RETRY_BACKOFF * 2^n seconds plus up to as much again of jitter
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.2"))
+# The solar Q&A service; its answers may take longer than a billing lookup
+SOLAR_CHAT_URL = os.getenv("SOLAR_CHAT_URL", "http://localhost:8001/chat/")
+SOLAR_CHAT_READ_TIMEOUT = float(os.getenv("SOLAR_CHAT_READ_TIMEOUT", "20"))
+
+# Each upstream host has a circuit breaker over its last CIRCUIT_WINDOW_SECONDS
+# of calls. With at least CIRCUIT_MIN_CALLS calls, it opens when
+# CIRCUIT_FAILURE_RATE of them failed or CIRCUIT_SLOW_CALL_RATE took
+# CIRCUIT_SLOW_CALL_SECONDS or more; calls then fail fast for
+# CIRCUIT_OPEN_SECONDS, after which one probe call decides whether it closes
+CIRCUIT_WINDOW_SECONDS = int(os.getenv("CIRCUIT_WINDOW_SECONDS", "30"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "5"))
+CIRCUIT_SLOW_CALL_RATE = float(os.getenv("CIRCUIT_SLOW_CALL_RATE", "0.8"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "15"))
+
+# Billing lookups are cached per process for BILLING_CACHE_TTL seconds, and
+# "no such account/contact" answers for BILLING_CACHE_NEGATIVE_TTL; failed
+# calls are never cached. An account is invalidated once its balance was
+# shown, and /api/chatbot/billing-cache/ invalidates accounts and contacts on
+# demand (in the worker serving that request); anything else may be up to
+# BILLING_CACHE_TTL seconds old.
+BILLING_CACHE_TTL = float(os.getenv("BILLING_CACHE_TTL", "60"))
+BILLING_CACHE_NEGATIVE_TTL = float(os.getenv("BILLING_CACHE_NEGATIVE_TTL", "15"))
+BILLING_CACHE_SIZE = int(os.getenv("BILLING_CACHE_SIZE", "10000"))
+
+# Expired sessions are archived to Mongo and deleted by a background sweeper
+# every CHAT_SESSION_SWEEP_INTERVAL seconds in each worker process. Archives
+# are keyed by session, so overlapping sweeps store a session once; set 0 to
+# disable the in-process sweeper and run "manage.py sweep_sessions" from cron.
+CHAT_SESSION_SWEEP_INTERVAL = float(os.getenv("CHAT_SESSION_SWEEP_INTERVAL", "60"))
+CHAT_SESSION_SWEEP_BATCH_SIZE = int(os.getenv("CHAT_SESSION_SWEEP_BATCH_SIZE", "500"))
+
+# Finished conversations are queued and archived to Mongo by a background
+# writer; transcripts Mongo cannot take are kept in this journal and replayed
+CHAT_ARCHIVE_QUEUE_SIZE = int(os.getenv("CHAT_ARCHIVE_QUEUE_SIZE", "1000"))
+CHAT_ARCHIVE_BATCH_SIZE = int(os.getenv("CHAT_ARCHIVE_BATCH_SIZE", "100"))
+CHAT_ARCHIVE_JOURNAL = os.getenv("CHAT_ARCHIVE_JOURNAL", str(BASE_DIR / "logs" / "archive_journal.jsonl"))
+
+# Evaluate the RandomForest intent model from flat arrays instead of sklearn
+# (checked against sklearn at load; falls back to sklearn on any disagreement)
+INTENT_MODEL_COMPILED = os.getenv("INTENT_MODEL_COMPILED", "true").lower() == "true"
+
+# Featurize messages with the TF-IDF vocabulary frozen into hashed arrays
+# instead of the sklearn vectorizer (output checked identical at load)
+INTENT_VECTORIZER_COMPACT = os.getenv("INTENT_VECTORIZER_COMPACT", "true").lower() == "true"
+
+# Per-category keywords that route a message without running the intent model
+INTENT_KEYWORDS_FILE = os.getenv("INTENT_KEYWORDS_FILE", str(BASE_DIR / "node_data" / "intent_keywords.json"))
+
+# Intent predictions cached per normalized message text
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "4096"))
+
+# Cache misses from all request threads are classified together in micro-batches
+# collected for up to INTENT_BATCH_WINDOW_MS or until INTENT_BATCH_MAX_SIZE wait
+INTENT_BATCH_WINDOW_MS = float(os.getenv("INTENT_BATCH_WINDOW_MS", "2"))
+INTENT_BATCH_MAX_SIZE = int(os.getenv("INTENT_BATCH_MAX_SIZE", "32"))
+
+# Versioned intent models and their manifest.json; every worker checks the
+# manifest each INTENT_MODEL_POLL_INTERVAL seconds and swaps models in place.
+# A version only goes live if it labels at least INTENT_SMOKE_MIN_ACCURACY of
+# the smoke set correctly. Without a manifest the V_5 model in models/ is used.
+INTENT_MODEL_REGISTRY = os.getenv("INTENT_MODEL_REGISTRY", str(BASE_DIR / "models" / "registry"))
+INTENT_MODEL_POLL_INTERVAL = float(os.getenv("INTENT_MODEL_POLL_INTERVAL", "5"))
+INTENT_SMOKE_SET_FILE = os.getenv("INTENT_SMOKE_SET_FILE", str(BASE_DIR / "node_data" / "intent_smoke.json"))
+INTENT_SMOKE_MIN_ACCURACY = float(os.getenv("INTENT_SMOKE_MIN_ACCURACY", "0.8"))
+# A version set as the manifest's "shadow" runs next to the live model on a
+# background thread; messages beyond INTENT_SHADOW_QUEUE_SIZE waiting are dropped
+INTENT_SHADOW_QUEUE_SIZE = int(os.getenv("INTENT_SHADOW_QUEUE_SIZE", "256"))
+INTENT_SHADOW_SAMPLE_RATE = float(os.getenv("INTENT_SHADOW_SAMPLE_RATE", "1.0"))
+# Required in X-Admin-Token by /api/chatbot/model/ and /api/chatbot/billing-cache/
+# (empty disables both endpoints)
+INTENT_MODEL_ADMIN_TOKEN = os.getenv("INTENT_MODEL_ADMIN_TOKEN", "")
 
 
 LOGGING = {
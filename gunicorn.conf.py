@@ -0,0 +1,23 @@
+# gunicorn -c gunicorn.conf.py chatbot_project.wsgi
+import os
+from dotenv import load_dotenv
+
+# Same environment the Django settings see
+load_dotenv()
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+# Import the app (and load the models) once in the master; workers share it copy-on-write
+preload_app = True
+
+
+def on_starting(server):
+    # The memory session store is per process: several workers without sticky
+    # routing would each keep and write back their own copy of a session
+    if (os.getenv("CHAT_SESSION_STORE", "orm") == "memory" and server.cfg.workers > 1
+            and os.getenv("CHAT_SESSION_STICKY_ROUTING", "false").lower() != "true"):
+        raise RuntimeError(
+            f"CHAT_SESSION_STORE=memory needs a single worker (got {server.cfg.workers}); "
+            "set GUNICORN_WORKERS=1, use CHAT_SESSION_STORE=cache, or set "
+            "CHAT_SESSION_STICKY_ROUTING=true if each session is routed to one worker"
+        )
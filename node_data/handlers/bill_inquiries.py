@@ -1,15 +1,31 @@
-import json
-from pathlib import Path
 from rest_framework.response import Response
+import asyncio
 import requests
+import httpx
 import re
+from chatbot_api.tree import conversation_graph
+from chatbot_api.circuit import CircuitOpenError
+from chatbot_api.lookup_cache import billing_cache
+from chatbot_api.upstream import billing_url, get_async_client, get_session, run_concurrently
+
+# A 10-digit number, optionally written in 3-3-4 groups ("071 444 5598")
+NUMBER_PATTERN = re.compile(r'(?<!\d)\d{3}[\s-]?\d{3}[\s-]?\d{4}(?!\d)')
+ACCOUNT_WORDS = re.compile(r'acc(?:oun)?t|a/c', re.IGNORECASE)
+CONTACT_WORDS = re.compile(r'phone|mobile|contact|tel|cell', re.IGNORECASE)
+
+
+def invalid_account(result):
+    return not result.get('valid')
+
+
+def unknown_contact(result):
+    return not result.get('account_number')
+
 
 class BillInquiriesHandler:
     """Handler class for managing bill inquiry related interactions"""
     
     _instance = None  # Class variable for singleton pattern
-    account_numbers = {}  # Dictionary to store account numbers with session IDs
-    account_balances = {}  # Dictionary to store account balances with session IDs
     
     def __new__(cls):
         # Implement singleton pattern to avoid multiple initializations
@@ -34,23 +50,10 @@ class BillInquiriesHandler:
             print("[DEBUG] Using existing BillInquiriesHandler instance")
     
     def _load_nodes(self):
-        """Load conversation flow nodes from JSON files (English and Sinhala)"""
+        """Attach the bill inquiry nodes (English and Sinhala) from the shared conversation graph"""
         print("[INFO] Loading node data")
-        base_path = Path(__file__).parent.parent / "categories" / "bill_inquiries"
-        try:
-            with open(base_path / "en_bill_inquiries.json", encoding='utf-8') as f:
-                data = json.load(f)
-                self.nodes["bill_inquiries"] = data["bill_inquiries"]
-                self.nodes.update(data)
-            
-            with open(base_path / "si_bill_inquiries.json", encoding='utf-8') as f:
-                data = json.load(f)
-                self.nodes["bill_inquiries_si"] = data["bill_inquiries_si"]
-                self.nodes.update(data)
-            print("[INFO] Successfully loaded node data")
-        except Exception as e:
-            print(f"[ERROR] Error loading bill inquiry nodes: {e}")
-            raise
+        self.nodes = conversation_graph.category("bill_inquiries")
+        print("[INFO] Successfully loaded node data")
 
     def handle_bill_inquiry(self, chat_session, user_message, current_node):
         """Handle bill inquiry with improved logging"""
@@ -61,7 +64,7 @@ class BillInquiriesHandler:
         print(f"[INFO] Language: {chat_session.selected_language}")
 
         try:
-            if chat_session.state in ["verification", "contact_verification", "display_balance"]:
+            if chat_session.state in ["verification", "contact_verification"]:
                 return self._handle_form_input(chat_session, user_message, self.nodes[chat_session.state])
             
             current_bill_node = self.nodes.get(chat_session.state, self.nodes["bill_inquiries"])
@@ -91,24 +94,23 @@ class BillInquiriesHandler:
         print(f"[DEBUG] Available options: {current_bill_node['options']}")
         print(f"[DEBUG] User selected: {user_message}")
         
+        if user_message not in current_bill_node["options"] and chat_session.state == "bill_inquiries":
+            account_number, _ = self.extract_identifiers(user_message)
+            if account_number:
+                # Numbers typed at the menu start the balance check right away
+                print("[INFO] Account number given at the menu, verifying it")
+                chat_session.state = "verification"
+                return self._handle_form_input(chat_session, user_message, self.nodes["verification"])
+
         if user_message in current_bill_node["options"]:
             next_node_key = current_bill_node["next"][user_message]
             next_node = self.nodes.get(next_node_key)
             
             if next_node:
                 chat_session.state = next_node_key
-                chat_session.chat_history.append({
-                    "user": user_message,
-                    "bot": next_node["message"]
-                })
-                chat_session.save()
+                chat_session.add_turn(user_message, next_node["message"])
                 
-                return Response({
-                    "message": next_node["message"],
-                    "type": next_node["type"],
-                    "options": next_node.get("options", []),
-                    "fields": next_node.get("fields", [])
-                })
+                return conversation_graph.response(next_node)
         
         return Response({
             "message": "Invalid option. Please select from the menu.",
@@ -123,17 +125,12 @@ class BillInquiriesHandler:
         print(f"[INFO] User input: {user_message}")
         
         stored_account = ''
-        
-        if not hasattr(chat_session, 'temp_data'):
-            chat_session.temp_data = {}
 
-        chat_session.chat_history.append({
-            "user": user_message,
-            "bot": "Processing your request..."
-        })
+        chat_session.add_turn(user_message, "Processing your request...")
 
         try:
-            stored_account = self.account_numbers.get(chat_session.id, '')
+            # Kept on the session, so the next turn finds it on any worker
+            stored_account = chat_session.temp_data.get('account', '')
             print(f"[DEBUG] Retrieved stored account number: {stored_account}")
 
             if chat_session.state == "verification":
@@ -145,6 +142,8 @@ class BillInquiriesHandler:
             elif chat_session.state == "account_comparison":
                 return self._handle_account_comparison(chat_session, user_message)
 
+        except CircuitOpenError as e:
+            return self._service_unavailable(chat_session, e)
         except Exception as e:
             print(f"[ERROR] Form input processing error: {str(e)}")
             return self._handle_error(chat_session, user_message, stored_account)
@@ -153,32 +152,39 @@ class BillInquiriesHandler:
         """Verify the account number provided by the user"""
         print("[DEBUG] Processing account verification")
         
-        if not re.match(r'^\d{10}$', user_message):
+        account_number, contact_number = self.extract_identifiers(user_message)
+        if not account_number:
             return Response({
                 "message": "Please enter a valid 10-digit account number.",
                 "type": "form",
                 "fields": ["account_number"]
             })
 
-        chat_session.temp_data['account'] = user_message
-        self.account_numbers[chat_session.id] = user_message
+        chat_session.temp_data['account'] = account_number
         print(f"[DEBUG] Stored account number: {chat_session.temp_data['account']}")
-        chat_session.save()
 
-        result = self.validate_account_number_with_api(user_message)
+        if contact_number:
+            # Both numbers in one message: look them up side by side
+            print(f"[INFO] Contact number {contact_number} given with the account, verifying both")
+            result, contact_result = run_concurrently(
+                lambda: self._lookup(chat_session, "account", account_number, self.validate_account_number_with_api),
+                lambda: self._lookup(chat_session, "contact", contact_number, self.validate_contact_number_with_api),
+            )
+        else:
+            result = self._lookup(chat_session, "account", account_number, self.validate_account_number_with_api)
         print(f"[DEBUG] API validation result: {result}")
         
         if result['valid']:
-            print(f"[INFO] Account {user_message} validated successfully")
+            print(f"[INFO] Account {account_number} validated successfully")
             chat_session.temp_data['balance'] = result['balance']
-            self.account_balances[chat_session.id] = result['balance']
             print(f"[DEBUG] Stored balance: {chat_session.temp_data['balance']}")
-            chat_session.save()
+
+            if contact_number:
+                return self._compare_contact(chat_session, contact_number, account_number, contact_result)
             
             chat_session.state = "contact_verification"
             next_message = self.nodes["contact_verification"]["message"]
-            chat_session.chat_history[-1]["bot"] = next_message
-            chat_session.save()
+            chat_session.set_reply(next_message)
             
             return Response({
                 "message": next_message,
@@ -186,15 +192,12 @@ class BillInquiriesHandler:
                 "fields": ["contact_number"]
             })
         else:
-            print(f"[WARN] Invalid account number: {user_message}")
+            print(f"[WARN] Invalid account number: {account_number}")
             chat_session.temp_data.pop('account', None)
-            self.account_numbers.pop(chat_session.id, None)
-            self.account_balances.pop(chat_session.id, None)
-            chat_session.save()
+            chat_session.temp_data.pop('balance', None)
             
             error_message = "Invalid account number. Please try again."
-            chat_session.chat_history[-1]["bot"] = error_message
-            chat_session.save()
+            chat_session.set_reply(error_message)
             return Response({
                 "message": error_message,
                 "type": "form",
@@ -213,14 +216,19 @@ class BillInquiriesHandler:
                 "options": self.nodes["bill_inquiries"]["options"]
             })
 
-        if not re.match(r'^\d{10}$', user_message):
+        contact_number = self.extract_mobile_number(user_message)
+        if not contact_number:
             return Response({
                 "message": "Invalid contact number format. Please enter a 10-digit number (e.g., 0714445598)",
                 "type": "form",
                 "fields": ["contact_number"]
             })
 
-        contact_result = self.validate_contact_number_with_api(user_message)
+        contact_result = self._lookup(chat_session, "contact", contact_number, self.validate_contact_number_with_api)
+        return self._compare_contact(chat_session, contact_number, stored_account, contact_result)
+
+    def _compare_contact(self, chat_session, contact_number, stored_account, contact_result):
+        """Show the balance if the contact number belongs to the account, else the mismatch"""
         api_account = contact_result.get('account_number', '') if contact_result else ''
         
         print(f"[DEBUG] Contact validation result: {contact_result}")
@@ -228,14 +236,16 @@ class BillInquiriesHandler:
         print(f"[DEBUG] API returned account: {api_account}")
         
         if api_account and api_account == stored_account:
-            stored_balance = self.account_balances.get(chat_session.id, 0)
+            stored_balance = chat_session.temp_data.get('balance', 0)
             response_message = (
                 "Account Balance Information\n\n"
                 f"• Account Number: {stored_account}\n"
                 f"• Current Balance: Rs. {stored_balance:.2f}"
             )
             chat_session.state = "display_balance"
-            chat_session.save()
+            # The balance shown is about to change (a payment, a new bill);
+            # the next inquiry asks the billing API again
+            self.invalidate_account(stored_account)
             
             return Response({
                 "message": response_message,
@@ -245,7 +255,7 @@ class BillInquiriesHandler:
         else:
             mismatch_details = (
                 f"Contact Number Verification Failed\n\n"
-                f"• Contact Number: {user_message}\n"
+                f"• Contact Number: {contact_number}\n"
                 f"• Your Account: {stored_account}\n"
                 f"• Found Account: {api_account or 'No account found'}\n\n"
                 f"Error: This contact number is not associated with account {stored_account}.\n"
@@ -255,8 +265,7 @@ class BillInquiriesHandler:
             print(f"[DEBUG] Mismatch detected: {mismatch_details}")
             
             chat_session.state = "account_comparison"
-            chat_session.chat_history[-1]["bot"] = mismatch_details
-            chat_session.save()
+            chat_session.set_reply(mismatch_details)
             
             return Response({
                 "message": mismatch_details,
@@ -268,7 +277,6 @@ class BillInquiriesHandler:
         """Handle the account comparison response"""
         if user_message == "Try Again":
             chat_session.state = "contact_verification"
-            chat_session.save()
             return Response({
                 "message": self.nodes["contact_verification"]["message"],
                 "type": "form",
@@ -276,7 +284,6 @@ class BillInquiriesHandler:
             })
         elif user_message == "Exit":
             chat_session.state = "bill_inquiries"
-            chat_session.save()
             return Response({
                 "message": self.nodes["bill_inquiries"]["message"],
                 "type": "menu",
@@ -295,8 +302,7 @@ class BillInquiriesHandler:
         )
         
         chat_session.state = "account_comparison"
-        chat_session.chat_history[-1]["bot"] = comparison_details
-        chat_session.save()
+        chat_session.set_reply(comparison_details)
         
         return Response({
             "message": comparison_details,
@@ -304,63 +310,211 @@ class BillInquiriesHandler:
             "options": self.nodes["account_comparison"]["options"]
         })
 
+    def _service_unavailable(self, chat_session, error):
+        """Fail fast with the canned node while the billing API's circuit is open"""
+        print(f"[WARN] {error}")
+        node = self.nodes["billing_unavailable"]
+        chat_session.state = "billing_unavailable"
+        chat_session.set_reply(node["message"])
+        return conversation_graph.response(node)
+
+    async def aprefetch(self, chat_session, user_message):
+        """Await the upstream lookup the coming verification turn needs (async endpoint only)"""
+        account_number, contact_number = self.extract_identifiers(user_message or '')
+        try:
+            if chat_session.state in ("verification", "bill_inquiries") and account_number:
+                if not contact_number:
+                    result = await self.avalidate_account_number_with_api(account_number)
+                    chat_session.prefetched = {("account", account_number): result}
+                    return
+                result, contact_result = await asyncio.gather(
+                    self.avalidate_account_number_with_api(account_number),
+                    self.avalidate_contact_number_with_api(contact_number),
+                )
+                chat_session.prefetched = {
+                    ("account", account_number): result,
+                    ("contact", contact_number): contact_result,
+                }
+            elif chat_session.state == "contact_verification":
+                contact_number = self.extract_mobile_number(user_message or '')
+                if contact_number:
+                    result = await self.avalidate_contact_number_with_api(contact_number)
+                    chat_session.prefetched = {("contact", contact_number): result}
+        except CircuitOpenError:
+            # The turn itself fails fast and answers with the canned node
+            pass
+
+    def _lookup(self, chat_session, kind, number, validate):
+        """Use the result the async endpoint prefetched, or call the API now"""
+        prefetched = getattr(chat_session, 'prefetched', {})
+        if (kind, number) in prefetched:
+            return prefetched[(kind, number)]
+        return validate(number)
+
     def validate_account_number_with_api(self, account_number):
-        """Validate the account number with the external API"""
+        """Validate the account number, from the billing cache or the external API"""
+        return billing_cache.get_or_load(
+            ("account", account_number),
+            lambda: self._fetch_account_balance(account_number),
+            negative=invalid_account,
+        )
+
+    def _fetch_account_balance(self, account_number):
+        """Ask the billing API for the balance of an account"""
         print(f"\n[INFO] ====== Account Validation Request ======")
         print(f"[INFO] Account number: {account_number}")
         
         try:
-            api_url = f"http://124.43.163.177:8080/CCLECO/Main/GetAccountBalance?accountNumber={account_number}"
+            api_url = billing_url("GetAccountBalance")
             print(f"[DEBUG] Calling API: {api_url}")
             
-            response = requests.get(api_url, timeout=10)
-            print(f"[DEBUG] API Response: Status={response.status_code}, Content={response.text}")
-            
-            if response.status_code == 200:
-                data = response.text.split(',')
-                if len(data) >= 2 and data[0] == "YES":
-                    balance = float(data[1])
-                    print(f"[INFO] Account {account_number} is valid with balance: {balance}")
-                    return {'valid': True, 'balance': balance}
-                else:
-                    print(f"[WARN] API response indicates invalid account: {data}")
-            else:
-                print(f"[ERROR] Unexpected status code: {response.status_code}")
+            response = get_session().get(api_url, params={"accountNumber": account_number})
+            return self._parse_account_response(account_number, response)
         
         except (requests.exceptions.RequestException, ValueError) as e:
             print(f"[ERROR] API error: {str(e)}")
         
+        return {'valid': False, 'error': True}
+
+    async def avalidate_account_number_with_api(self, account_number):
+        """Async variant of validate_account_number_with_api"""
+        return await billing_cache.aget_or_load(
+            ("account", account_number),
+            lambda: self._afetch_account_balance(account_number),
+            negative=invalid_account,
+        )
+
+    async def _afetch_account_balance(self, account_number):
+        """Async variant of _fetch_account_balance"""
+        print(f"[INFO] Validating account number (async): {account_number}")
+        try:
+            response = await get_async_client().get(
+                billing_url("GetAccountBalance"),
+                params={"accountNumber": account_number}
+            )
+            return self._parse_account_response(account_number, response)
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"[ERROR] API error: {str(e)}")
+        return {'valid': False, 'error': True}
+
+    def _parse_account_response(self, account_number, response):
+        """Parse the "YES,<balance>" reply of GetAccountBalance"""
+        print(f"[DEBUG] API Response: Status={response.status_code}, Content={response.text}")
+        
+        if response.status_code == 200:
+            data = response.text.split(',')
+            if len(data) >= 2 and data[0] == "YES":
+                balance = float(data[1])
+                print(f"[INFO] Account {account_number} is valid with balance: {balance}")
+                return {'valid': True, 'balance': balance}
+            else:
+                print(f"[WARN] API response indicates invalid account: {data}")
+        else:
+            print(f"[ERROR] Unexpected status code: {response.status_code}")
+            return {'valid': False, 'error': True}
         return {'valid': False}
 
     def validate_contact_number_with_api(self, contact_number):
-        """Validate the contact number with the external API"""
+        """Look up the account of a contact number, from the billing cache or the external API"""
+        return billing_cache.get_or_load(
+            ("contact", contact_number),
+            lambda: self._fetch_contact_account(contact_number),
+            negative=unknown_contact,
+        )
+
+    def _fetch_contact_account(self, contact_number):
+        """Ask the billing API for the account registered to a contact number"""
         print(f"[INFO] Validating contact number: {contact_number}")
         try:
-            api_url = f"http://124.43.163.177:8080/CCLECO/Main/GetAccountNumber?contactNumber={contact_number}"
+            api_url = billing_url("GetAccountNumber")
             print(f"[DEBUG] Calling API: {api_url}")
             
-            response = requests.get(api_url, timeout=10)
-            print(f"[DEBUG] API Response: Status={response.status_code}, Content={response.text}")
-            
-            if response.status_code == 200:
-                data = response.text.strip()
-                return {'account_number': data}
+            response = get_session().get(api_url, params={"contactNumber": contact_number})
+            return self._parse_contact_response(response)
         except (requests.exceptions.RequestException, IndexError) as e:
             print(f"[ERROR] Contact API error: {str(e)}")
-        return {'account_number': None}
+        return {'account_number': None, 'error': True}
+
+    async def avalidate_contact_number_with_api(self, contact_number):
+        """Async variant of validate_contact_number_with_api"""
+        return await billing_cache.aget_or_load(
+            ("contact", contact_number),
+            lambda: self._afetch_contact_account(contact_number),
+            negative=unknown_contact,
+        )
+
+    async def _afetch_contact_account(self, contact_number):
+        """Async variant of _fetch_contact_account"""
+        print(f"[INFO] Validating contact number (async): {contact_number}")
+        try:
+            response = await get_async_client().get(
+                billing_url("GetAccountNumber"),
+                params={"contactNumber": contact_number}
+            )
+            return self._parse_contact_response(response)
+        except httpx.HTTPError as e:
+            print(f"[ERROR] Contact API error: {str(e)}")
+        return {'account_number': None, 'error': True}
+
+    def _parse_contact_response(self, response):
+        """Parse the plain account number reply of GetAccountNumber"""
+        print(f"[DEBUG] API Response: Status={response.status_code}, Content={response.text}")
+        
+        if response.status_code == 200:
+            data = response.text.strip()
+            return {'account_number': data}
+        return {'account_number': None, 'error': True}
+
+    def invalidate_account(self, account_number):
+        """Forget the cached balance of an account and the contacts found for it; returns how many entries"""
+        cached = billing_cache.invalidate(("account", account_number))
+        return cached + billing_cache.invalidate_matching(
+            lambda key, result: key[0] == "contact" and result.get('account_number') == account_number
+        )
+
+    def invalidate_contact(self, contact_number):
+        """Forget the cached account of a contact number, e.g. after it is re-registered; returns how many entries"""
+        return int(billing_cache.invalidate(("contact", contact_number)))
+
+    @staticmethod
+    def extract_identifiers(message):
+        """Extract (account number, contact number) from a message, None where missing.
+
+        A number goes to whichever of "account" or "phone"/"mobile"/"contact"
+        was written last before it, e.g. "account 1234567890, phone
+        0714445598". A single unmarked number fills the one that is still
+        missing, the account first; several unmarked numbers are not guessed.
+        """
+        found = {'account': None, 'contact': None}
+        unmarked = []
+        previous_end = 0
+        for match in NUMBER_PATTERN.finditer(message):
+            before = message[previous_end:match.start()]
+            previous_end = match.end()
+            number = re.sub(r'\D', '', match.group())
+            account_word = max((m.end() for m in ACCOUNT_WORDS.finditer(before)), default=-1)
+            contact_word = max((m.end() for m in CONTACT_WORDS.finditer(before)), default=-1)
+            if account_word > contact_word:
+                found['account'] = found['account'] or number
+            elif contact_word > account_word:
+                found['contact'] = found['contact'] or number
+            else:
+                unmarked.append(number)
+        missing = [kind for kind in ('account', 'contact') if not found[kind]]
+        if len(unmarked) == 1 and missing:
+            found[missing[0]] = unmarked[0]
+        return found['account'], found['contact']
 
     @staticmethod
     def extract_account_number(message):
         """Extract a 10-digit account number from a message"""
-        match = re.search(r'\b\d{10}\b', message)
-        return match.group() if match else None
+        return BillInquiriesHandler.extract_identifiers(message)[0]
 
     @staticmethod
     def extract_mobile_number(message):
-        """Extract a 10-digit mobile number from a message"""
-        cleaned_message = re.sub(r'[^0-9]', '', message)
-        match = re.search(r'\b\d{10}\b', cleaned_message)
-        return match.group() if match else None
+        """Extract a 10-digit mobile number from a message (the only number, if unmarked)"""
+        account_number, contact_number = BillInquiriesHandler.extract_identifiers(message)
+        return contact_number or account_number
 
     @staticmethod
     def extract_payment_amount(message):
@@ -387,12 +387,12 @@ class FaultReportingHandler:
         return None """
 
 
-import json
-from pathlib import Path
+from collections.abc import Mapping, Sequence
 from rest_framework.response import Response
 import re
 from datetime import datetime
 import random
+from chatbot_api.tree import conversation_graph
 
 class FaultReportingHandler:
     """Enhanced fault reporting handler with robust error handling"""
@@ -423,70 +423,53 @@ class FaultReportingHandler:
             print("[DEBUG] Using existing FaultReportingHandler instance")
 
     def _load_nodes(self):
-        """Load and validate conversation flow nodes"""
+        """Load and validate conversation flow nodes from the shared conversation graph"""
         print("[INFO] Loading node data")
-        base_path = Path(__file__).parent.parent / "categories" / "fault_reporting"
-        
+
         required_nodes = {
             "fault_reporting": {
                 "type": "menu",
                 "message": str,
-                "options": list,
-                "next": dict
+                "options": Sequence,
+                "next": Mapping
             },
             "awaiting_district": {
                 "type": "form",
                 "message": str,
-                "next": dict
+                "next": Mapping
             },
             "awaiting_town": {
                 "type": "form", 
                 "message": str,
-                "next": dict
+                "next": Mapping
             },
             "awaiting_identifier": {
                 "type": "form",
                 "message": str,
-                "next": dict
+                "next": Mapping
             },
             "awaiting_fault_type": {
                 "type": "menu",
                 "message": str,
-                "options": list,
-                "next": dict
+                "options": Sequence,
+                "next": Mapping
             },
             "confirm_details": {
                 "type": "message",
                 "message": str,
-                "next": dict
+                "next": Mapping
             },
             "exit": {
                 "type": "message",
                 "message": str,
-                "next": dict
+                "next": Mapping
             }
         }
 
         try:
-            # Load English nodes
-            en_path = base_path / "en_fault_reporting.json"
-            with open(en_path, encoding='utf-8') as f:
-                data = json.load(f)
-                self._validate_nodes(data, required_nodes)
-                self.nodes.update(data)
-                self.nodes["fault_reporting"] = data["fault_reporting"]
-                print(f"[DEBUG] Loaded {len(data)} English nodes")
-
-            # Load Sinhala nodes if available
-            si_path = base_path / "si_fault_reporting.json"
-            if si_path.exists():
-                with open(si_path, encoding='utf-8') as f:
-                    data = json.load(f)
-                    self._validate_nodes(data, required_nodes)
-                    self.nodes.update(data)
-                    self.nodes["fault_reporting_si"] = data["fault_reporting_si"]
-                    print(f"[DEBUG] Loaded {len(data)} Sinhala nodes")
-
+            nodes = conversation_graph.category("fault_reporting")
+            self._validate_nodes(nodes, required_nodes)
+            self.nodes = nodes
             print(f"[INFO] Total nodes loaded: {len(self.nodes)}")
             
         except Exception as e:
@@ -504,7 +487,14 @@ class FaultReportingHandler:
                 if field not in node:
                     raise KeyError(f"Missing field '{field}' in node '{node_name}'")
                 
-                if not isinstance(node[field], field_type):
+                if not isinstance(field_type, type):
+                    # Literal requirement such as "type": "menu"
+                    if node[field] != field_type:
+                        raise ValueError(
+                            f"Invalid value for {node_name}.{field}. "
+                            f"Expected {field_type!r}, got {node[field]!r}"
+                        )
+                elif not isinstance(node[field], field_type):
                     raise TypeError(
                         f"Invalid type for {node_name}.{field}. "
                         f"Expected {field_type}, got {type(node[field])}"
@@ -517,7 +507,6 @@ class FaultReportingHandler:
         # Initialize session if needed
         chat_session.state = getattr(chat_session, 'state', 'fault_reporting')
         chat_session.temp_data = getattr(chat_session, 'temp_data', {})
-        chat_session.chat_history = getattr(chat_session, 'chat_history', [])
         
         try:
             # Handle form states
@@ -575,30 +564,11 @@ class FaultReportingHandler:
 
         # Update session state
         chat_session.state = next_node_key
-        chat_session.save()
-
-        # Prepare response
-        next_node = self.nodes[next_node_key]
-        response_data = {
-            "message": next_node["message"],
-            "type": next_node["type"],
-            "session_state": chat_session.state
-        }
-
-        # Add optional fields
-        if "options" in next_node:
-            response_data["options"] = next_node["options"]
-        if "fields" in next_node:
-            response_data["fields"] = next_node["fields"]
 
         # Update chat history
-        chat_session.chat_history.append({
-            "user": user_message,
-            "bot": next_node["message"]
-        })
-        chat_session.save()
+        chat_session.add_turn(user_message, self.nodes[next_node_key]["message"])
 
-        return Response(response_data)
+        return self._prepare_response(next_node_key)
 
     def _handle_form_input(self, chat_session, user_message):
         """Process form input with validation"""
@@ -615,11 +585,7 @@ class FaultReportingHandler:
             })
 
         # Update chat history
-        chat_session.chat_history.append({
-            "user": user_message,
-            "bot": "Processing your input..."
-        })
-        chat_session.save()
+        chat_session.add_turn(user_message, "Processing your input...")
 
         try:
             # Route to appropriate processor
@@ -648,7 +614,6 @@ class FaultReportingHandler:
 
         chat_session.temp_data["district"] = district
         chat_session.state = "awaiting_town"
-        chat_session.save()
 
         return self._prepare_response("awaiting_town")
 
@@ -664,7 +629,6 @@ class FaultReportingHandler:
 
         chat_session.temp_data["town"] = town
         chat_session.state = "awaiting_identifier"
-        chat_session.save()
 
         return self._prepare_response("awaiting_identifier")
 
@@ -681,7 +645,6 @@ class FaultReportingHandler:
         chat_session.temp_data["identifier"] = identifier
         chat_session.temp_data["identifier_type"] = "account" if identifier.isdigit() else "contact"
         chat_session.state = "awaiting_fault_type"
-        chat_session.save()
 
         return self._prepare_response("awaiting_fault_type")
 
@@ -697,7 +660,6 @@ class FaultReportingHandler:
 
         chat_session.temp_data["fault_type"] = fault_type
         chat_session.state = "confirm_details"
-        chat_session.save()
 
         return Response({
             "message": self._generate_confirmation(chat_session),
@@ -705,20 +667,8 @@ class FaultReportingHandler:
         })
 
     def _prepare_response(self, node_key):
-        """Prepare standardized response for a node"""
-        node = self.nodes[node_key]
-        response = {
-            "message": node["message"],
-            "type": node["type"],
-            "session_state": node_key
-        }
-        
-        if "options" in node:
-            response["options"] = node["options"]
-        if "fields" in node:
-            response["fields"] = node["fields"]
-            
-        return Response(response)
+        """Serve the node's response, pre-rendered by the conversation graph like every other hop"""
+        return conversation_graph.response(self.nodes[node_key])
 
     def _generate_confirmation(self, chat_session):
         """Generate confirmation message with collected data"""
@@ -740,7 +690,6 @@ class FaultReportingHandler:
     def _handle_error(self, chat_session):
         """Handle errors gracefully"""
         chat_session.state = "fault_reporting"
-        chat_session.save()
         
         return Response({
             "message": random.choice([
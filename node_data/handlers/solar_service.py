@@ -1,8 +1,11 @@
-import json
-from pathlib import Path
 from rest_framework.response import Response
+from django.conf import settings
+import httpx
 import requests
 import re
+from chatbot_api.tree import conversation_graph
+from chatbot_api.circuit import CircuitOpenError
+from chatbot_api.upstream import get_async_client, get_session
 
 
 class SolarServiceHandler:
@@ -33,27 +36,10 @@ class SolarServiceHandler:
             print("[DEBUG] Using existing SolarServiceHandler instance")
     
     def _load_nodes(self):
-        """Load conversation flow nodes from JSON files (English and Sinhala)"""
+        """Attach the solar service nodes from the shared conversation graph"""
         print("[INFO] Loading node data")
-        base_path = Path(__file__).parent.parent / "categories" / "solar_service"
-        try:
-            with open(base_path / "en_solar_service.json", encoding='utf-8') as f:
-                data = json.load(f)
-                self.nodes["solar_service"] = data["solar_service"]
-                self.nodes.update(data)
-            
-            try:
-                with open(base_path / "si_solar_service.json", encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.nodes["solar_service_si"] = data["solar_service_si"]
-                    self.nodes.update(data)
-            except FileNotFoundError:
-                print("[WARN] Sinhala solar service file not found. Proceeding without it.")
-            
-            print("[INFO] Successfully loaded node data")
-        except Exception as e:
-            print(f"[ERROR] Error loading solar service nodes: {e}")
-            raise
+        self.nodes = conversation_graph.category("solar_service")
+        print("[INFO] Successfully loaded node data")
 
     def handle_solar_service(self, chat_session, user_message, current_node):
         """Handle solar service with improved logging"""
@@ -98,18 +84,9 @@ class SolarServiceHandler:
             
             if next_node:
                 chat_session.state = next_node_key
-                chat_session.chat_history.append({
-                    "user": user_message,
-                    "bot": next_node["message"]
-                })
-                chat_session.save()
+                chat_session.add_turn(user_message, next_node["message"])
                 
-                return Response({
-                    "message": next_node["message"],
-                    "type": next_node["type"],
-                    "options": next_node.get("options", []),
-                    "fields": next_node.get("fields", [])
-                })
+                return conversation_graph.response(next_node)
         
         return Response({
             "message": "Invalid option. Please select from the menu.",
@@ -126,10 +103,7 @@ class SolarServiceHandler:
         if not hasattr(chat_session, 'temp_data'):
             chat_session.temp_data = {}
 
-        chat_session.chat_history.append({
-            "user": user_message,
-            "bot": "Processing your request..."
-        })
+        chat_session.add_turn(user_message, "Processing your request...")
 
         try:
             if chat_session.state == "verification":
@@ -140,45 +114,78 @@ class SolarServiceHandler:
             
             elif chat_session.state == "solar_details":
                 chatbot_response = self.fetch_chatbot_response(user_message, chat_session)
-                chat_session.chat_history[-1]["bot"] = chatbot_response
-                chat_session.save()
+                chat_session.set_reply(chatbot_response)
                 return Response({
                     "message": chatbot_response,
                     "type": "message"
                 })
             
+        except CircuitOpenError as e:
+            return self._service_unavailable(chat_session, e)
         except Exception as e:
             print(f"[ERROR] Form input processing error: {str(e)}")
             return self._handle_error(chat_session, user_message)
 
     def fetch_chatbot_response(self, user_message, session):
         """Fetch response from the chatbot API"""
-        api_url = "http://localhost:8001/chat/"
-        payload = {
-            "question": user_message,
-            "session_id": session.get("session_id", "default")  # Default session if not provided
-        }
-        
+        prefetched = getattr(session, 'prefetched', {})
+        if ("chat", user_message) in prefetched:
+            return prefetched[("chat", user_message)]
+
         try:
             # Send POST request to the FastAPI server
-            response = requests.post(api_url, json=payload)
-            
-            # Check if the response is successful
-            if response.status_code == 200:
-                response_data = response.json()
-                
-                # Update session with the new session_id if returned
-                if 'session_id' in response_data:
-                    session["session_id"] = response_data["session_id"]
-                
-                # Return the chatbot's response
-                return response_data.get("response", "I'm sorry, I couldn't understand that.")
-            else:
-                return f"Error: {response.status_code}, Unable to get response from the chatbot."
+            response = get_session().post(
+                settings.SOLAR_CHAT_URL,
+                json=self._chat_payload(user_message, session),
+                timeout=(settings.UPSTREAM_CONNECT_TIMEOUT, settings.SOLAR_CHAT_READ_TIMEOUT)
+            )
+            return self._parse_chat_response(response)
         
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            return f"An error occurred while fetching the chatbot response: {str(e)}"
+
+    async def afetch_chatbot_response(self, user_message, session):
+        """Async variant of fetch_chatbot_response"""
+        try:
+            response = await get_async_client().post(
+                settings.SOLAR_CHAT_URL,
+                json=self._chat_payload(user_message, session),
+                timeout=httpx.Timeout(settings.SOLAR_CHAT_READ_TIMEOUT, connect=settings.UPSTREAM_CONNECT_TIMEOUT)
+            )
+            return self._parse_chat_response(response)
+        except CircuitOpenError:
+            raise
         except Exception as e:
             return f"An error occurred while fetching the chatbot response: {str(e)}"
 
+    def _chat_payload(self, user_message, session):
+        return {
+            "question": user_message,
+            "session_id": getattr(session, "session_id", None) or "default"  # Default session if not provided
+        }
+
+    def _parse_chat_response(self, response):
+        """Extract the answer from the chatbot API reply"""
+        # Check if the response is successful
+        if response.status_code == 200:
+            response_data = response.json()
+            # Return the chatbot's response
+            return response_data.get("response", "I'm sorry, I couldn't understand that.")
+        else:
+            return f"Error: {response.status_code}, Unable to get response from the chatbot."
+
+    async def aprefetch(self, chat_session, user_message):
+        """Await the chatbot API answer the coming solar_details turn needs (async endpoint only)"""
+        if chat_session.state == "solar_details" and user_message:
+            try:
+                answer = await self.afetch_chatbot_response(user_message, chat_session)
+            except CircuitOpenError:
+                # The turn itself fails fast and answers with the canned node
+                return
+            chat_session.prefetched = {("chat", user_message): answer}
+
     def _verify_account_number(self, chat_session, user_message):
         """Verify the account number provided by the user"""
         print("[DEBUG] Processing account verification")
@@ -191,7 +198,6 @@ class SolarServiceHandler:
             })
 
         chat_session.temp_data['account'] = user_message
-        chat_session.save()
 
         result = self.validate_account_number_with_api(user_message)
         print(f"[DEBUG] API validation result: {result}")
@@ -199,12 +205,10 @@ class SolarServiceHandler:
         if result['valid']:
             print(f"[INFO] Account {user_message} validated successfully")
             chat_session.temp_data['balance'] = result['balance']
-            chat_session.save()
             
             chat_session.state = "contact_verification"
             next_message = self.nodes["contact_verification"]["message"]
-            chat_session.chat_history[-1]["bot"] = next_message
-            chat_session.save()
+            chat_session.set_reply(next_message)
             
             return Response({
                 "message": next_message,
@@ -214,11 +218,9 @@ class SolarServiceHandler:
         else:
             print(f"[WARN] Invalid account number: {user_message}")
             chat_session.temp_data.pop('account', None)
-            chat_session.save()
             
             error_message = "Invalid account number. Please try again."
-            chat_session.chat_history[-1]["bot"] = error_message
-            chat_session.save()
+            chat_session.set_reply(error_message)
             return Response({
                 "message": error_message,
                 "type": "form",
@@ -248,7 +250,6 @@ class SolarServiceHandler:
                 f"• Associated Account: {api_account}"
             )
             chat_session.state = "display_balance"
-            chat_session.save()
             
             return Response({
                 "message": response_message,
@@ -266,8 +267,7 @@ class SolarServiceHandler:
             print(f"[DEBUG] Mismatch detected: {mismatch_details}")
             
             chat_session.state = "account_comparison"
-            chat_session.chat_history[-1]["bot"] = mismatch_details
-            chat_session.save()
+            chat_session.set_reply(mismatch_details)
             
             return Response({
                 "message": mismatch_details,
@@ -275,6 +275,14 @@ class SolarServiceHandler:
                 "options": ["Try Again", "Exit"]
             })
 
+    def _service_unavailable(self, chat_session, error):
+        """Fail fast with the canned node while the solar service's circuit is open"""
+        print(f"[WARN] {error}")
+        node = self.nodes["solar_unavailable"]
+        chat_session.state = "solar_unavailable"
+        chat_session.set_reply(node["message"])
+        return conversation_graph.response(node)
+
     def _handle_error(self, chat_session, user_message):
         """Handle errors during form input processing"""
         error_message = (
@@ -283,8 +291,7 @@ class SolarServiceHandler:
         )
         
         chat_session.state = "solar_service"
-        chat_session.chat_history[-1]["bot"] = error_message
-        chat_session.save()
+        chat_session.set_reply(error_message)
         
         return Response({
             "message": error_message,
@@ -301,7 +308,7 @@ class SolarServiceHandler:
             api_url = f"http://example.com/api/validate_account?accountNumber={account_number}"
             print(f"[DEBUG] Calling API: {api_url}")
             
-            response = requests.get(api_url, timeout=10)
+            response = get_session().get(api_url)
             print(f"[DEBUG] API Response: Status={response.status_code}, Content={response.text}")
             
             if response.status_code == 200:
@@ -327,7 +334,7 @@ class SolarServiceHandler:
             api_url = f"http://example.com/api/validate_contact?contactNumber={contact_number}"
             print(f"[DEBUG] Calling API: {api_url}")
             
-            response = requests.get(api_url, timeout=10)
+            response = get_session().get(api_url)
             print(f"[DEBUG] API Response: Status={response.status_code}, Content={response.text}")
             
             if response.status_code == 200: